@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import base64
+import random
+import hashlib
+from typing import Dict, List, Tuple, Any
+
+BENCHMARK_DIR = os.path.dirname(os.path.realpath(__file__))
+ROOT_DIR = os.path.dirname(BENCHMARK_DIR)
+CLIENT_DIR = os.path.join(ROOT_DIR, "feature_sync_client")
+SERVER_DIR = os.path.join(ROOT_DIR, "feature_sync_server")
+
+# 基准测试用的表结构，MySQL 和 SQLite 都能执行；区域索引与 sql/region_index.sql 相同
+# （SQLite 的索引名在整个库中唯一，加上表名前缀）
+TABLES = {
+    "user": "create table `user` (`id` integer not null primary key, `uid` varchar(64), `pic_md5` blob, "
+            "`province_code` varchar(64), `city_code` varchar(64), `town_code` varchar(64))",
+    "feature_model_0330": "create table `feature_model_0330` (`id` integer not null primary key, `user_id` integer, "
+                          "`timestamp` bigint, `feature_id` integer, `feature` blob, "
+                          "`province_code` varchar(64), `city_code` varchar(64), `town_code` varchar(64))",
+}
+INDEXES = (
+    ("idx_region_city_id", "`province_code`, `city_code`, `id`"),
+    ("idx_region_town_id", "`province_code`, `city_code`, `town_code`, `id`"),
+)
+
+STMT_INSERT = {
+    "user": "insert into `user` (id, uid, pic_md5, province_code, city_code, town_code) "
+            "values (%(id)s, %(uid)s, %(pic_md5)s, %(province_code)s, %(city_code)s, %(town_code)s)",
+    "feature_model_0330": "insert into `feature_model_0330` (id, user_id, timestamp, feature_id, feature, province_code, city_code, town_code) "
+                          "values (%(id)s, %(user_id)s, %(timestamp)s, %(feature_id)s, %(feature)s, %(province_code)s, %(city_code)s, %(town_code)s)",
+}
+
+
+def use_app(app_dir, backend):
+    """
+    把客户端或服务端的目录放到 sys.path 最前面，以便 import lib / core；
+    backend 为 sqlite 时把 lib.mysql_client.MysqlClient 换成 SqliteClient，需要在 import core 之前调用
+    一个进程只能使用其中一个应用，两边的 lib / core 同名
+    """
+    sys.path.insert(0, app_dir)
+    if backend == "sqlite":
+        import lib.mysql_client
+        from sqlite_client import SqliteClient
+        lib.mysql_client.MysqlClient = SqliteClient
+
+
+def parse_regions(regions) -> List[Tuple[str, str, str]]:
+    result = []
+    for region in regions.split(","):
+        codes = [code.strip() for code in region.strip().split("/")]
+        if len(codes) < 2 or len(codes) > 3:
+            raise ValueError("invalid region <{}>, expect province_code/city_code/town_code".format(region))
+        result.append((codes[0], codes[1], codes[2] if len(codes) == 3 and codes[2] else "-1"))
+    return result
+
+
+def user_region(regions: List[Tuple[str, str, str]], user_id) -> Dict[str, str]:
+    """
+    user 所在的区域: 按 id 轮流分到各个区域，区域的 town_code 为 -1（整个城市）时分到这个城市的 4 个区县
+    """
+    province_code, city_code, town_code = regions[(user_id - 1) % len(regions)]
+    if town_code == "-1":
+        town_code = "{}{:02d}".format(city_code, user_id % 4)
+    return dict(province_code=province_code, city_code=city_code, town_code=town_code)
+
+
+def generate(regions: List[Tuple[str, str, str]], users, features_per_user, feature_bytes, seed=0) -> Dict[str, List[Dict[Any, Any]]]:
+    """
+    云端的数据: users 个 user（id 为 1 到 users）按 user_region 分到各个区域，每个 user 有 features_per_user 个 feature，
+    第 n 个 user 的 feature 的 id 为 (n - 1) * features_per_user + 1 到 n * features_per_user
+    pic_md5 是 16 字节的二进制 md5，feature 是 feature_bytes 字节的 base64 文本（随机的可打印字节，json 格式传输时和其他 bytes 一样再编码成 base64）
+    """
+    rnd = random.Random(seed)
+    rows = {"user": [], "feature_model_0330": []}
+    feature_id = 0
+    for user_id in range(1, users + 1):
+        region = user_region(regions, user_id)
+        rows["user"].append(dict(id=user_id, uid="uid{:010d}".format(user_id),
+                                 pic_md5=hashlib.md5(str(rnd.random()).encode()).digest(), **region))
+        for _ in range(features_per_user):
+            feature_id += 1
+            rows["feature_model_0330"].append(dict(id=feature_id, user_id=user_id, timestamp=1600000000000 + feature_id,
+                                                   feature_id=feature_id, feature=random_feature(rnd, feature_bytes),
+                                                   **region))
+    return rows
+
+
+def random_feature(rnd, size):
+    return base64.b64encode(rnd.getrandbits(size * 6).to_bytes(size * 6 // 8 + 1, "little"))[:size]
+
+
+def drift(cloud_rows: Dict[str, List[Dict[Any, Any]]], missing, extra, stale, seed=0) -> Tuple[Dict[str, List[Dict[Any, Any]]], Dict[str, Dict[str, int]]]:
+    """
+    远程的数据: 云端数据的副本，按比例去掉 missing 的行（需要插入）、修改 stale 的行（需要更新），
+    再加上 extra 比例的只在远程的行（需要删除，id 在云端最大 id 之后）
+    只在远程的 feature 一半属于云端已有的 user，一半属于只在远程的 user：这些 user 的删除在服务端推迟（code 104），
+    同一轮中 feature 删除之后，下一轮才删除 user；其余只在远程的 user 没有 feature
+    返回 (远程的数据, 每张表的 missing / stale / extra 行数)
+    """
+    rnd = random.Random(seed + 1)
+    remote_rows = {}
+    counts = {}
+    extra_users = []
+    for table in ("user", "feature_model_0330"):
+        rows = cloud_rows[table]
+        remote, counter = [], dict(missing=0, stale=0, extra=0)
+        for row in rows:
+            value = rnd.random()
+            if value < missing:
+                counter["missing"] += 1
+                continue
+            row = dict(row)
+            if value < missing + stale:
+                counter["stale"] += 1
+                if table == "user":
+                    row["uid"] = row["uid"] + "-stale"
+                else:
+                    row["timestamp"] -= 1
+            remote.append(row)
+
+        max_id = rows[-1]["id"] if rows else 0
+        for i in range(int(len(rows) * extra)):
+            row = dict(rnd.choice(rows)) if rows else None
+            if row is None:
+                break
+            row["id"] = max_id + i + 1
+            if table == "user":
+                row["uid"] = "extra{:010d}".format(row["id"])
+                extra_users.append(row)
+            elif i % 2 == 1 and extra_users:
+                user = extra_users[i // 2 % len(extra_users)]
+                row.update(user_id=user["id"], province_code=user["province_code"], city_code=user["city_code"],
+                           town_code=user["town_code"])
+            remote.append(row)
+            counter["extra"] += 1
+        remote_rows[table] = remote
+        counts[table] = counter
+    return remote_rows, counts
+
+
+async def create_tables(database_client, backend):
+    for table, statement in TABLES.items():
+        await database_client.execute("drop table if exists `{}`".format(table))
+        await database_client.execute(statement)
+        for index_name, columns in INDEXES:
+            if backend == "sqlite":
+                index_name = "{}_{}".format(table, index_name)
+            await database_client.execute("create index `{}` on `{}` ({})".format(index_name, table, columns))
+
+
+async def load_rows(database_client, rows: Dict[str, List[Dict[Any, Any]]], chunk_size=1000):
+    for table, table_rows in rows.items():
+        for i in range(0, len(table_rows), chunk_size):
+            await database_client.executemany(STMT_INSERT[table], table_rows[i:i + chunk_size])
+
+
+async def table_digests(database_client, regions: List[Tuple[str, str, str]]) -> Dict[str, Dict[int, str]]:
+    """
+    各区域每张表每一行的 md5，用来检查同步之后两边是否一致
+    """
+    digests = {}
+    for table in TABLES:
+        table_digests = {}
+        for province_code, city_code, town_code in regions:
+            statement = "select * from `{}` where province_code=%(province_code)s and city_code=%(city_code)s".format(table)
+            if town_code != "-1":
+                statement += " and town_code=%(town_code)s"
+            for row in await database_client.query_all(statement, dict(province_code=province_code, city_code=city_code,
+                                                                        town_code=town_code)):
+                table_digests[row["id"]] = hashlib.md5(repr(sorted((key, bytes(value) if isinstance(value, (bytes, bytearray)) else value)
+                                                                   for key, value in row.items())).encode()).hexdigest()
+        digests[table] = table_digests
+    return digests
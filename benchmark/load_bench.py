@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+feature_sync_server 的压力测试: concurrency 个协程按 mix 中的比例发送 /feature 的命令（见 feature_sync_server/readme.md），
+输出每个命令的吞吐量和 p50/p95/p99 延迟；可以连接已有的服务（--url），也可以在本地用 SQLite 替身或 MySQL 启动服务，
+--server-workers 为逗号分隔的多个值时依次用每个 workers_num 重新启动服务并测试
+    python3 benchmark/load_bench.py --backend sqlite --server-workers 1,2,4 --concurrency 32 --duration 30
+用法见 benchmark/readme.md
+"""
+
+import os
+import json
+import time
+import base64
+import random
+import asyncio
+import argparse
+import tempfile
+import collections
+from typing import Dict, List, Tuple, Any
+
+import dataset
+import sync_bench
+from dataset import CLIENT_DIR, SERVER_DIR
+
+DEFAULT_MIX = "query_user_digest_range=30,query_feature_model_0330_time_range=30,query_user_range=10,get_range_digest=5," \
+              "add_user=5,update_user=5,del_user_by_id=5,add_feature_model_0330=3,update_feature_model_0330=3," \
+              "del_feature_model_0330_by_id=3,add_users_batch=1"
+# 压测期间新增的行的 id 从这里开始，不与已有的数据冲突
+NEW_ID_BASE = 1000000000
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="load generator for the feature sync server")
+    parser.add_argument('--url', default=None, help='existing server, e.g. http://127.0.0.1:9000/feature; a local server is started if not set')
+    parser.add_argument('--backend', default='sqlite', choices=['sqlite', 'mysql'], help='database of the local server')
+    parser.add_argument('--workdir', default=None)
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='command=weight, comma separated')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=30, help='seconds of each run')
+    parser.add_argument('--requests', type=int, default=0, help='stop after this many requests, 0 for duration only')
+    parser.add_argument('--warmup', type=float, default=3, help='seconds not counted at the beginning of each run')
+    parser.add_argument('--page-size', type=int, default=1000, help='limit of the range queries')
+    parser.add_argument('--range-span', type=int, default=5000, help='id span of the range queries and exports')
+    parser.add_argument('--batch-size', type=int, default=100, help='rows of the *_batch commands and commands of batch')
+    parser.add_argument('--feature-bytes', type=int, default=2048)
+    parser.add_argument('--wire-format', default='msgpack', choices=['msgpack', 'json'])
+    parser.add_argument('--compression', default='zstd,gzip', help='request/response encodings, empty for none')
+    parser.add_argument('--regions', default='320000/321000/321084', help='province_code/city_code[/town_code], comma separated')
+    parser.add_argument('--users', type=int, default=100000, help='users in the dataset (seeded for a local server)')
+    parser.add_argument('--features-per-user', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--mysql-host', default='127.0.0.1')
+    parser.add_argument('--mysql-port', type=int, default=3306)
+    parser.add_argument('--mysql-user', default='root')
+    parser.add_argument('--mysql-password', default='')
+    parser.add_argument('--remote-db', default='feature_sync_bench_remote', help='mysql database of the local server (must exist)')
+    parser.add_argument('--server-port', type=int, default=19000)
+    parser.add_argument('--server-workers', default='1', help='workers_num of the local server, comma separated to compare')
+    parser.add_argument('--server-conf', default=os.path.join(SERVER_DIR, 'conf', 'feature_sync_server.conf'))
+    parser.add_argument('--server-set', action='append', default=[], metavar='SECTION.key=value',
+                        help='override a server conf value, e.g. MYSQL.max_connections=20')
+    parser.add_argument('--log-level', default='INFO')
+    parser.add_argument('--output', default=None, help='append the result of each run as one json line to this file')
+    return parser.parse_args()
+
+
+def parse_mix(mix) -> Dict[str, float]:
+    weights = collections.OrderedDict()
+    for item in mix.split(","):
+        if not item.strip():
+            continue
+        command, _, weight = item.partition("=")
+        weights[command.strip()] = float(weight or 1)
+    return weights
+
+
+def percentile(sorted_values: List[float], p):
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(p / 100.0 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+class Workload(object):
+    """
+    生成每个命令的请求: (method, path, 参数)，path 为 "" 或 "/export"
+    查询随机选一个区域和 id 区间；更新已有的行；新增的行 id 从 NEW_ID_BASE 开始，删除时只删除压测中新增的行，数据量保持稳定
+    """
+    def __init__(self, regions, users, features_per_user, page_size, range_span, batch_size, feature_bytes, seed=0):
+        self._regions = regions
+        self._users = users
+        self._features_per_user = features_per_user
+        self._page_size = page_size
+        self._range_span = range_span
+        self._batch_size = batch_size
+        self._feature_bytes = feature_bytes
+        self._rnd = random.Random(seed)
+        self._next_id = {"user": NEW_ID_BASE, "feature_model_0330": NEW_ID_BASE}
+        self._added = {"user": collections.deque(), "feature_model_0330": collections.deque()}
+
+    def _region_query(self, table):
+        max_id = self._users * (self._features_per_user if table == "feature_model_0330" else 1)
+        begin_id = self._rnd.randint(-1, max(-1, max_id - self._range_span))
+        province_code, city_code, town_code = self._rnd.choice(self._regions)
+        return dict(province_code=province_code, city_code=city_code, town_code=town_code,
+                    begin_id=begin_id, end_id=begin_id + self._range_span)
+
+    def _user(self, user_id):
+        return dict(id=user_id, uid="load{:010d}-{}".format(user_id, self._rnd.getrandbits(32)),
+                    pic_md5=base64.b64encode(self._rnd.getrandbits(128).to_bytes(16, "little")).decode(),
+                    **dataset.user_region(self._regions, user_id))
+
+    def _feature(self, feature_id, user_id=None):
+        if user_id is None:
+            user_id = (feature_id - 1) // max(1, self._features_per_user) + 1
+        return dict(id=feature_id, user_id=user_id, timestamp=int(time.time() * 1000), feature_id=feature_id,
+                    feature=base64.b64encode(dataset.random_feature(self._rnd, self._feature_bytes)).decode(),
+                    **dataset.user_region(self._regions, user_id))
+
+    def _new(self, table):
+        self._next_id[table] += 1
+        self._added[table].append(self._next_id[table])
+        if table == "user":
+            return self._user(self._next_id[table])
+        return self._feature(self._next_id[table], user_id=self._rnd.randint(1, self._users))
+
+    def _existing(self, table):
+        if table == "user":
+            return self._user(self._rnd.randint(1, self._users))
+        return self._feature(self._rnd.randint(1, self._users * max(1, self._features_per_user)))
+
+    def _delete_id(self, table):
+        # 没有新增的行可以删除时删除一个不存在的 id
+        return self._added[table].popleft() if self._added[table] else NEW_ID_BASE * 2
+
+    def request(self, command) -> Tuple[str, str, Dict[str, Any]]:
+        table = "feature_model_0330" if "feature_model_0330" in command else "user"
+        if command == "get_sync_status":
+            province_code, city_code, town_code = self._rnd.choice(self._regions)
+            return "GET", "", dict(command=command, province_code=province_code, city_code=city_code, town_code=town_code)
+        if command == "get_range_digest":
+            table = self._rnd.choice(["user", "feature_model_0330"])
+            return "GET", "", dict(command=command, table=table, bucket_count=16, **self._region_query(table))
+        if command.startswith("query_") and command.endswith("_range"):
+            return "GET", "", dict(command=command, limit=self._page_size, **self._region_query(table))
+        if command.startswith("export_"):
+            return "GET", "/export", dict(command=command, **self._region_query(table))
+        if command in ("add_user", "add_feature_model_0330"):
+            return "POST", "", dict(command=command, values=self._new(table))
+        if command in ("update_user", "update_feature_model_0330"):
+            return "POST", "", dict(command=command, values=self._existing(table))
+        if command in ("del_user_by_id", "del_feature_model_0330_by_id"):
+            return "POST", "", dict(command=command, id=self._delete_id(table))
+        if command in ("add_users_batch", "add_feature_model_0330_batch"):
+            return "POST", "", dict(command=command, values=[self._new(table) for _ in range(self._batch_size)])
+        if command in ("update_users_batch", "update_feature_model_0330_batch"):
+            return "POST", "", dict(command=command, values=[self._existing(table) for _ in range(self._batch_size)])
+        if command == "batch":
+            # 一半新增一半更新，fail_fast=0
+            commands = [dict(command="add_user", values=self._new("user")) for _ in range(self._batch_size // 2)] \
+                + [dict(command="update_user", values=self._existing("user")) for _ in range(self._batch_size - self._batch_size // 2)]
+            return "POST", "", dict(command=command, fail_fast=0, commands=commands)
+        # 其他命令（如 get_database_stats）不带参数
+        return "GET", "", dict(command=command)
+
+
+class CommandStats(object):
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self.error_sample = None
+        self.transfer = collections.Counter()
+
+    def to_dict(self, elapsed) -> Dict[str, Any]:
+        latencies = sorted(self.latencies)
+
+        def ms(value):
+            return round(value * 1000, 2) if value is not None else None
+
+        return dict(count=len(latencies),
+                    errors=self.errors,
+                    error_sample=self.error_sample,
+                    throughput=round(len(latencies) / elapsed, 1) if elapsed else None,
+                    p50_ms=ms(percentile(latencies, 50)),
+                    p95_ms=ms(percentile(latencies, 95)),
+                    p99_ms=ms(percentile(latencies, 99)),
+                    mean_ms=ms(sum(latencies) / len(latencies)) if latencies else None,
+                    max_ms=ms(latencies[-1]) if latencies else None,
+                    bytes_sent=self.transfer["sent"],
+                    bytes_received=self.transfer["received"])
+
+
+async def send(client, url, method, path, params) -> Tuple[bool, str]:
+    """
+    返回 (是否成功, 失败的原因)；流式导出读完所有行，以最后一行的 code 为准
+    """
+    from lib.wire_format import loads
+
+    if path == "/export":
+        trailer = None
+        async for line in client.get_lines(url.rstrip("/") + path, **params):
+            trailer = line
+        result = loads(trailer) if trailer is not None else dict(code=-1, desc="no trailer")
+    elif method == "GET":
+        result = (await client.get(url, **params)).data
+    else:
+        result = (await client.post(url, body=params)).data
+    if result.get("code", 0) != 0:
+        return False, "{} {}".format(result.get("code"), result.get("desc"))
+    return True, None
+
+
+async def run_load(args, url, weights: Dict[str, float]) -> Dict[str, Any]:
+    from lib.async_http_response_proxy import AsyncHttpClientProxy
+    from lib.compression import Compression
+    from lib.wire_format import WireFormat, JSON, MSGPACK
+
+    workload = Workload(dataset.parse_regions(args.regions), args.users, args.features_per_user, args.page_size,
+                        args.range_span, args.batch_size, args.feature_bytes, args.seed)
+    stats = collections.defaultdict(CommandStats)
+    session = AsyncHttpClientProxy.create_session(limit=args.concurrency, limit_per_host=args.concurrency)
+    compression = Compression(encodings=[encoding for encoding in args.compression.split(",") if encoding], level=6, min_size=1024)
+    wire_format = WireFormat([MSGPACK, JSON] if args.wire_format == "msgpack" else [JSON])
+    clients = {command: AsyncHttpClientProxy(session=session, compression=compression, wire_format=wire_format,
+                                             transfer=stats[command].transfer) for command in weights}
+    commands, command_weights = list(weights), list(weights.values())
+
+    begin = time.time()
+    measure_begin = begin + args.warmup
+    deadline = measure_begin + args.duration
+    sent = [0]
+
+    async def worker():
+        while time.time() < deadline and (not args.requests or sent[0] < args.requests):
+            sent[0] += 1
+            command = random.choices(commands, command_weights)[0]
+            method, path, params = workload.request(command)
+            request_begin = time.time()
+            try:
+                success, error = await send(clients[command], url, method, path, params)
+            except Exception as err:
+                success, error = False, "{}".format(err)
+            request_end = time.time()
+            if request_begin < measure_begin:
+                continue
+            if success:
+                stats[command].latencies.append(request_end - request_begin)
+            else:
+                stats[command].errors += 1
+                stats[command].error_sample = stats[command].error_sample or error
+
+    try:
+        await asyncio.gather(*[worker() for _ in range(args.concurrency)])
+    finally:
+        await session.close()
+    elapsed = max(0.0, min(time.time(), deadline) - measure_begin)
+
+    commands_result = {command: stats[command].to_dict(elapsed) for command in weights}
+    all_latencies = sorted(latency for command_stats in stats.values() for latency in command_stats.latencies)
+    total = CommandStats()
+    total.latencies = all_latencies
+    total.errors = sum(command_stats.errors for command_stats in stats.values())
+    for command_stats in stats.values():
+        total.transfer.update(command_stats.transfer)
+    return dict(elapsed=round(elapsed, 3), commands=commands_result, total=total.to_dict(elapsed))
+
+
+async def load_remote(args, remote_db, rows):
+    database_client = sync_bench.open_database(args, remote_db)
+    await database_client.create_pool()
+    try:
+        await dataset.create_tables(database_client, args.backend)
+        await dataset.load_rows(database_client, rows)
+    finally:
+        await database_client.close()
+
+
+def print_result(result):
+    print("server workers: {}, concurrency: {}, elapsed: {}s".format(
+          result["server_workers"], result["concurrency"], result["elapsed"]))
+    print("    {:<40} {:>8} {:>7} {:>9} {:>9} {:>9} {:>9} {:>9}".format(
+          "command", "count", "errors", "req/s", "p50 ms", "p95 ms", "p99 ms", "max ms"))
+    for command, item in list(result["commands"].items()) + [("total", result["total"])]:
+        print("    {:<40} {:>8} {:>7} {:>9} {:>9} {:>9} {:>9} {:>9}".format(
+              command, item["count"], item["errors"], item["throughput"], item["p50_ms"], item["p95_ms"], item["p99_ms"],
+              item["max_ms"]))
+        if item["error_sample"]:
+            print("        error: {}".format(item["error_sample"]))
+
+
+def main():
+    args = parse_args()
+    weights = parse_mix(args.mix)
+    dataset.use_app(CLIENT_DIR, args.backend)
+    loop = asyncio.get_event_loop()
+
+    runs = []
+    if args.url:
+        runs.append((None, args.url))
+    else:
+        workdir = os.path.realpath(args.workdir or tempfile.mkdtemp(prefix="feature_sync_load_"))
+        os.makedirs(workdir, exist_ok=True)
+        remote_db = os.path.join(workdir, "remote.db") if args.backend == "sqlite" else args.remote_db
+        url = "http://127.0.0.1:{}/feature".format(args.server_port)
+        for workers in [int(workers) for workers in args.server_workers.split(",") if workers.strip()]:
+            runs.append((workers, url))
+
+    for workers, url in runs:
+        server = None
+        if workers is not None:
+            # 每一次都重新生成数据，各次的结果可以比较
+            rows = dataset.generate(dataset.parse_regions(args.regions), args.users, args.features_per_user,
+                                    args.feature_bytes, args.seed)
+            loop.run_until_complete(load_remote(args, remote_db, rows))
+            conf_path = os.path.join(workdir, "feature_sync_server.conf")
+            overrides = {("MAIN", "server_host"): "127.0.0.1", ("MAIN", "server_port"): args.server_port,
+                         ("MAIN", "workers_num"): workers, ("MYSQL", "use_ssl"): "0",
+                         ("LOG", "level"): args.log_level, ("LOG", "file_name"): "feature_sync_server.load.log"}
+            overrides.update(sync_bench.database_conf(args, remote_db))
+            sync_bench.write_conf(args.server_conf, conf_path, overrides, args.server_set)
+            server = sync_bench.start_server(args, conf_path, workdir)
+        try:
+            if server is not None:
+                loop.run_until_complete(sync_bench.wait_server(url, server))
+            result = loop.run_until_complete(run_load(args, url, weights))
+        finally:
+            if server is not None:
+                sync_bench.stop_server(server)
+
+        result.update(server_workers=workers, server_set=args.server_set, backend=args.backend if workers is not None else None,
+                      concurrency=args.concurrency, mix=weights, page_size=args.page_size, batch_size=args.batch_size,
+                      feature_bytes=args.feature_bytes, wire_format=args.wire_format, begin=round(time.time(), 3))
+        print_result(result)
+        line = json.dumps(result, sort_keys=True)
+        print(line)
+        if args.output:
+            with open(args.output, "a") as f:
+                f.write(line + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+启动 feature_sync_server，数据库可以换成 SQLite 替身:
+    python3 benchmark/run_server.py [--backend sqlite] -c conf
+backend 为 sqlite 时配置中 [MYSQL] db 为 SQLite 文件的路径，其他 MYSQL 配置不使用
+日志和 state 目录与直接运行 feature_sync_server.py 相同
+"""
+
+import os
+import sys
+import argparse
+
+from dataset import SERVER_DIR, use_app
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backend', dest='backend', default='mysql', choices=['mysql', 'sqlite'], help='database backend')
+    parser.add_argument('-c', '--config', dest='config_path', required=True, help='server conf file')
+    args = parser.parse_args()
+
+    use_app(SERVER_DIR, args.backend)
+    # get_log_dir / get_state_dir 按 sys.argv[0] 所在的目录
+    sys.argv = [os.path.join(SERVER_DIR, "feature_sync_server.py"), "-c", os.path.realpath(args.config_path)]
+    import feature_sync_server
+    feature_sync_server.main()
+
+
+if __name__ == "__main__":
+    main()
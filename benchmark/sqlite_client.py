@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import re
+import time
+import sqlite3
+import hashlib
+import functools
+import collections
+from typing import Dict, List, Tuple, Any
+
+
+# 分桶摘要中 CAST(CONV(SUBSTRING(MD5(...), 1, 16), 16, 10) AS UNSIGNED)，整体换成一个函数
+_CONV_UNSIGNED = re.compile(r"CAST\(CONV\((.*?), 16, 10\) AS UNSIGNED\)", re.S | re.I)
+_PARAMETER = re.compile(r"%\((\w+)\)s")
+_INSERT = re.compile(r"^\s*insert\s+(?!into\b)", re.I)
+_DIV = re.compile(r"\bDIV\b", re.I)
+_SUBSTRING = re.compile(r"\bSUBSTRING\(", re.I)
+_FROM_DUAL = re.compile(r"\s+from\s+dual\b", re.I)
+
+
+@functools.lru_cache(maxsize=256)
+def translate(statement):
+    """
+    把 feature_database / cloud_feature_proxy 中的 MySQL 语句改写成 SQLite 能执行的语句:
+        %(name)s -> :name，insert t (...) -> insert into t (...)，DIV -> /，SUBSTRING -> substr，去掉 from dual，
+        分桶摘要的 64 位无符号整数换成 conv_int64（SQLite 的整数是有符号的 64 位，摘要是同一个值的有符号表示）
+    information_schema 中表的最后修改时间 SQLite 没有，返回 NULL（客户端不会因此跳过一轮）
+    """
+    if "information_schema" in statement:
+        return "select NULL as change_time"
+    statement = _CONV_UNSIGNED.sub(r"conv_int64(\1)", statement)
+    statement = _SUBSTRING.sub("substr(", statement)
+    statement = _DIV.sub("/", statement)
+    statement = _FROM_DUAL.sub("", statement)
+    statement = _INSERT.sub("insert into ", statement)
+    return _PARAMETER.sub(r":\1", statement)
+
+
+def _bind(statement, parameter):
+    """
+    参数中的 tuple / list（如 id in %(ids)s）展开成 (:ids_0, :ids_1, ...)
+    """
+    statement = translate(statement)
+    if not parameter:
+        return statement, {}
+    parameter = dict(parameter)
+    for key, value in list(parameter.items()):
+        if isinstance(value, (tuple, list)):
+            names = ["{}_{}".format(key, i) for i in range(len(value))]
+            statement = statement.replace(":{}".format(key), "({})".format(", ".join(":" + name for name in names) or "NULL"))
+            parameter.update(zip(names, value))
+            del parameter[key]
+    return statement, parameter
+
+
+def _md5(value):
+    if value is None:
+        return None
+    if not isinstance(value, bytes):
+        value = str(value).encode()
+    return hashlib.md5(value).hexdigest()
+
+
+def _concat_ws(separator, *values):
+    return separator.join(value.decode("latin-1") if isinstance(value, bytes) else str(value)
+                          for value in values if value is not None)
+
+
+def _conv_int64(hex_text):
+    value = int(hex_text, 16)
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+class _BitXor(object):
+    def __init__(self):
+        self._value = 0
+
+    def step(self, value):
+        if value is not None:
+            self._value ^= value
+
+    def finalize(self):
+        return self._value
+
+
+class SqliteClient(object):
+    """
+    基准测试用的 MysqlClient 替身: 接口与 lib/mysql_client.py 相同，数据在 initialize(db=...) 指定的 SQLite 文件中
+    语句由 translate 改写；查询在事件循环中同步执行，只用来测量同步流程本身，不能反映数据库的并发能力
+    """
+    def __init__(self):
+        self._db = None
+        self._conn = None
+        self.acquire_count = 0
+        self.acquire_wait = 0.0
+
+    def initialize(self, db=None, **kwargs):
+        self._db = db
+
+    async def create_pool(self):
+        self._conn = sqlite3.connect(self._db, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute("pragma journal_mode=wal")
+        self._conn.execute("pragma synchronous=normal")
+        self._conn.create_function("md5", 1, _md5, deterministic=True)
+        self._conn.create_function("concat_ws", -1, _concat_ws, deterministic=True)
+        self._conn.create_function("conv_int64", 1, _conv_int64, deterministic=True)
+        self._conn.create_aggregate("bit_xor", 1, _BitXor)
+
+    async def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def stats(self):
+        return dict(pool_size=1 if self._conn is not None else 0,
+                    pool_free=1 if self._conn is not None else 0,
+                    pool_rebuild=0,
+                    connection_discard=0,
+                    retry=0,
+                    ping_failed=0,
+                    acquire_count=self.acquire_count,
+                    acquire_wait_seconds=round(self.acquire_wait, 6))
+
+    def _cursor(self, statement, parameter):
+        if self._conn is None:
+            raise sqlite3.ProgrammingError("database is not opened, call create_pool first")
+        begin = time.time()
+        statement, parameter = _bind(statement, parameter)
+        cursor = self._conn.execute(statement, parameter)
+        self.acquire_count += 1
+        self.acquire_wait += time.time() - begin
+        return cursor
+
+    @staticmethod
+    def _rows(cursor, rows) -> List[Dict[Any, Any]]:
+        names = [d[0] for d in cursor.description]
+        return [collections.OrderedDict(zip(names, row)) for row in rows]
+
+    async def query_one(self, statement, parameter=None):
+        cursor = self._cursor(statement, parameter)
+        row = cursor.fetchone()
+        return self._rows(cursor, [row])[0] if row is not None else None
+
+    async def query_many(self, statement, parameter=None, size=None):
+        cursor = self._cursor(statement, parameter)
+        return self._rows(cursor, cursor.fetchmany(size or cursor.arraysize))
+
+    async def query_all(self, statement, parameter=None):
+        cursor = self._cursor(statement, parameter)
+        return self._rows(cursor, cursor.fetchall())
+
+    async def iterate(self, statement, parameter=None, size=1000):
+        cursor = self._cursor(statement, parameter)
+        while True:
+            rows = cursor.fetchmany(size)
+            if not rows:
+                break
+            yield self._rows(cursor, rows)
+
+    async def execute(self, statement, parameter=None) -> Tuple[int, int]:
+        cursor = self._cursor(statement, parameter)
+        return cursor.rowcount, cursor.lastrowid
+
+    async def executemany(self, statement, parameter=None) -> Tuple[int, int]:
+        if not parameter:
+            return 0, 0
+        self._conn.execute("begin")
+        try:
+            row_count = 0
+            for values in parameter:
+                row_count += self._cursor(statement, values).rowcount
+            self._conn.execute("commit")
+        except Exception:
+            self._conn.execute("rollback")
+            raise
+        return row_count, 0
+
+    async def execute_batch(self, statement, parameters, fast_path=True):
+        """
+        与 MysqlClient.execute_batch 相同: 一个事务中逐行执行，返回每一行的 (row_count, errmsg)
+        """
+        result = []
+        self._conn.execute("begin")
+        try:
+            for parameter in parameters:
+                try:
+                    result.append((self._cursor(statement, parameter).rowcount, None))
+                except sqlite3.IntegrityError as err:
+                    result.append((0, "{}".format(err)))
+            self._conn.execute("commit")
+        except Exception:
+            self._conn.execute("rollback")
+            raise
+        return result
+
+    async def execute_transaction(self, operations, fail_fast=True):
+        """
+        与 MysqlClient.execute_transaction 相同，fail_fast 为 False 时失败的语句用 savepoint 只回滚它自己
+        """
+        result = []
+        if not operations:
+            return True, result
+
+        self._conn.execute("begin")
+        try:
+            for operation in operations:
+                statement, parameter = operation[:2]
+                allow_empty = len(operation) > 2 and operation[2]
+                self._conn.execute("savepoint operation")
+                try:
+                    row_count = self._cursor(statement, parameter).rowcount
+                    result.append((row_count, None if row_count > 0 or allow_empty else "no row affected"))
+                except sqlite3.IntegrityError as err:
+                    result.append((0, "{}".format(err)))
+                if result[-1][1] is not None:
+                    if fail_fast:
+                        self._conn.execute("rollback")
+                        result.extend((0, "not executed") for _ in operations[len(result):])
+                        return False, result
+                    self._conn.execute("rollback to operation")
+                self._conn.execute("release operation")
+            self._conn.execute("commit")
+        except Exception:
+            self._conn.execute("rollback")
+            raise
+        return True, result
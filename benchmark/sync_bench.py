@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+端到端的同步基准测试: 生成云端和远程两份数据（远程有缺少、多余和过期的行），在本地启动 feature_sync_server，
+对每个区域执行一轮 FeatureProcessor.start()，输出每个区域每秒处理的行数、请求数、传输的字节数和每个阶段的耗时，
+然后检查两边的数据是否一致，不一致时（推迟的 user 删除）再执行一轮，最多 --max-cycles 轮
+    python3 benchmark/sync_bench.py --backend sqlite --users 20000 --features-per-user 2 --missing 0.01 --extra 0.01 --stale 0.01
+用法见 benchmark/readme.md
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import traceback
+import subprocess
+import configparser
+from typing import Dict, List, Tuple, Any
+
+import dataset
+from dataset import BENCHMARK_DIR, CLIENT_DIR, SERVER_DIR
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="end-to-end feature sync benchmark")
+    parser.add_argument('--backend', default='sqlite', choices=['sqlite', 'mysql'],
+                        help='sqlite: SQLite stand-in for MysqlClient; mysql: local MySQL/MariaDB')
+    parser.add_argument('--workdir', default=None, help='directory for generated conf files, SQLite files and server output')
+    parser.add_argument('--regions', default='320000/321000/321084', help='province_code/city_code[/town_code], comma separated')
+    parser.add_argument('--users', type=int, default=10000, help='users in the cloud dataset')
+    parser.add_argument('--features-per-user', type=int, default=1)
+    parser.add_argument('--feature-bytes', type=int, default=2048)
+    parser.add_argument('--missing', type=float, default=0.01, help='fraction of cloud rows missing on the remote')
+    parser.add_argument('--extra', type=float, default=0.01, help='fraction of extra rows only on the remote')
+    parser.add_argument('--stale', type=float, default=0.01, help='fraction of remote rows with stale content')
+    parser.add_argument('--max-cycles', type=int, default=3,
+                        help='cycles to run until both sides converge; deferred user deletes finish in the second cycle')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-seed', action='store_true', help='reuse the data of the last run instead of seeding')
+    parser.add_argument('--mysql-host', default='127.0.0.1')
+    parser.add_argument('--mysql-port', type=int, default=3306)
+    parser.add_argument('--mysql-user', default='root')
+    parser.add_argument('--mysql-password', default='')
+    parser.add_argument('--cloud-db', default='feature_sync_bench_cloud', help='mysql database of the cloud dataset (must exist)')
+    parser.add_argument('--remote-db', default='feature_sync_bench_remote', help='mysql database of the remote dataset (must exist)')
+    parser.add_argument('--server-port', type=int, default=19000)
+    parser.add_argument('--server-workers', type=int, default=1)
+    parser.add_argument('--client-conf', default=os.path.join(CLIENT_DIR, 'conf', 'feature_sync_client.conf'))
+    parser.add_argument('--server-conf', default=os.path.join(SERVER_DIR, 'conf', 'feature_sync_server.conf'))
+    parser.add_argument('--client-set', action='append', default=[], metavar='SECTION.key=value',
+                        help='override a client conf value, e.g. PIPELINE.page_envelope=0')
+    parser.add_argument('--server-set', action='append', default=[], metavar='SECTION.key=value',
+                        help='override a server conf value, e.g. MYSQL.max_connections=20')
+    parser.add_argument('--log-level', default='INFO')
+    parser.add_argument('--output', default=None, help='append the result as one json line to this file')
+    return parser.parse_args()
+
+
+def write_conf(template, path, overrides: Dict[Tuple[str, str], str], settings: List[str]):
+    """
+    以 template 为基础生成配置文件，settings 中的 SECTION.key=value 最后生效
+    """
+    config = configparser.ConfigParser(interpolation=None)
+    config.read(template)
+    for setting in settings:
+        name, _, value = setting.partition("=")
+        section, _, key = name.partition(".")
+        if not section or not key:
+            raise ValueError("invalid setting <{}>, expect SECTION.key=value".format(setting))
+        overrides[(section, key)] = value
+    for (section, key), value in overrides.items():
+        if not config.has_section(section):
+            config.add_section(section)
+        config.set(section, key, str(value))
+    with open(path, "w") as f:
+        config.write(f)
+
+
+def database_conf(args, db) -> Dict[Tuple[str, str], str]:
+    if args.backend == "sqlite":
+        return {("MYSQL", "db"): db, ("MYSQL", "index_check"): "0"}
+    return {("MYSQL", "host"): args.mysql_host, ("MYSQL", "port"): args.mysql_port, ("MYSQL", "user"): args.mysql_user,
+            ("MYSQL", "password"): args.mysql_password, ("MYSQL", "db"): db}
+
+
+def open_database(args, db):
+    from lib import mysql_client
+    database_client = mysql_client.MysqlClient()
+    if args.backend == "sqlite":
+        database_client.initialize(db=db)
+    else:
+        database_client.initialize(host=args.mysql_host, port=args.mysql_port, user=args.mysql_user,
+                                   password=args.mysql_password, db=db)
+    return database_client
+
+
+async def seed(args, regions, cloud_db, remote_db) -> Dict[str, Any]:
+    begin = time.time()
+    cloud_rows = dataset.generate(regions, args.users, args.features_per_user, args.feature_bytes, args.seed)
+    remote_rows, drift_rows = dataset.drift(cloud_rows, args.missing, args.extra, args.stale, args.seed)
+    for db, rows in ((cloud_db, cloud_rows), (remote_db, remote_rows)):
+        database_client = open_database(args, db)
+        await database_client.create_pool()
+        try:
+            await dataset.create_tables(database_client, args.backend)
+            await dataset.load_rows(database_client, rows)
+        finally:
+            await database_client.close()
+    return dict(drift_rows=drift_rows, seed_seconds=round(time.time() - begin, 3))
+
+
+async def compare(args, regions, cloud_db, remote_db) -> Dict[str, Any]:
+    digests = []
+    for db in (cloud_db, remote_db):
+        database_client = open_database(args, db)
+        await database_client.create_pool()
+        try:
+            digests.append(await dataset.table_digests(database_client, regions))
+        finally:
+            await database_client.close()
+    cloud, remote = digests
+    mismatched = {}
+    for table in cloud:
+        ids = set(cloud[table]) | set(remote[table])
+        mismatched[table] = len([row_id for row_id in ids if cloud[table].get(row_id) != remote[table].get(row_id)])
+    return dict(converged=not any(mismatched.values()), mismatched=mismatched,
+                cloud_rows={table: len(rows) for table, rows in cloud.items()})
+
+
+def start_server(args, conf_path, workdir) -> subprocess.Popen:
+    output = open(os.path.join(workdir, "server.out"), "w")
+    return subprocess.Popen([sys.executable, os.path.join(BENCHMARK_DIR, "run_server.py"), "--backend", args.backend,
+                             "-c", conf_path], stdout=output, stderr=subprocess.STDOUT)
+
+
+async def wait_server(url, process: subprocess.Popen, timeout=60):
+    import aiohttp
+    deadline = time.time() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.time() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError("server exited with code {}".format(process.returncode))
+            try:
+                async with session.get(url, params=dict(command="get_database_stats")) as resp:
+                    if resp.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError("server not ready in {}s".format(timeout))
+
+
+def stop_server(process: subprocess.Popen):
+    process.terminate()
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+async def run_cycles(regions) -> List[Dict[str, Any]]:
+    """
+    每个区域执行一轮同步，返回每个区域的报告（core.cycle_report 的 json 加上 error）
+    """
+    from core.feature_processor import FeatureProcessor
+
+    results = []
+    for region_index, region in enumerate(regions):
+        processor = FeatureProcessor(*region, region_index=region_index)
+        error = None
+        try:
+            await processor.start()
+        except Exception:
+            error = traceback.format_exc()
+        finally:
+            await processor.close()
+        result = processor.report.to_dict()
+        result["error"] = error
+        results.append(result)
+    return results
+
+
+def summarize(region_reports: List[Dict[str, Any]], cloud_rows: Dict[str, int]) -> Dict[str, Any]:
+    wall = sum(report["wall"] for report in region_reports)
+    operations = {}
+    for report in region_reports:
+        for pass_report in report["passes"]:
+            for key, value in pass_report["operations"].items():
+                operations[key] = operations.get(key, 0) + value
+    rows = sum(cloud_rows.values())
+    changed = sum(operations.get(key, 0) for key in ("insert", "update", "delete"))
+    return dict(wall=round(wall, 3),
+                rows=rows,
+                rows_per_second=round(rows / wall, 1) if wall else None,
+                changed_rows=changed,
+                changed_rows_per_second=round(changed / wall, 1) if wall else None,
+                operations=operations,
+                http_requests=sum(report["http_requests"] for report in region_reports),
+                bytes_sent=sum(report["bytes_sent"] for report in region_reports),
+                bytes_received=sum(report["bytes_received"] for report in region_reports))
+
+
+def print_result(result):
+    total = result["total"]
+    print("backend: {}, users: {}, features per user: {}, drift: {}".format(
+          result["backend"], result["users"], result["features_per_user"], result.get("drift_rows")))
+    for report in result["regions"]:
+        print("region {}: {}s, requests: {}, sent: {} B, received: {} B{}".format(
+              report["region"], report["wall"], report["http_requests"], report["bytes_sent"], report["bytes_received"],
+              ", error" if report["error"] else ""))
+        for pass_report in report["passes"]:
+            print("    {:<28} wall {:>8}s  cpu {:>8}s  cloud {:>8}s  remote {:>8}s  pages {:>6}  rows {:>9}  requests {:>6}  ops {}".format(
+                  pass_report["name"], pass_report["wall"], pass_report["cpu"], pass_report["cloud_wait"],
+                  pass_report["remote_wait"], pass_report["pages"], pass_report["rows"], pass_report["http_requests"],
+                  pass_report["operations"]))
+    print("total: {}s, rows: {} ({}/s), changed rows: {} ({}/s), requests: {}, sent: {} B, received: {} B".format(
+          total["wall"], total["rows"], total["rows_per_second"], total["changed_rows"], total["changed_rows_per_second"],
+          total["http_requests"], total["bytes_sent"], total["bytes_received"]))
+    for cycle, total in enumerate(result["later_cycles"], 2):
+        print("cycle {}: {}s, changed rows: {}, requests: {}, ops {}".format(
+              cycle, total["wall"], total["changed_rows"], total["http_requests"], total["operations"]))
+    print("converged: {} after {} cycles, mismatched rows: {}".format(result["converged"], result["cycles"], result["mismatched"]))
+
+
+def main():
+    args = parse_args()
+    regions = dataset.parse_regions(args.regions)
+    workdir = os.path.realpath(args.workdir or tempfile.mkdtemp(prefix="feature_sync_bench_"))
+    os.makedirs(workdir, exist_ok=True)
+    if args.backend == "sqlite":
+        cloud_db, remote_db = os.path.join(workdir, "cloud.db"), os.path.join(workdir, "remote.db")
+    else:
+        cloud_db, remote_db = args.cloud_db, args.remote_db
+
+    # 客户端在本进程中运行，服务端在子进程中运行
+    dataset.use_app(CLIENT_DIR, args.backend)
+    from lib.logger import logger
+    from core.conf_parameter import g_conf_parameter
+
+    server_url = "http://127.0.0.1:{}/feature".format(args.server_port)
+    server_conf = os.path.join(workdir, "feature_sync_server.conf")
+    client_conf = os.path.join(workdir, "feature_sync_client.conf")
+    server_overrides = {("MAIN", "server_host"): "127.0.0.1", ("MAIN", "server_port"): args.server_port,
+                        ("MAIN", "workers_num"): args.server_workers, ("MYSQL", "use_ssl"): "0",
+                        ("LOG", "level"): args.log_level, ("LOG", "file_name"): "feature_sync_server.bench.log"}
+    server_overrides.update(database_conf(args, remote_db))
+    write_conf(args.server_conf, server_conf, server_overrides, args.server_set)
+    province_code, city_code, town_code = regions[0]
+    client_overrides = {("MAIN", "run_once"): "1", ("MAIN", "workers"): "1",
+                        ("MAIN", "regions"): ",".join("/".join(region) for region in regions),
+                        ("MAIN", "province_code"): province_code, ("MAIN", "city_code"): city_code, ("MAIN", "town_code"): town_code,
+                        ("LOG", "level"): args.log_level, ("LOG", "file_name"): "feature_sync_client.bench.log",
+                        ("REMOTE_FEATURE_SERVER", "url"): server_url,
+                        ("CHECKPOINT", "enable"): "0", ("CDC", "enable"): "0",
+                        ("REPORT", "enable"): "1", ("REPORT", "file_name"): ""}
+    client_overrides.update(database_conf(args, cloud_db))
+    write_conf(args.client_conf, client_conf, client_overrides, args.client_set)
+
+    g_conf_parameter.load_conf(client_conf)
+    logger.set_child_name('feature_sync_bench')
+    logger.set_file_path(os.path.join(workdir, "log"))
+    logger.set_file_name(g_conf_parameter.log_file_name)
+    logger.set_log_level(g_conf_parameter.log_level)
+    logger.set_back_count(g_conf_parameter.log_back_count)
+    logger.start()
+
+    loop = asyncio.get_event_loop()
+    result = dict(backend=args.backend, workdir=workdir, regions_arg=args.regions, users=args.users,
+                  features_per_user=args.features_per_user, feature_bytes=args.feature_bytes,
+                  drift=dict(missing=args.missing, extra=args.extra, stale=args.stale),
+                  client_set=args.client_set, server_set=args.server_set, begin=round(time.time(), 3))
+    if not args.no_seed:
+        result.update(loop.run_until_complete(seed(args, regions, cloud_db, remote_db)))
+
+    # 第一轮是测量的结果；只在远程的 user 还有 feature 时删除推迟到下一轮，继续执行直到两边一致
+    server = start_server(args, server_conf, workdir)
+    try:
+        loop.run_until_complete(wait_server(server_url, server))
+        cycles = []
+        for _ in range(max(1, args.max_cycles)):
+            cycles.append(loop.run_until_complete(run_cycles(regions)))
+            comparison = loop.run_until_complete(compare(args, regions, cloud_db, remote_db))
+            if comparison["converged"]:
+                break
+    finally:
+        stop_server(server)
+
+    result["regions"] = cycles[0]
+    result["cycles"] = len(cycles)
+    result["later_cycles"] = [summarize(reports, comparison["cloud_rows"]) for reports in cycles[1:]]
+    result.update(comparison)
+    result["total"] = summarize(result["regions"], result.pop("cloud_rows"))
+
+    print_result(result)
+    line = json.dumps(result, sort_keys=True)
+    print(line)
+    if args.output:
+        with open(args.output, "a") as f:
+            f.write(line + "\n")
+    sys.exit(0 if result["converged"] and not any(report["error"] for reports in cycles for report in reports) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import abc
+import asyncio
+from typing import Dict, List, Any
+
+from lib.logger import logger
+
+from core.conf_parameter import g_conf_parameter
+from core.cloud_feature_proxy import CloudFeatureProxy
+from core.checkpoint_store import CheckpointStore
+
+try:
+    from pymysqlreplication import BinLogStreamReader
+    from pymysqlreplication.event import XidEvent
+    from pymysqlreplication.row_event import WriteRowsEvent, UpdateRowsEvent, DeleteRowsEvent
+except ImportError:
+    BinLogStreamReader = None
+
+SYNC_TABLES = ("user", "feature_model_0330")
+
+
+class ChangeEvent(object):
+    def __init__(self, table, action, row_id, user_id=None, values=None):
+        self.table = table
+        self.action = action  # insert / update / delete
+        self.row_id = row_id
+        self.user_id = user_id
+        self.values = values  # insert / update 时为整行数据，与 CloudFeatureProxy.query_*_range 的返回相同
+
+    def __str__(self):
+        return "<ChangeEvent {} {} id:{}, user_id:{}>".format(self.table, self.action, self.row_id, self.user_id)
+
+
+class ChangeSource(abc.ABC):
+    """
+    云端的变更来源，按发生的顺序返回 ChangeEvent；read_events 之后调用 commit 保存读取的位置，或者调用 reset 重新读取
+    """
+    position_name = "cdc_position"
+
+    def __init__(self, cloud_feature_proxy: CloudFeatureProxy, checkpoint_store: CheckpointStore, region,
+                 province_code, city_code, town_code):
+        self._cloud_feature_proxy = cloud_feature_proxy
+        self._checkpoint_store = checkpoint_store
+        self._region = region
+        self._province_code = province_code
+        self._city_code = city_code
+        self._town_code = town_code
+        self._position = checkpoint_store.get_value(region, self.position_name)
+        self._pending_position = None
+
+    async def read_events(self, batch_size) -> List[ChangeEvent]:
+        """
+        第一次运行时没有保存的位置，从当前位置开始，之前的数据由全量对比补齐
+        """
+        if self._position is None:
+            self._pending_position = await self._get_head_position()
+            logger.info("[cdc] no saved position, start from {}".format(self._pending_position))
+            return []
+
+        events = await self._read_events(batch_size)
+        return events
+
+    def commit(self) -> bool:
+        """
+        保存 read_events 读到的位置，位置没有变化（已经读到末尾）时返回 False
+        """
+        if self._pending_position is None:
+            return False
+        self._position = self._pending_position
+        self._pending_position = None
+        self._checkpoint_store.set_value(self._region, self.position_name, self._position)
+        self._checkpoint_store.save()
+        return True
+
+    def reset(self):
+        """
+        放弃 read_events 读到的位置，下次从上次保存的位置重新读取
+        """
+        self._pending_position = None
+
+    def _match_region(self, values: Dict[Any, Any]):
+        return values.get("province_code") == self._province_code and values.get("city_code") == self._city_code \
+            and (self._town_code == '-1' or values.get("town_code") == self._town_code)
+
+    @abc.abstractmethod
+    async def _get_head_position(self):
+        """
+        云端当前的位置，第一次运行时从这里开始读取
+        """
+
+    @abc.abstractmethod
+    async def _read_events(self, batch_size) -> List[ChangeEvent]:
+        """
+        从 self._position 开始读取最多 batch_size 个变更，把读到的位置记在 self._pending_position
+        """
+
+
+class ChangeLogChangeSource(ChangeSource):
+    """
+    读取触发器写入的 sync_change_log 表（sql/sync_change_log.sql），insert / update 按 id 从云端取当前的整行
+    update 修改前在当前区域、修改后不在时按删除处理，与 BinlogChangeSource 相同
+    """
+    async def _get_head_position(self):
+        return dict(change_log_id=await self._cloud_feature_proxy.get_max_change_log_id())
+
+    async def _read_events(self, batch_size) -> List[ChangeEvent]:
+        logs = await self._cloud_feature_proxy.query_change_log(self._position["change_log_id"], batch_size)
+        if not logs:
+            return []
+        self._pending_position = dict(change_log_id=logs[-1]["id"])
+
+        changes = []
+        for log in logs:
+            if log["table_name"] not in SYNC_TABLES:
+                continue
+            if self._match_region(log):
+                changes.append((log, log["action"]))
+            elif log["action"] == "update" and self._match_region(self._old_region(log)):
+                # 更新后移出了当前区域，对远程来说是删除
+                changes.append((log, "delete"))
+
+        user_ids = {log["row_id"] for log, action in changes if log["table_name"] == "user" and action != "delete"}
+        feature_ids = {log["row_id"] for log, action in changes if log["table_name"] == "feature_model_0330" and action != "delete"}
+        rows = {
+            "user": {row["id"]: row for row in await self._cloud_feature_proxy.query_user_by_ids(
+                        self._province_code, self._city_code, self._town_code, sorted(user_ids))},
+            "feature_model_0330": {row["id"]: row for row in await self._cloud_feature_proxy.query_feature_model_0330_by_ids(
+                        self._province_code, self._city_code, self._town_code, sorted(feature_ids))},
+        }
+
+        events = []
+        for log, action in changes:
+            table, row_id = log["table_name"], log["row_id"]
+            if action == "delete":
+                events.append(ChangeEvent(table, action, row_id, user_id=log["user_id"]))
+                continue
+
+            # 行已经被删除或者移出了当前区域，后面会有对应的 delete，或者由全量对比处理
+            values = rows[table].get(row_id)
+            if values is None:
+                continue
+            events.append(ChangeEvent(table, action, row_id, user_id=log["user_id"], values=values))
+
+        return events
+
+    @staticmethod
+    def _old_region(log: Dict[Any, Any]) -> Dict[Any, Any]:
+        return dict(province_code=log.get("old_province_code"), city_code=log.get("old_city_code"),
+                    town_code=log.get("old_town_code"))
+
+
+class BinlogChangeSource(ChangeSource):
+    """
+    读取云端 MySQL 的 row 格式 binlog（需要安装 mysql-replication，账号需要 REPLICATION SLAVE / CLIENT 权限），
+    只在事务结束（XidEvent）时推进位置，从保存的位置继续时不会停在事务中间
+    """
+    def __init__(self, *args, server_id=None, **kwargs):
+        if BinLogStreamReader is None:
+            raise RuntimeError("cdc source binlog requires the mysql-replication package")
+        super().__init__(*args, **kwargs)
+        self._server_id = server_id or g_conf_parameter.cdc_server_id
+
+    async def _get_head_position(self):
+        return await self._cloud_feature_proxy.get_binlog_position()
+
+    async def _read_events(self, batch_size) -> List[ChangeEvent]:
+        loop = asyncio.get_event_loop()
+        rows, position = await loop.run_in_executor(None, self._read_binlog, self._position, batch_size, self._server_id)
+        if position != self._position:
+            self._pending_position = position
+
+        events = []
+        for table, action, values, before_values in rows:
+            if not self._match_region(values):
+                # 更新后移出了当前区域，对远程来说是删除
+                if action != "update" or not self._match_region(before_values):
+                    continue
+                action, values = "delete", before_values
+
+            user_id = values["id"] if table == "user" else values.get("user_id")
+            if action == "delete":
+                events.append(ChangeEvent(table, action, values["id"], user_id=user_id))
+            else:
+                events.append(ChangeEvent(table, action, values["id"], user_id=user_id, values=values))
+
+        return events
+
+    @staticmethod
+    def _read_binlog(position, batch_size, server_id):
+        """
+        在线程池中执行，非阻塞读取到当前末尾或者够 batch_size 行为止
+        返回 [(table, action, values, before_values), ...] 和最后一个完整事务之后的位置
+        """
+        stream = BinLogStreamReader(connection_settings=dict(host=g_conf_parameter.mysql_host,
+                                                             port=g_conf_parameter.mysql_port,
+                                                             user=g_conf_parameter.mysql_user,
+                                                             passwd=g_conf_parameter.mysql_password),
+                                    server_id=server_id,
+                                    blocking=False,
+                                    resume_stream=True,
+                                    log_file=position["log_file"],
+                                    log_pos=position["log_pos"],
+                                    only_schemas=[g_conf_parameter.mysql_db],
+                                    only_tables=list(SYNC_TABLES),
+                                    only_events=[WriteRowsEvent, UpdateRowsEvent, DeleteRowsEvent, XidEvent])
+
+        rows, transaction_rows = [], []
+        try:
+            for binlog_event in stream:
+                if isinstance(binlog_event, XidEvent):
+                    rows.extend(transaction_rows)
+                    transaction_rows = []
+                    position = dict(log_file=stream.log_file, log_pos=stream.log_pos)
+                    if len(rows) >= batch_size:
+                        break
+                    continue
+
+                for row in binlog_event.rows:
+                    if isinstance(binlog_event, WriteRowsEvent):
+                        transaction_rows.append((binlog_event.table, "insert", row["values"], None))
+                    elif isinstance(binlog_event, DeleteRowsEvent):
+                        transaction_rows.append((binlog_event.table, "delete", row["values"], None))
+                    else:
+                        transaction_rows.append((binlog_event.table, "update", row["after_values"], row["before_values"]))
+        finally:
+            stream.close()
+
+        return rows, position
+
+
+def create_change_source(source, *args, **kwargs) -> ChangeSource:
+    sources = {
+        "binlog": BinlogChangeSource,
+        "change_log": ChangeLogChangeSource,
+    }
+    if source not in sources:
+        raise ValueError("no support cdc source <{}>".format(source))
+    return sources[source](*args, **kwargs)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import traceback
+from typing import Dict, List, Tuple, Any
+
+from lib.logger import logger
+
+
+class CheckpointStore(object):
+    """
+    同步进度的本地存储，json 文件，按区域保存每张表每个对比阶段的水位和上次看到的同步状态:
+    {
+        "320000/321000/321084": {
+            "watermarks": {"user": {"insert_miss": 12000, "del": -1, "update": -1}},
+            "status": {"cloud": {"user_id": 1, "feature_model_0330_id": 1}, "remote": {...}},
+            "values": {"cdc_position": {"log_file": "mysql-bin.000001", "log_pos": 4}}
+        }
+    }
+    保存时先写临时文件再 os.replace，进程中途退出也不会留下写了一半的文件；path 为 None 时只保存在内存中
+    """
+    def __init__(self, path=None):
+        self._path = path
+        self._content = {}
+        self._load()
+
+    def _load(self):
+        if self._path is None or not os.path.isfile(self._path):
+            return
+        try:
+            with open(self._path, "r") as f:
+                self._content = json.load(f)
+        except Exception:
+            logger.error("fail to load checkpoint {}, start from scratch: {}".format(self._path, traceback.format_exc()))
+            self._content = {}
+
+    def save(self):
+        if self._path is None:
+            return
+
+        tmp_path = "{}.tmp".format(self._path)
+        with open(tmp_path, "w") as f:
+            json.dump(self._content, f, indent=2, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._path)
+
+    def _region(self, region):
+        return self._content.setdefault(region, {"watermarks": {}, "status": {}})
+
+    def get_watermark(self, region, table, pass_name):
+        return self._region(region)["watermarks"].get(table, {}).get(pass_name, -1)
+
+    def set_watermark(self, region, table, pass_name, watermark):
+        self._region(region)["watermarks"].setdefault(table, {})[pass_name] = watermark
+
+    def get_value(self, region, name):
+        return self._region(region).get("values", {}).get(name)
+
+    def set_value(self, region, name, value):
+        self._region(region).setdefault("values", {})[name] = value
+
+    def has_pending_pass(self, region) -> bool:
+        """
+        有对比阶段在上一轮没有遍历完（水位不是 -1）
+        """
+        return any(watermark != -1 for passes in self._region(region)["watermarks"].values() for watermark in passes.values())
+
+    def get_status(self, region, side) -> Dict[Any, Any]:
+        return self._region(region)["status"].get(side)
+
+    def set_status(self, region, side, status: Dict[Any, Any]):
+        self._region(region)["status"][side] = dict(status, time=int(time.time()))
+
+
+class PassProgress(object):
+    """
+    一个对比阶段的进度: 从上次的水位继续，每处理 save_pages 页等写请求全部确认后保存一次水位，
+    max_pages 不为 0 时本轮最多处理 max_pages 页，剩下的留到下一轮；区间全部处理完后水位回到 -1
+    flush 返回失败的写操作，有失败时本轮不再保存水位，下一轮从最后一次全部确认的水位重新对比
+    """
+    def __init__(self, store: CheckpointStore, region, table, pass_name, ranges: List[Tuple[int, int]],
+                 flush, save_pages=10, max_pages=0):
+        self._store = store
+        self._region = region
+        self._table = table
+        self._pass_name = pass_name
+        self._flush = flush
+        self._save_pages = max(1, save_pages)
+        self._max_pages = max_pages
+        self._page_count = 0
+        self._stopped = False
+        self._failed = False
+
+        self._watermark = store.get_watermark(region, table, pass_name)
+        self.ranges = self._clip(ranges, self._watermark)
+        if not self.ranges:
+            # 上一轮已经遍历到末尾，开始新的一轮
+            self._watermark = -1
+            self.ranges = ranges
+        logger.info("[checkpoint] {} {} resume from {}, ranges: {}".format(table, pass_name, self._watermark, self.ranges))
+
+    @staticmethod
+    def _clip(ranges, watermark):
+        return [(max(begin_id, watermark), end_id) for begin_id, end_id in ranges if end_id > watermark]
+
+    async def advance(self, page) -> bool:
+        """
+        一页处理完（写请求已提交）后调用，返回 True 表示本轮的页数用完，应该停止
+        """
+        self._page_count += 1
+        self._watermark = page.end_id
+        if self._page_count % self._save_pages == 0:
+            await self._save()
+        if self._max_pages and self._page_count >= self._max_pages:
+            self._stopped = True
+        return self._stopped
+
+    async def finish(self):
+        if not self._stopped:
+            self._watermark = -1
+        await self._save()
+        logger.info("[checkpoint] {} {} finish, pages: {}, watermark: {}, failed: {}".format(
+                    self._table, self._pass_name, self._page_count, self._watermark, self._failed))
+
+    async def _save(self):
+        if await self._flush():
+            self._failed = True
+        if self._failed:
+            logger.error("[checkpoint] {} {} has failed writes, keep the saved watermark {}".format(
+                         self._table, self._pass_name, self._store.get_watermark(self._region, self._table, self._pass_name)))
+            return
+        self._store.set_watermark(self._region, self._table, self._pass_name, self._watermark)
+        self._store.save()
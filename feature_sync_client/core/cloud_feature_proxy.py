@@ -1,41 +1,87 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import base64
+import time
+import asyncio
 
 from lib.utils import single_ton
 from lib.mysql_client import MysqlClient
+from lib.region_sql import region_statement, check_region_index
 from lib.logger import logger
 
 from core.conf_parameter import g_conf_parameter
 
 
 class CloudFeatureProxy(object):
-    stmt_get_max_user_id = "select MAX(`id`) as id from user where province_code=%(province_code)s and city_code=%(city_code)s \
+    stmt_get_user_summary = "select MAX(`id`) as id, count(*) as count from user \
+                            where province_code=%(province_code)s and city_code=%(city_code)s \
                             and (%(town_code)s='-1' or town_code=%(town_code)s)"
     stmt_query_user_id_range = "select id from user \
                             where province_code=%(province_code)s and city_code=%(city_code)s \
                             and (%(town_code)s='-1' or town_code=%(town_code)s) \
-                            and id>%(begin_id)s and id<=%(end_id)s LIMIT 1000"
+                            and id>%(begin_id)s and id<=%(end_id)s order by id LIMIT %(limit)s"
     stmt_query_user_range = "select * from user \
                             where province_code=%(province_code)s and city_code=%(city_code)s \
                             and (%(town_code)s='-1' or town_code=%(town_code)s) \
-                            and id>%(begin_id)s and id<=%(end_id)s LIMIT 1000"
+                            and id>%(begin_id)s and id<=%(end_id)s order by id LIMIT %(limit)s"
 
-    stmt_get_max_feature_model_0330_id = "select MAX(`id`) as id from feature_model_0330 \
+    stmt_get_feature_model_0330_summary = "select MAX(`id`) as id, count(*) as count from feature_model_0330 \
                                             where province_code=%(province_code)s and city_code=%(city_code)s \
                                             and (%(town_code)s='-1' or town_code=%(town_code)s)"
+    # 两张表最后修改的时间（MySQL 5.7 及以上，重启后在第一次修改之前为 NULL），与服务端相同；
+    # MySQL 8 按 information_schema_stats_expiry 缓存，不能及时反映修改，见配置 skip_unchanged
+    stmt_get_change_time = "select UNIX_TIMESTAMP(MAX(update_time)) as change_time from information_schema.tables \
+                            where table_schema=DATABASE() and table_name in ('user', 'feature_model_0330')"
     stmt_query_feature_model_0330_id_range = "select id from feature_model_0330 \
                                             where province_code=%(province_code)s and city_code=%(city_code)s \
                                             and (%(town_code)s='-1' or town_code=%(town_code)s) \
-                                            and id>%(begin_id)s and id<=%(end_id)s LIMIT 1000"
+                                            and id>%(begin_id)s and id<=%(end_id)s order by id LIMIT %(limit)s"
+    # 每一行内容的摘要，与服务端的计算方式相同
+    stmt_query_user_digest_range = "select id, MD5(CONCAT_WS('#', id, uid, MD5(pic_md5), province_code, city_code, town_code)) as digest \
+                            from user \
+                            where province_code=%(province_code)s and city_code=%(city_code)s \
+                            and (%(town_code)s='-1' or town_code=%(town_code)s) \
+                            and id>%(begin_id)s and id<=%(end_id)s order by id LIMIT %(limit)s"
+    stmt_query_feature_model_0330_time_range = "select id, timestamp from feature_model_0330 \
+                                            where province_code=%(province_code)s and city_code=%(city_code)s \
+                                            and (%(town_code)s='-1' or town_code=%(town_code)s) \
+                                            and id>%(begin_id)s and id<=%(end_id)s order by id LIMIT %(limit)s"
     stmt_query_feature_model_0330_range = "select * from feature_model_0330 \
                                             where province_code=%(province_code)s and city_code=%(city_code)s \
                                             and (%(town_code)s='-1' or town_code=%(town_code)s) \
-                                            and id>%(begin_id)s and id<=%(end_id)s LIMIT 1000"
-    
+                                            and id>%(begin_id)s and id<=%(end_id)s order by id LIMIT %(limit)s"
+    stmt_query_user_by_ids = "select * from user \
+                            where province_code=%(province_code)s and city_code=%(city_code)s \
+                            and (%(town_code)s='-1' or town_code=%(town_code)s) \
+                            and id in %(ids)s"
+    stmt_query_feature_model_0330_by_ids = "select * from feature_model_0330 \
+                                            where province_code=%(province_code)s and city_code=%(city_code)s \
+                                            and (%(town_code)s='-1' or town_code=%(town_code)s) \
+                                            and id in %(ids)s"
+
+    stmt_show_master_status = "show master status"
+    stmt_get_max_change_log_id = "select MAX(`id`) as id from sync_change_log"
+    stmt_query_change_log = "select * from sync_change_log where id>%(begin_id)s order by id LIMIT %(limit)s"
+
+    # 按 id 分桶的摘要: 行数 + 每一行内容 md5 的前 64 位按位异或，与服务端的计算方式相同
+    stmt_get_user_range_digest = "select (id - %(begin_id)s - 1) DIV %(bucket_size)s as bucket, count(*) as count, \
+                            BIT_XOR(CAST(CONV(SUBSTRING(MD5(CONCAT_WS('#', id, uid, MD5(pic_md5), \
+                                province_code, city_code, town_code)), 1, 16), 16, 10) AS UNSIGNED)) as digest \
+                            from user \
+                            where province_code=%(province_code)s and city_code=%(city_code)s \
+                            and (%(town_code)s='-1' or town_code=%(town_code)s) \
+                            and id>%(begin_id)s and id<=%(end_id)s group by bucket"
+    stmt_get_feature_model_0330_range_digest = "select (id - %(begin_id)s - 1) DIV %(bucket_size)s as bucket, count(*) as count, \
+                            BIT_XOR(CAST(CONV(SUBSTRING(MD5(CONCAT_WS('#', id, user_id, timestamp, feature_id, MD5(feature), \
+                                province_code, city_code, town_code)), 1, 16), 16, 10) AS UNSIGNED)) as digest \
+                            from feature_model_0330 \
+                            where province_code=%(province_code)s and city_code=%(city_code)s \
+                            and (%(town_code)s='-1' or town_code=%(town_code)s) \
+                            and id>%(begin_id)s and id<=%(end_id)s group by bucket"
+
     def __init__(self):
         self._database_client = None
+        self._status_cache = {}  # (province_code, city_code, town_code) -> (过期时间, 同步状态)
 
     async def _initial_database_client(self):
         """
@@ -47,76 +93,175 @@ class CloudFeatureProxy(object):
                                     port=g_conf_parameter.mysql_port,
                                     user=g_conf_parameter.mysql_user,
                                     password=g_conf_parameter.mysql_password,
-                                    db=g_conf_parameter.mysql_db)
+                                    db=g_conf_parameter.mysql_db,
+                                    max_retries=g_conf_parameter.mysql_max_retries,
+                                    ping_idle=g_conf_parameter.mysql_ping_idle,
+                                    pool_recycle=g_conf_parameter.mysql_pool_recycle)
         await self._database_client.create_pool()
 
     async def _get_database_client(self):
         if self._database_client is None:
             await self._initial_database_client()
 
+    async def close(self):
+        if self._database_client is not None:
+            await self._database_client.close()
+            self._database_client = None
+
+    def database_stats(self):
+        return self._database_client.stats() if self._database_client is not None else None
+
     async def get_sync_status(self, province_code, city_code, town_code):
         """
-        获取同步状态
+        获取同步状态: 区域内两张表的最大 id、行数和最后修改的时间，与服务端返回的格式相同，缓存 status_cache_ttl 秒
         :return:
         """
+        region = (province_code, city_code, town_code)
+        entry = self._status_cache.get(region)
+        if entry is not None and entry[0] >= time.time():
+            return entry[1]
+
         await self._get_database_client()
-            
-        max_feature_model_0330_id = await self._database_client.query_one(self.stmt_get_max_feature_model_0330_id,
-                                                                            parameter=dict(
-                                                                                    province_code=province_code,
-                                                                                    city_code=city_code,
-                                                                                    town_code=town_code))
-        max_feature_model_0330_id = max_feature_model_0330_id["id"]
-        if max_feature_model_0330_id is None:
-            max_feature_model_0330_id = -1
-
-        max_user_id = await self._database_client.query_one(self.stmt_get_max_user_id,
-                                                            parameter=dict(
+
+        parameter = dict(province_code=province_code, city_code=city_code, town_code=town_code)
+        user, feature_model_0330, change_time = await asyncio.gather(
+            self._database_client.query_one(region_statement(self.stmt_get_user_summary, town_code), parameter=parameter),
+            self._database_client.query_one(region_statement(self.stmt_get_feature_model_0330_summary, town_code), parameter=parameter),
+            self._database_client.query_one(self.stmt_get_change_time))
+
+        status = {
+            'user_id': user["id"] if user["id"] is not None else -1,
+            'user_count': user["count"],
+            'feature_model_0330_id': feature_model_0330["id"] if feature_model_0330["id"] is not None else -1,
+            'feature_model_0330_count': feature_model_0330["count"],
+            'change_time': int(change_time["change_time"]) if change_time and change_time["change_time"] is not None else None
+        }
+        if g_conf_parameter.mysql_status_cache_ttl > 0:
+            self._status_cache[region] = (time.time() + g_conf_parameter.mysql_status_cache_ttl, status)
+        return status
+
+    async def query_user_id_range(self, province_code, city_code, town_code, begin_id, end_id, limit=1000):
+        return await self._query_info_by_id_range(self.stmt_query_user_id_range, province_code, city_code, town_code, begin_id, end_id, limit)
+
+    async def query_user_range(self, province_code, city_code, town_code, begin_id, end_id, limit=1000):
+        # 返回值 ((7026, '42489ff329f4456a8f241df79de797f1', b'python2的pickle编码的二进制', '510000', '511102', '511100'),)
+        # bytes 字段保持原样，传输时由 RemoteFeatureProxy 按协商的数据格式编码
+        return await self._query_info_by_id_range(self.stmt_query_user_range, province_code, city_code, town_code, begin_id, end_id, limit)
+
+    async def query_user_digest_range(self, province_code, city_code, town_code, begin_id, end_id, limit=1000):
+        """
+        只取 id 和每一行内容的摘要，用来判断哪些行需要更新，不读取 pic_md5
+        """
+        return await self._query_info_by_id_range(self.stmt_query_user_digest_range, province_code, city_code, town_code, begin_id, end_id, limit)
+
+    async def query_user_by_ids(self, province_code, city_code, town_code, ids):
+        return await self._query_info_by_ids(self.stmt_query_user_by_ids, province_code, city_code, town_code, ids)
+
+    async def query_feature_model_0330_id_range(self, province_code, city_code, town_code, begin_id, end_id, limit=1000):
+        return await self._query_info_by_id_range(self.stmt_query_feature_model_0330_id_range, province_code, city_code, town_code, begin_id, end_id, limit)
+
+    async def query_feature_model_0330_time_range(self, province_code, city_code, town_code, begin_id, end_id, limit=1000):
+        """
+        只取 id 和 timestamp，用来判断哪些行需要更新，不读取 feature
+        """
+        return await self._query_info_by_id_range(self.stmt_query_feature_model_0330_time_range, province_code, city_code, town_code, begin_id, end_id, limit)
+
+    async def query_feature_model_0330_range(self, province_code, city_code, town_code, begin_id, end_id, limit=1000):
+        return await self._query_info_by_id_range(self.stmt_query_feature_model_0330_range, province_code, city_code, town_code, begin_id, end_id, limit)
+
+    async def query_feature_model_0330_by_ids(self, province_code, city_code, town_code, ids):
+        return await self._query_info_by_ids(self.stmt_query_feature_model_0330_by_ids, province_code, city_code, town_code, ids)
+
+    async def get_binlog_position(self):
+        """
+        当前 binlog 的位置 {"log_file": "mysql-bin.000001", "log_pos": 4}
+        """
+        await self._get_database_client()
+
+        content = await self._database_client.query_one(self.stmt_show_master_status)
+        return dict(log_file=content["File"], log_pos=content["Position"])
+
+    async def get_max_change_log_id(self):
+        await self._get_database_client()
+
+        content = await self._database_client.query_one(self.stmt_get_max_change_log_id)
+        return content["id"] if content["id"] is not None else -1
+
+    async def query_change_log(self, begin_id, limit):
+        """
+        读取变更日志表中 id > begin_id 的记录，按 id 排序
+        """
+        await self._get_database_client()
+
+        return await self._database_client.query_all(statement=self.stmt_query_change_log,
+                                                     parameter=dict(begin_id=begin_id, limit=limit))
+
+    async def get_range_digest(self, table, province_code, city_code, town_code, begin_id, end_id, bucket_count):
+        """
+        把 (begin_id, end_id] 平均分成 bucket_count 个桶，返回每个非空桶的摘要
+        [{"begin_id": 1, "end_id": 2, "count": 1, "digest": 123}, ...]
+        """
+        await self._get_database_client()
+
+        statement = {
+            "user": self.stmt_get_user_range_digest,
+            "feature_model_0330": self.stmt_get_feature_model_0330_range_digest,
+        }[table]
+        bucket_size = max(1, -(-(end_id - begin_id) // bucket_count))
+        content = await self._database_client.query_all(statement=region_statement(statement, town_code),
+                                                        parameter=dict(
                                                                     province_code=province_code,
                                                                     city_code=city_code,
-                                                                    town_code=town_code))
-        max_user_id = max_user_id["id"]
-        if max_user_id is None:
-            max_user_id = -1
-
-        return {
-            'user_id': max_user_id,
-            'feature_model_0330_id': max_feature_model_0330_id
-        }
+                                                                    town_code=town_code,
+                                                                    begin_id=begin_id,
+                                                                    end_id=end_id,
+                                                                    bucket_size=bucket_size))
+
+        return [dict(begin_id=begin_id + c["bucket"] * bucket_size,
+                     end_id=min(end_id, begin_id + (c["bucket"] + 1) * bucket_size),
+                     count=c["count"],
+                     digest=int(c["digest"])) for c in content]
 
-    async def query_user_id_range(self, province_code, city_code, town_code, begin_id, end_id):
-        return await self._query_info_by_id_range(self.stmt_query_user_id_range, province_code, city_code, town_code, begin_id, end_id)
+    async def check_region_indexes(self, province_code, city_code, town_code):
+        """
+        EXPLAIN 区域按 id 的范围查询，没有用到 sql/region_index.sql 中的索引时打印警告
+        """
+        await self._get_database_client()
 
-    async def query_user_range(self, province_code, city_code, town_code, begin_id, end_id):
-        content = await self._query_info_by_id_range(self.stmt_query_user_range, province_code, city_code, town_code, begin_id, end_id)
+        statements = {
+            "query_user_digest_range": self.stmt_query_user_digest_range,
+            "query_feature_model_0330_time_range": self.stmt_query_feature_model_0330_time_range,
+        }
+        for name, statement in statements.items():
+            await check_region_index(self._database_client, name, statement,
+                                     dict(province_code=province_code, city_code=city_code, town_code=town_code,
+                                          begin_id=-1, end_id=2 ** 31, limit=1000))
 
-        # content 值 ((7026, '42489ff329f4456a8f241df79de797f1', b'python2的pickle编码的二进制', '510000', '511102', '511100'),)
-        for c in content:
-            if isinstance(c["pic_md5"], bytes):
-                c["pic_md5"] = base64.b64encode(c["pic_md5"]).decode()
-            
-        return content
+    async def _query_info_by_ids(self, statement, province_code, city_code, town_code, ids):
+        if not ids:
+            return []
 
-    async def query_feature_model_0330_id_range(self, province_code, city_code, town_code, begin_id, end_id):
-        return await self._query_info_by_id_range(self.stmt_query_feature_model_0330_id_range, province_code, city_code, town_code, begin_id, end_id)
+        await self._get_database_client()
 
-    async def query_feature_model_0330_range(self, province_code, city_code, town_code, begin_id, end_id):
-        content = await self._query_info_by_id_range(self.stmt_query_feature_model_0330_range, province_code, city_code, town_code, begin_id, end_id)
-        for c in content:
-            if isinstance(c["feature"], bytes):
-                c["feature"] = c["feature"].decode()
+        content = await self._database_client.query_all(statement=region_statement(statement, town_code),
+                                                        parameter=dict(
+                                                                    province_code=province_code,
+                                                                    city_code=city_code,
+                                                                    town_code=town_code,
+                                                                    ids=tuple(ids)))
 
         return content
 
-    async def _query_info_by_id_range(self, statement, province_code, city_code, town_code, begin_id, end_id):
+    async def _query_info_by_id_range(self, statement, province_code, city_code, town_code, begin_id, end_id, limit=1000):
         await self._get_database_client()
 
-        content = await self._database_client.query_all(statement=statement,
+        content = await self._database_client.query_all(statement=region_statement(statement, town_code),
                                                         parameter=dict(
                                                                     province_code=province_code,
                                                                     city_code=city_code,
                                                                     town_code=town_code,
                                                                     begin_id=begin_id,
-                                                                    end_id=end_id))
+                                                                    end_id=end_id,
+                                                                    limit=limit))
 
         return content
@@ -20,14 +20,79 @@ class ConfParameter(object):
         self.sync_city_code = self.config_parser.get_config("MAIN", "city_code")
         _sync_town_code = self.config_parser.get_config("MAIN", "town_code")
         self.sync_town_code = _sync_town_code if _sync_town_code else '-1'
+        # 多个区域: "province_code/city_code/town_code" 以逗号分隔，town_code 可以省略；没有配置时只同步上面的一个区域
+        _sync_regions = self.config_parser.get_config("MAIN", "regions", "")
+        self.sync_regions = [self._parse_region(region) for region in _sync_regions.split(",") if region.strip()]
+        if not self.sync_regions:
+            self.sync_regions = [(self.sync_province_code, self.sync_city_code, self.sync_town_code)]
+        self.sync_workers = int(self.config_parser.get_config("MAIN", "workers", "1"))
+        self.sync_skip_unchanged = int(self.config_parser.get_config("MAIN", "skip_unchanged", "0"))
+        self.sync_skip_max_interval = int(self.config_parser.get_config("MAIN", "skip_max_interval", "600"))
 
         self.mysql_host = self.config_parser.get_config("MYSQL", "host")
         self.mysql_port = int(self.config_parser.get_config("MYSQL", "port"))
         self.mysql_user = self.config_parser.get_config("MYSQL", "user")
         self.mysql_password = self.config_parser.get_config("MYSQL", "password")
         self.mysql_db = self.config_parser.get_config("MYSQL", "db")
+        self.mysql_index_check = int(self.config_parser.get_config("MYSQL", "index_check", "1"))
+        self.mysql_max_retries = int(self.config_parser.get_config("MYSQL", "max_retries", "3"))
+        self.mysql_ping_idle = int(self.config_parser.get_config("MYSQL", "ping_idle", "30"))
+        self.mysql_pool_recycle = int(self.config_parser.get_config("MYSQL", "pool_recycle", "3600"))
+        self.mysql_status_cache_ttl = int(self.config_parser.get_config("MYSQL", "status_cache_ttl_ms", "1000")) / 1000.0
 
         self.remote_feature_url = self.config_parser.get_config("REMOTE_FEATURE_SERVER", "url")
+        self.remote_pool_limit = int(self.config_parser.get_config("REMOTE_FEATURE_SERVER", "pool_limit", "100"))
+        self.remote_pool_limit_per_host = int(self.config_parser.get_config("REMOTE_FEATURE_SERVER", "pool_limit_per_host", "20"))
+        self.remote_keepalive_timeout = int(self.config_parser.get_config("REMOTE_FEATURE_SERVER", "keepalive_timeout", "60"))
+        self.remote_dns_cache_ttl = int(self.config_parser.get_config("REMOTE_FEATURE_SERVER", "dns_cache_ttl", "300"))
+        self.remote_request_timeout = int(self.config_parser.get_config("REMOTE_FEATURE_SERVER", "request_timeout", "300"))
+        self.remote_wire_format = self.config_parser.get_config("REMOTE_FEATURE_SERVER", "wire_format", "msgpack")
+        self.remote_stream_range = int(self.config_parser.get_config("REMOTE_FEATURE_SERVER", "stream_range", "1"))
+
+        _compression_encodings = self.config_parser.get_config("COMPRESSION", "encodings", "zstd,gzip")
+        self.compression_encodings = [encoding.strip() for encoding in _compression_encodings.split(",") if encoding.strip()]
+        self.compression_level = int(self.config_parser.get_config("COMPRESSION", "level", "6"))
+        self.compression_min_size = int(self.config_parser.get_config("COMPRESSION", "min_size", "1024"))
+
+        self.pipeline_min_concurrency = int(self.config_parser.get_config("PIPELINE", "min_concurrency", "1"))
+        self.pipeline_max_concurrency = int(self.config_parser.get_config("PIPELINE", "max_concurrency", "32"))
+        self.pipeline_initial_concurrency = int(self.config_parser.get_config("PIPELINE", "initial_concurrency", "4"))
+        self.pipeline_latency_target = int(self.config_parser.get_config("PIPELINE", "latency_target_ms", "2000")) / 1000.0
+        self.pipeline_prefetch_pages = int(self.config_parser.get_config("PIPELINE", "prefetch_pages", "2"))
+        self.pipeline_page_size = int(self.config_parser.get_config("PIPELINE", "page_size", "1000"))
+        self.pipeline_min_page_size = int(self.config_parser.get_config("PIPELINE", "min_page_size", "100"))
+        self.pipeline_max_page_size = int(self.config_parser.get_config("PIPELINE", "max_page_size", "20000"))
+        self.pipeline_page_target_bytes = int(self.config_parser.get_config("PIPELINE", "page_target_kb", "4096")) * 1024
+        self.pipeline_page_target_latency = int(self.config_parser.get_config("PIPELINE", "page_target_latency_ms", "1000")) / 1000.0
+        self.pipeline_page_envelope = int(self.config_parser.get_config("PIPELINE", "page_envelope", "1"))
+        self.pipeline_envelope_fail_fast = int(self.config_parser.get_config("PIPELINE", "envelope_fail_fast", "0"))
+
+        self.digest_enable = int(self.config_parser.get_config("DIGEST", "enable", "1"))
+        self.digest_bucket_count = int(self.config_parser.get_config("DIGEST", "bucket_count", "16"))
+        self.digest_leaf_rows = int(self.config_parser.get_config("DIGEST", "leaf_rows", "1000"))
+
+        self.checkpoint_enable = int(self.config_parser.get_config("CHECKPOINT", "enable", "1"))
+        self.checkpoint_file_name = self.config_parser.get_config("CHECKPOINT", "file_name", "feature_sync_client.checkpoint")
+        self.checkpoint_save_pages = int(self.config_parser.get_config("CHECKPOINT", "save_pages", "10"))
+        self.checkpoint_max_pages_per_cycle = int(self.config_parser.get_config("CHECKPOINT", "max_pages_per_cycle", "0"))
+
+        self.cdc_enable = int(self.config_parser.get_config("CDC", "enable", "0"))
+        self.cdc_source = self.config_parser.get_config("CDC", "source", "change_log")
+        self.cdc_server_id = int(self.config_parser.get_config("CDC", "server_id", "1001"))
+        self.cdc_batch_size = int(self.config_parser.get_config("CDC", "batch_size", "1000"))
+        self.cdc_full_scan_interval = int(self.config_parser.get_config("CDC", "full_scan_interval", "3600"))
+        self.cdc_max_retries = int(self.config_parser.get_config("CDC", "max_retries", "3"))
+
+        self.report_enable = int(self.config_parser.get_config("REPORT", "enable", "1"))
+        self.report_file_name = self.config_parser.get_config("REPORT", "file_name", "feature_sync_client.report.jsonl")
+
+    @staticmethod
+    def _parse_region(region):
+        codes = [code.strip() for code in region.strip().split("/")]
+        if len(codes) < 2 or len(codes) > 3:
+            raise ValueError("invalid region <{}>, expect province_code/city_code/town_code".format(region))
+        town_code = codes[2] if len(codes) == 3 and codes[2] else '-1'
+        return codes[0], codes[1], town_code
 
 
 g_conf_parameter = ConfParameter()
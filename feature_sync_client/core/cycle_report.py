@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import inspect
+import functools
+import collections
+from typing import Dict, Any
+
+from lib.logger import logger
+
+
+class PassReport(object):
+    """
+    一个阶段（如 user 的分桶摘要对比、user 的归并对比）的统计:
+        wall: 墙上时间；cpu: 本进程的 CPU 时间；cloud_wait / remote_wait: 等待云端数据库 / 远程服务的时间之和，
+        并发的请求分别计入，可能大于 wall；pages / rows: 拉取的页数和参与对比的行数（两边之和）；
+        operations: 插入/更新/删除的行数和写请求数；http_requests: 发给远程服务的请求数；
+        bytes_sent / bytes_received: 与远程服务之间传输的字节数（压缩后）
+    """
+    def __init__(self, name):
+        self.name = name
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.cloud_wait = 0.0
+        self.remote_wait = 0.0
+        self.pages = 0
+        self.rows = 0
+        self.operations = collections.Counter()
+        self.http_requests = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(name=self.name,
+                    wall=round(self.wall, 4),
+                    cpu=round(self.cpu, 4),
+                    cloud_wait=round(self.cloud_wait, 4),
+                    remote_wait=round(self.remote_wait, 4),
+                    pages=self.pages,
+                    rows=self.rows,
+                    operations=dict(self.operations),
+                    http_requests=self.http_requests,
+                    bytes_sent=self.bytes_sent,
+                    bytes_received=self.bytes_received)
+
+
+class _PassContext(object):
+    def __init__(self, report, pass_report: PassReport):
+        self._report = report
+        self._pass_report = pass_report
+
+    def __enter__(self):
+        self._previous = self._report.current
+        self._report.current = self._pass_report
+        self._wall = time.time()
+        self._cpu = time.process_time()
+        self._transfer = dict(self._report.transfer)
+        return self._pass_report
+
+    def __exit__(self, exc_type, exc, tb):
+        self._pass_report.wall += time.time() - self._wall
+        self._pass_report.cpu += time.process_time() - self._cpu
+        self._pass_report.http_requests += self._report.transfer["requests"] - self._transfer.get("requests", 0)
+        self._pass_report.bytes_sent += self._report.transfer["sent"] - self._transfer.get("sent", 0)
+        self._pass_report.bytes_received += self._report.transfer["received"] - self._transfer.get("received", 0)
+        self._report.current = self._previous
+
+
+class CycleReport(object):
+    """
+    一轮同步的报告，结束时输出一行 json（日志和 report 文件各一行）
+    不在任何阶段中的等待时间计入 "other" 阶段
+    """
+    def __init__(self, region, transfer: collections.Counter):
+        self.region = region
+        self.transfer = transfer
+        self.passes = collections.OrderedDict()  # type: Dict[str, PassReport]
+        self.current = self._get_pass("other")
+        self._begin = time.time()
+        self._cpu = time.process_time()
+        self._transfer = dict(transfer)
+
+    def _get_pass(self, name) -> PassReport:
+        if name not in self.passes:
+            self.passes[name] = PassReport(name)
+        return self.passes[name]
+
+    def phase(self, name) -> _PassContext:
+        """
+        with report.phase("user.merge") as pass_report: ...
+        同名的阶段多次进入时累加
+        """
+        return _PassContext(self, self._get_pass(name))
+
+    def add_wait(self, kind, seconds):
+        if kind == "cloud":
+            self.current.cloud_wait += seconds
+        else:
+            self.current.remote_wait += seconds
+
+    def to_dict(self, **extra) -> Dict[str, Any]:
+        passes = [pass_report.to_dict() for pass_report in self.passes.values()
+                  if pass_report.name != "other" or pass_report.cloud_wait or pass_report.remote_wait]
+        return dict(region=self.region,
+                    begin=round(self._begin, 3),
+                    wall=round(time.time() - self._begin, 4),
+                    cpu=round(time.process_time() - self._cpu, 4),
+                    http_requests=self.transfer["requests"] - self._transfer.get("requests", 0),
+                    bytes_sent=self.transfer["sent"] - self._transfer.get("sent", 0),
+                    bytes_received=self.transfer["received"] - self._transfer.get("received", 0),
+                    passes=passes,
+                    **extra)
+
+    def emit(self, path=None, **extra):
+        line = json.dumps(self.to_dict(**extra), sort_keys=True)
+        logger.info("[report] {}".format(line))
+        if path:
+            # 一次 write 追加一整行，多个进程写同一个文件时不会交错
+            fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, (line + "\n").encode())
+            finally:
+                os.close(fd)
+
+
+class TimedProxy(object):
+    """
+    包装 CloudFeatureProxy / RemoteFeatureProxy: 协程方法和异步生成器方法的等待时间计入当前报告的 kind（cloud / remote）
+    """
+    def __init__(self, proxy, kind, get_report):
+        self._proxy = proxy
+        self._kind = kind
+        self._get_report = get_report
+
+    def __getattr__(self, item):
+        attr = getattr(self._proxy, item)
+        if inspect.iscoroutinefunction(attr):
+            @functools.wraps(attr)
+            async def timed(*args, **kwargs):
+                begin = time.time()
+                try:
+                    return await attr(*args, **kwargs)
+                finally:
+                    self._add_wait(time.time() - begin)
+            return timed
+        if inspect.isasyncgenfunction(attr):
+            @functools.wraps(attr)
+            async def timed_gen(*args, **kwargs):
+                generator = attr(*args, **kwargs)
+                while True:
+                    begin = time.time()
+                    try:
+                        item = await generator.__anext__()
+                    except StopAsyncIteration:
+                        return
+                    finally:
+                        self._add_wait(time.time() - begin)
+                    yield item
+            return timed_gen
+        return attr
+
+    def _add_wait(self, seconds):
+        report = self._get_report()
+        if report is not None:
+            report.add_wait(self._kind, seconds)
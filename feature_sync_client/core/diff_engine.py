@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from typing import Dict, List, Any
+
+
+class DiffResult(object):
+    def __init__(self):
+        self.inserts = []  # type: List[Dict[Any, Any]]
+        self.deletes = []  # type: List[Dict[Any, Any]]
+        self.updates = []  # type: List[Dict[Any, Any]]
+
+    def __str__(self):
+        return "<DiffResult insert: {}, delete: {}, update: {}>".format(
+                len(self.inserts), len(self.deletes), len(self.updates))
+
+
+def merge_join(cloud_rows: List[Dict[Any, Any]], remote_rows: List[Dict[Any, Any]], is_changed) -> DiffResult:
+    """
+    按 id 归并同一区间的云端和远程数据: 只在云端的行需要插入，只在远程的行需要删除，
+    两边都有且 is_changed(cloud_row, remote_row) 为 True 的行需要更新
+    inserts / updates 为云端的行，deletes 为远程的行
+    """
+    cloud_rows = sorted(cloud_rows, key=lambda row: row["id"])
+    remote_rows = sorted(remote_rows, key=lambda row: row["id"])
+
+    result = DiffResult()
+    i, j = 0, 0
+    while i < len(cloud_rows) and j < len(remote_rows):
+        cloud_row, remote_row = cloud_rows[i], remote_rows[j]
+        if cloud_row["id"] < remote_row["id"]:
+            result.inserts.append(cloud_row)
+            i += 1
+        elif cloud_row["id"] > remote_row["id"]:
+            result.deletes.append(remote_row)
+            j += 1
+        else:
+            if is_changed(cloud_row, remote_row):
+                result.updates.append(cloud_row)
+            i += 1
+            j += 1
+
+    result.inserts.extend(cloud_rows[i:])
+    result.deletes.extend(remote_rows[j:])
+    return result
@@ -2,37 +2,117 @@
 # -*- coding: utf-8 -*-
 
 import datetime
+import time
 import traceback
 import asyncio
-from typing import Dict, List, Any
+import functools
+import itertools
+import collections
+from typing import Dict, List, Tuple, Any
 import os
 
 from lib.logger import logger
+from lib.utils import get_state_dir, get_log_dir
+from lib.exceptions import ServerException, Error
 
 from core.conf_parameter import g_conf_parameter
 from core.cloud_feature_proxy import CloudFeatureProxy
 from core.remote_feature_proxy import RemoteFeatureProxy
+from core.write_pipeline import AimdWindow, WritePipeline
+from core.page_pipeline import PagePipeline, PageSizer
+from core.checkpoint_store import CheckpointStore, PassProgress
+from core.change_source import ChangeEvent, create_change_source
+from core.diff_engine import merge_join
+from core.cycle_report import CycleReport, TimedProxy
 
 
 class SyncStatus(object):
-    def __init__(self, user_id, feature_model_0330_id):
+    def __init__(self, user_id, feature_model_0330_id, user_count=None, feature_model_0330_count=None, change_time=None):
         self.user_id = user_id
         self.feature_model_0330_id = feature_model_0330_id
+        self.user_count = user_count
+        self.feature_model_0330_count = feature_model_0330_count
+        self.change_time = change_time
+
+    def key(self):
+        return self.user_id, self.user_count, self.feature_model_0330_id, self.feature_model_0330_count, self.change_time
 
     def __str__(self):
-        return "<SyncStatus id:{}, user_id:{}, feature_model_0330_id: {}>".format(
-                id(self), self.user_id, self.feature_model_0330_id)
+        return "<SyncStatus id:{}, user_id:{}, feature_model_0330_id: {}, user_count: {}, feature_model_0330_count: {}, change_time: {}>".format(
+                id(self), self.user_id, self.feature_model_0330_id, self.user_count, self.feature_model_0330_count, self.change_time)
 
 
 class FeatureProcessor(object):
-    def __init__(self):
-        self.province_code = g_conf_parameter.sync_province_code
-        self.city_code = g_conf_parameter.sync_city_code
-        self.town_code = g_conf_parameter.sync_town_code
-
-        self._cloud_feature_proxy = CloudFeatureProxy()
-        self._remote_feature_proxy = RemoteFeatureProxy()
-
+    # 每张表的批量插入、批量更新和删除命令
+    table_commands = {
+        "user": ("add_users_batch", "update_users_batch", "del_user_by_id"),
+        "feature_model_0330": ("add_feature_model_0330_batch", "update_feature_model_0330_batch", "del_feature_model_0330_by_id"),
+    }
+    # 合并到一个 batch 事务中时每一行的插入、更新和删除命令
+    table_row_commands = {
+        "user": ("add_user", "update_user", "del_user_by_id"),
+        "feature_model_0330": ("add_feature_model_0330", "update_feature_model_0330", "del_feature_model_0330_by_id"),
+    }
+    # CDC 写入时每一行的写入和删除命令，重复执行的结果相同
+    table_change_commands = {
+        "user": ("upsert_user", "del_user_by_id"),
+        "feature_model_0330": ("upsert_feature_model_0330", "del_feature_model_0330_by_id"),
+    }
+
+    def __init__(self, province_code=None, city_code=None, town_code=None, region_index=0):
+        """
+        不指定区域时使用配置中 MAIN 的区域；多区域同步时 region_index 为区域在 regions 中的序号
+        """
+        self.province_code = province_code or g_conf_parameter.sync_province_code
+        self.city_code = city_code or g_conf_parameter.sync_city_code
+        self.town_code = town_code or g_conf_parameter.sync_town_code
+
+        self._region = "{}/{}/{}".format(self.province_code, self.city_code, self.town_code)
+
+        # 两个 proxy 的等待时间计入当前一轮的报告
+        self._cloud_feature_proxy = TimedProxy(CloudFeatureProxy(), "cloud", lambda: self._report)
+        self._remote_feature_proxy = TimedProxy(RemoteFeatureProxy(), "remote", lambda: self._report)
+        self._report = CycleReport(self._region, self._remote_feature_proxy.transfer)
+        self._write_pipeline = WritePipeline(AimdWindow(min_size=g_conf_parameter.pipeline_min_concurrency,
+                                                        max_size=g_conf_parameter.pipeline_max_concurrency,
+                                                        initial_size=g_conf_parameter.pipeline_initial_concurrency,
+                                                        latency_target=g_conf_parameter.pipeline_latency_target))
+
+        # 每张表的每页行数，跨轮次保留调整的结果
+        self._page_sizers = collections.defaultdict(lambda: PageSizer(initial_size=g_conf_parameter.pipeline_page_size,
+                                                                      min_size=g_conf_parameter.pipeline_min_page_size,
+                                                                      max_size=g_conf_parameter.pipeline_max_page_size,
+                                                                      target_bytes=g_conf_parameter.pipeline_page_target_bytes,
+                                                                      target_latency=g_conf_parameter.pipeline_page_target_latency))
+
+        checkpoint_path = None
+        if g_conf_parameter.checkpoint_enable == 1:
+            checkpoint_file_name = g_conf_parameter.checkpoint_file_name
+            if len(g_conf_parameter.sync_regions) > 1:
+                # 多个区域可能在不同的进程中同步，每个区域一个文件
+                checkpoint_file_name = "{}.{}_{}_{}".format(checkpoint_file_name, self.province_code, self.city_code, self.town_code)
+            checkpoint_path = os.path.join(get_state_dir(), checkpoint_file_name)
+        self._checkpoint_store = CheckpointStore(checkpoint_path)
+
+        self._change_source = None
+        if g_conf_parameter.cdc_enable == 1:
+            source_kwargs = {}
+            if g_conf_parameter.cdc_source == "binlog":
+                # 每个 binlog 连接的 server_id 不能重复
+                source_kwargs["server_id"] = g_conf_parameter.cdc_server_id + region_index
+            self._change_source = create_change_source(g_conf_parameter.cdc_source,
+                                                       self._cloud_feature_proxy, self._checkpoint_store, self._region,
+                                                       self.province_code, self.city_code, self.town_code, **source_kwargs)
+        self._last_full_scan_time = 0
+        # 同一批变更连续写入失败的轮数
+        self._cdc_failures = 0
+        # 第一轮同步前检查云端的区域查询是否用到了索引
+        self._index_checked = g_conf_parameter.mysql_index_check != 1
+
+        # 上一轮没有任何写操作并且遍历完所有区间时的 (云端状态, 远程状态, 时间)，两边状态都没有变化时跳过这一轮
+        self._clean_status = None
+        self.cloud_status = None  # type: SyncStatus
+        self.remote_status = None  # type: SyncStatus
         self.stop = False
         self.running = False
 
@@ -43,32 +123,210 @@ class FeatureProcessor(object):
         now = datetime.datetime.now()
         logger.info("[start]->begin, {}".format(now))
 
+        self._report = CycleReport(self._region, self._remote_feature_proxy.transfer)
+        submit_count = self._write_pipeline.submit_count
+        result = "sync"
         try:
             self.running = True
-
-            cloud_status = await self._cloud_feature_proxy.get_sync_status(self.province_code, self.city_code, self.town_code)
+            # 失败的写在一轮中一直阻止依赖它的写（user 阶段失败的 user 阻止 feature 阶段的 feature），下一轮重新对比
+            self._write_pipeline.reset()
+
+            if not self._index_checked:
+                self._index_checked = True
+                await self._cloud_feature_proxy.check_region_indexes(self.province_code, self.city_code, self.town_code)
+
+            if self._change_source is not None:
+                await self.sync_changes()
+                # CDC 模式下全量对比只是兜底，间隔 full_scan_interval 执行一次
+                if time.time() - self._last_full_scan_time < g_conf_parameter.cdc_full_scan_interval:
+                    result = "changes"
+                    return
+                self._last_full_scan_time = time.time()
+
+            with self._report.phase("status"):
+                cloud_status, remote_status = await asyncio.gather(
+                    self._cloud_feature_proxy.get_sync_status(self.province_code, self.city_code, self.town_code),
+                    self._remote_feature_proxy.get_sync_status(self.province_code, self.city_code, self.town_code))
             cloud_status = SyncStatus(**cloud_status)
+            self.cloud_status = cloud_status
             logger.info("cloud_status: {}".format(cloud_status))
 
-            remote_status = await self._remote_feature_proxy.get_sync_status(self.province_code, self.city_code, self.town_code)
             remote_status = SyncStatus(**remote_status)
+            self.remote_status = remote_status
             logger.info("remote_status: {}".format(remote_status))
-            
+
+            logger.info("last cloud_status: {}, last remote_status: {}".format(
+                        self._checkpoint_store.get_status(self._region, "cloud"),
+                        self._checkpoint_store.get_status(self._region, "remote")))
+            self._checkpoint_store.set_status(self._region, "cloud", vars(cloud_status))
+            self._checkpoint_store.set_status(self._region, "remote", vars(remote_status))
+            self._checkpoint_store.save()
+
+            if self._is_unchanged(cloud_status, remote_status):
+                logger.info("nothing changed since {}, skip".format(datetime.datetime.fromtimestamp(self._clean_status[2])))
+                result = "skip"
+                return
+
+            self._clean_status = None
+            write_count = self._write_pipeline.submit_count
             await self.sync_user(cloud_status, remote_status)
             await self.sync_feature_model_0330(cloud_status, remote_status)
+            if self._write_pipeline.submit_count == write_count and not self._checkpoint_store.has_pending_pass(self._region):
+                self._clean_status = (cloud_status.key(), remote_status.key(), time.time())
+        except Exception:
+            result = "error"
+            raise
         finally:
             self.running = False
+            self._emit_report(result, self._write_pipeline.submit_count - submit_count)
             end = datetime.datetime.now()
             logger.info("[start]->end, {} ,cost {}s".format(end, (end-now).seconds))
 
+    def _emit_report(self, result, requests):
+        """
+        一轮结束时输出报告: 日志中一行 [report] json，并追加到 log 目录的 report 文件（每行一个 json）
+        """
+        if g_conf_parameter.report_enable != 1:
+            return
+        path = None
+        if g_conf_parameter.report_file_name:
+            path = os.path.join(get_log_dir(), g_conf_parameter.report_file_name)
+        try:
+            self._report.emit(path, result=result, requests=requests)
+        except OSError:
+            logger.error(traceback.format_exc())
+
+    @property
+    def report(self) -> CycleReport:
+        """
+        当前（或最近）一轮的报告
+        """
+        return self._report
+
+    def _is_unchanged(self, cloud_status: SyncStatus, remote_status: SyncStatus):
+        """
+        上一轮两边已经一致，并且两边的最大 id、行数和云端最后修改的时间都没有变化；
+        云端不支持最后修改的时间时不跳过，距上一次完整对比超过 skip_max_interval 秒时也不跳过
+        最后修改的时间可能被缓存，默认不开启，见配置 skip_unchanged
+        """
+        if g_conf_parameter.sync_skip_unchanged != 1 or self._clean_status is None or cloud_status.change_time is None:
+            return False
+        cloud_key, remote_key, clean_time = self._clean_status
+        return cloud_key == cloud_status.key() and remote_key == remote_status.key() \
+            and time.time() - clean_time < g_conf_parameter.sync_skip_max_interval
+
+    def database_stats(self):
+        """
+        云端数据库连接池的指标，见 MysqlClient.stats
+        """
+        return self._cloud_feature_proxy.database_stats()
+
+    async def close(self):
+        """
+        释放云端数据库连接池和远程服务的 http 连接池
+        """
+        await self._cloud_feature_proxy.close()
+        await self._remote_feature_proxy.close()
+
+    async def sync_changes(self):
+        """
+        CDC 模式: 按发生的顺序把云端的变更写到远程，每一批的写请求全部确认后再保存读取的位置；
+        有写请求失败时不保存位置，下一轮从上次保存的位置重新读取这一批；
+        同一批连续 max_retries 轮失败时跳过失败的行并保存位置，记录在 checkpoint 的 cdc_skipped 中，由全量对比补齐
+        """
+        now = datetime.datetime.now()
+        logger.info("[sync_changes]->begin, {}".format(now))
+
+        event_count = 0
+        with self._report.phase("changes") as pass_report:
+            submit_count = self._write_pipeline.submit_count
+            while True:
+                events = await self._change_source.read_events(g_conf_parameter.cdc_batch_size)
+                pass_report.pages += 1
+                if events:
+                    await self._apply_change_events(events)
+                    failed_keys = await self._write_pipeline.join()
+                    event_count += len(events)
+                    pass_report.rows += len(events)
+                    pass_report.operations.update(event.action for event in events)
+                    if failed_keys:
+                        self._cdc_failures += 1
+                        if self._cdc_failures < g_conf_parameter.cdc_max_retries:
+                            logger.error("[sync_changes] {} writes failed, read the batch again next cycle, failures: {}".format(
+                                         len(failed_keys), self._cdc_failures))
+                            self._change_source.reset()
+                            break
+                        self._skip_failed_changes(failed_keys)
+                        pass_report.operations["skipped"] += len(failed_keys)
+                    self._cdc_failures = 0
+                if not self._change_source.commit():
+                    break
+            pass_report.operations["requests"] += self._write_pipeline.submit_count - submit_count
+
+        end = datetime.datetime.now()
+        logger.info("[sync_changes]->end, events: {}, cost:{}s".format(event_count, round((end-now).total_seconds(), 3)))
+
+    def _skip_failed_changes(self, failed_keys):
+        """
+        一直写入失败的行不再阻塞后面的变更: 记录到 checkpoint 的 cdc_skipped（最多 100 个），
+        清除写流水线中的失败标记，这一轮立即执行全量对比
+        """
+        failed_keys = sorted(failed_keys, key=str)
+        logger.error("[sync_changes] {} writes failed {} times, skip: {}".format(
+                     len(failed_keys), self._cdc_failures, failed_keys[:100]))
+        skipped = self._checkpoint_store.get_value(self._region, "cdc_skipped") or {}
+        self._checkpoint_store.set_value(self._region, "cdc_skipped", dict(
+            keys=[list(key) for key in failed_keys[:100]],
+            count=skipped.get("count", 0) + len(failed_keys),
+            time=int(time.time())))
+        self._write_pipeline.reset()
+        self._last_full_scan_time = 0
+
+    async def _apply_change_events(self, events: List[ChangeEvent]):
+        """
+        相邻的同一张表的插入和更新合并成一个 upsert 的 batch 请求，相邻的删除合并成一个 batch 请求，
+        都是 fail_fast 为 0，重复执行（重新读取同一批）的结果相同
+        同一行的写按顺序执行，feature 在其 user 写入之后执行，user 的删除在其 feature 的写之后执行
+        """
+        for (table, is_delete), group in itertools.groupby(events, key=lambda event: (event.table, event.action == "delete")):
+            group = list(group)
+            upsert_command, delete_command = self.table_change_commands[table]
+            if is_delete:
+                for event in group:
+                    logger.info("[sync_changes] {}".format(event))
+                commands = [dict(command=delete_command, id=event.row_id) for event in group]
+                keys = [(table, event.row_id) for event in group]
+                if table == "user":
+                    after = keys + [("user_feature", event.row_id) for event in group]
+                else:
+                    after = list(keys)
+                    keys += [("user_feature", event.user_id) for event in group]
+                await self._write_pipeline.submit("batch", self._apply_changes, table, commands, keys=keys, after=after)
+                continue
+
+            # 同一批中同一行只保留最后一次的数据
+            records = list(collections.OrderedDict((event.row_id, event.values) for event in group).values())
+            keys = [(table, record["id"]) for record in records]
+            after = list(keys)
+            if table == "feature_model_0330":
+                keys += [("user_feature", record["user_id"]) for record in records]
+                after += [("user", record["user_id"]) for record in records]
+
+            logger.info("[sync_changes] {} {}".format(upsert_command, [record["id"] for record in records]))
+            commands = [dict(command=upsert_command, values=record) for record in records]
+            await self._write_pipeline.submit("batch", self._apply_changes, table, commands, keys=keys, after=after)
+
     async def sync_user(self, cloud_status: SyncStatus, remote_status: SyncStatus):
         now = datetime.datetime.now()
         logger.info("[sync_user]->start, begin:{}".format(now))
 
-        await self._user_check_for_insert(cloud_status, remote_status)
-        await self._user_check_for_insert_miss(cloud_status, remote_status)
-        await self._user_check_for_del(cloud_status, remote_status)
-        await self._user_check_for_update(cloud_status, remote_status)
+        # 两侧都只对比 id 和行内容的摘要，需要插入或者更新的行再按 id 从云端取完整的行
+        await self._sync_table("user", cloud_status.user_id, remote_status.user_id,
+                               self._cloud_feature_proxy.query_user_digest_range,
+                               self._remote_feature_proxy.query_user_digest_range,
+                               self._is_user_changed,
+                               remote_stream=self._remote_feature_proxy.export_user_digest_range,
+                               cloud_fetch=self._cloud_feature_proxy.query_user_by_ids)
 
         end = datetime.datetime.now()
         logger.info("[sync_user]->end, end:{}, cost:{}s".format(end, round((end-now).total_seconds(),3)))
@@ -77,293 +335,248 @@ class FeatureProcessor(object):
         now = datetime.datetime.now()
         logger.info("start sync feature model 0330, begin:{}".format(now))
 
-        await self._feature_model_0330_check_for_insert(cloud_status, remote_status)
-        await self._feature_model_0330_check_for_insert_miss(cloud_status, remote_status)
-        await self._feature_model_0330_check_for_delete(cloud_status, remote_status)
-        await self._feature_model_0330_check_for_update(cloud_status, remote_status)
+        # 两侧都只对比 id 和 timestamp，需要插入或者更新的行再按 id 从云端取完整的 feature
+        await self._sync_table("feature_model_0330", cloud_status.feature_model_0330_id, remote_status.feature_model_0330_id,
+                               self._cloud_feature_proxy.query_feature_model_0330_time_range,
+                               self._remote_feature_proxy.query_feature_model_0330_time_range,
+                               self._is_feature_model_0330_changed,
+                               remote_stream=self._remote_feature_proxy.export_feature_model_0330_time_range,
+                               cloud_fetch=self._cloud_feature_proxy.query_feature_model_0330_by_ids)
 
         end = datetime.datetime.now()
         logger.info(
             "end sync feature model 0330, end:{}, cost:{}s".format(end, round((end-now).total_seconds(),3)))
 
-    async def _user_check_for_insert(self, cloud_status: SyncStatus, remote_status: SyncStatus):
-        end_id = cloud_user_id = cloud_status.user_id
-        old_begin_id = begin_id = remote_user_id = remote_status.user_id
-
-        logger.info("[_user_check_for_insert]->begin, cloud: {}, remote: {}".format(end_id, begin_id))
-
-        if begin_id < end_id:
-            while begin_id < end_id:
-                records = await self._cloud_feature_proxy.query_user_range(
-                    self.province_code, self.city_code, self.town_code, begin_id, end_id)
-                logger.info("user_check_for_insert: {} {} {} {} result_len: {}".format(
-                    self.province_code, self.city_code, self.town_code, begin_id, end_id, len(records)))
-
-                if not records:
-                    logger.info("no records, for insert, break")
-                    break
-                else:
-                    for record in records:  # type: Dict[Any, Any]
-                        begin_id = record["id"]
-                        logger.debug("[insert_feature_model_0330]->begin {}".format(begin_id))
-                        logger.debug("prepare insert data {}".format(record))
-                        await self._remote_feature_proxy.add_user(record)
-                        logger.debug("[insert_feature_model_0330]->end {}".format(begin_id))
-        else:
-            logger.info("begin_id >= end_id, begin_id:{}, end_id:{}".format(begin_id, end_id))
-        logger.info("[_user_check_for_insert]->end, ({}, {})".format(old_begin_id, end_id))
-
-    async def _user_check_for_insert_miss(self, cloud_status: SyncStatus, remote_status: SyncStatus):
-
-        def get_ids(user_records: List[Dict[Any, Any]]) -> List[int]:
-            return [record["id"] for record in user_records]
-
-        begin_id = -1
-        end_id = cloud_status.user_id
-        logger.info("[_user_check_for_insert_miss]->begin: (-1, {})".format(end_id))
-        if begin_id >= end_id:
-            logger.info("begin_id >= end_id, begin_id:{}, end_id:{}".format(begin_id, end_id))
-        else:
-            while begin_id < end_id:
-                cloud_records = await self._cloud_feature_proxy.query_user_range(
-                                        self.province_code, self.city_code, self.town_code, begin_id, end_id)
-                cloud_ids = set(get_ids(cloud_records))
-                if not cloud_ids:
-                    break
-                cloud_map = {line['id']: line for line in cloud_records}
+    def _page_pipeline(self, table, cloud_query, remote_query, ranges: List[Tuple[int, int]], remote_stream=None) -> PagePipeline:
+        """
+        cloud_query / remote_query 为 proxy 的 query_*_range 方法，remote_stream 为 export_*_range 方法，这里绑定当前的区域
+        配置了 stream_range 时远程每个区间只发一个流式请求，否则按页请求
+        """
+        def bind(query):
+            if query is None:
+                return None
+            return functools.partial(query, self.province_code, self.city_code, self.town_code)
 
-                remote_records = await self._remote_feature_proxy.query_user_id_range(
-                                        self.province_code, self.city_code, self.town_code, begin_id, end_id)
-                remote_ids = set(get_ids(remote_records))
+        if g_conf_parameter.remote_stream_range != 1:
+            remote_stream = None
+        return PagePipeline(bind(cloud_query), bind(remote_query), ranges, prefetch=g_conf_parameter.pipeline_prefetch_pages,
+                            page_sizer=self._page_sizers[table], remote_stream=bind(remote_stream))
 
-                miss_ids = cloud_ids - remote_ids
-                if not miss_ids:
-                    logger.info("no miss_ids between: range({}, {})".format(begin_id, end_id))
-                else:
-                    for _id in miss_ids:
-                        logger.info("insert user:{}".format(_id))
-                        await self._remote_feature_proxy.add_user(cloud_map[_id])
-                begin_id = max(cloud_ids)
-        logger.info("[_user_check_for_insert_miss]->end: (-1,{})".format(end_id))
-
-    async def _user_check_for_del(self, cloud_status: SyncStatus, remote_status: SyncStatus):
-
-        def get_ids(user_records: List[Dict[Any, Any]]) -> List[int]:
-            return [record["id"] for record in user_records]
-
-        begin_id = -1
-        end_id = cloud_status.user_id
-        logger.info("[_user_check_for_del]->begin: (-1, {})".format(end_id))
-        if begin_id >= end_id:
-            logger.info("begin_id >= end_id, begin_id:{}, end_id:{}".format(begin_id, end_id))
-        else:
-            while begin_id < end_id:
-                remote_records = await self._remote_feature_proxy.query_user_id_range(
-                                        self.province_code, self.city_code, self.town_code, begin_id, end_id)
-                remote_ids = set(get_ids(remote_records))
-                if not remote_ids:
-                    logger.info("not found ids for delete")
-                    break
-                    
-                cloud_records = await self._cloud_feature_proxy.query_user_id_range(
-                                        self.province_code, self.city_code, self.town_code, begin_id, end_id)
-                cloud_ids = set(get_ids(cloud_records))
-
-                diff_ids = remote_ids - cloud_ids
-                if not diff_ids:
-                    logger.info("no diff between:range({}, {})".format(begin_id, end_id))
-                else:
-                    for _id in diff_ids:
-                        logger.info("delete user:{}".format(_id))
-                        await self._remote_feature_proxy.del_user_by_id(_id)
-                begin_id = max(remote_ids)
-        logger.info("[_user_check_for_del]->end: (-1,{})".format(end_id))
-
-    async def _user_check_for_update(self, cloud_status: SyncStatus, remote_status: SyncStatus):
-        """
-        检测更新操作
-        """
-
-        def get_ids(user_records: List[Dict[Any, Any]]) -> List[int]:
-            return [record['id'] for record in user_records]
-
-        begin_id = -1
-        end_id = cloud_status.user_id
-        logger.info("[_user_check_for_update]->begin: (-1, {})".format(end_id))
-
-        if begin_id >= end_id:
-            logger.info("begin_id >= end_id, begin_id:{}, end_id:{}".format(begin_id, end_id))
-        else:
-            while begin_id < end_id:
-                remote_records = await self._remote_feature_proxy.query_user_range(
-                                        self.province_code, self.city_code, self.town_code, begin_id, end_id)
-                remote_map = {line['id']: line for line in remote_records}
-                remote_ids = set(get_ids(remote_records))
-                if not remote_ids:
-                    logger.info("not found ids for update")
-                    break
+    def _pass_progress(self, table, pass_name, ranges: List[Tuple[int, int]]) -> PassProgress:
+        """
+        对比阶段从上次保存的水位继续，保存水位前等待写流水线中的请求全部确认，有失败的请求时不保存
+        """
+        return PassProgress(self._checkpoint_store, self._region, table, pass_name, ranges,
+                            flush=self._write_pipeline.join,
+                            save_pages=g_conf_parameter.checkpoint_save_pages,
+                            max_pages=g_conf_parameter.checkpoint_max_pages_per_cycle)
 
-                cloud_records = await self._cloud_feature_proxy.query_user_range(
-                                        self.province_code, self.city_code, self.town_code, begin_id, end_id)
-                cloud_map = {line['id']: line for line in cloud_records}
-                cloud_ids = set(get_ids(cloud_records))
+    async def _sync_table(self, table, cloud_max_id, remote_max_id, cloud_query, remote_query, is_changed, remote_stream=None,
+                          cloud_fetch=None):
+        """
+        一次按 id 顺序的归并遍历同时得到插入、删除和更新，只遍历分桶摘要不一致的区间
+        云端和远程同一区间的数据页并发拉取，归并得到的写操作交给写流水线
+        cloud_fetch 不为 None 时 cloud_query 只返回用于对比的列，插入和更新的完整行由 cloud_fetch 按 id 批量获取
+        """
+        with self._report.phase("{}.digest".format(table)):
+            ranges = await self._get_diff_ranges(table, max(cloud_max_id, remote_max_id))
+        logger.info("[_sync_table]->begin, {}, cloud: {}, remote: {}, ranges: {}".format(
+                    table, cloud_max_id, remote_max_id, ranges))
+
+        with self._report.phase("{}.merge".format(table)) as pass_report:
+            submit_count = self._write_pipeline.submit_count
+            counter, page_count = await self._merge_table(table, ranges, cloud_query, remote_query, is_changed, remote_stream,
+                                                          cloud_fetch, pass_report)
+            pass_report.pages += page_count
+            pass_report.operations.update(counter)
+            pass_report.operations["requests"] += self._write_pipeline.submit_count - submit_count
+
+        logger.info("[_sync_table]->end, {}, pages: {}, page size: {}, insert: {}, delete: {}, update: {}".format(
+                    table, page_count, self._page_sizers[table].size,
+                    counter["insert"], counter["delete"], counter["update"]))
+
+    async def _merge_table(self, table, ranges, cloud_query, remote_query, is_changed, remote_stream, cloud_fetch,
+                           pass_report) -> Tuple[collections.Counter, int]:
+        """
+        逐页归并对比 ranges 中的区间并提交写操作，等待写操作全部确认，返回 (插入/删除/更新的行数, 页数)
+        """
+        add_command, update_command, delete_command = self.table_commands[table]
+
+        counter = collections.Counter()
+        progress = self._pass_progress(table, "merge", ranges)
+        pipeline = self._page_pipeline(table, cloud_query, remote_query, progress.ranges, remote_stream)
+        async for page in pipeline.pages():
+            pass_report.rows += len(page.cloud_rows) + len(page.remote_rows)
+            result = merge_join(page.cloud_rows, page.remote_rows, is_changed)
+            logger.debug("[_sync_table] {} {} {}".format(table, page, result))
+            if cloud_fetch is not None:
+                result.inserts, result.updates = await self._fetch_cloud_rows(cloud_fetch, result.inserts, result.updates)
+
+            if result.inserts:
+                logger.info("insert {}:{}".format(table, [row["id"] for row in result.inserts]))
+            for row in result.deletes:
+                logger.info("delete {}:{}".format(table, row["id"]))
+            if g_conf_parameter.pipeline_page_envelope == 1:
+                await self._submit_envelope(table, result.inserts, result.updates, result.deletes)
+            else:
+                await self._submit_batch(add_command, table, result.inserts)
+                for row in result.deletes:
+                    await self._write_pipeline.submit(delete_command, getattr(self._remote_feature_proxy, delete_command),
+                                                      row["id"], keys=[(table, row["id"])])
+                await self._submit_batch(update_command, table, result.updates)
+
+            counter.update(insert=len(result.inserts), delete=len(result.deletes), update=len(result.updates))
+            if await progress.advance(page):
+                break
+        # finish 等待写操作全部确认后再保存水位
+        await progress.finish()
+        return counter, pipeline.page_count
 
-                intersection_ids = remote_ids.intersection(cloud_ids)
-                if not intersection_ids:
-                    logger.info(
-                        "no intersection ids between:range({}, {})".format(begin_id, end_id))
+    async def _fetch_cloud_rows(self, cloud_fetch, *row_lists, chunk_size=1000):
+        """
+        按 id 每 chunk_size 个一批从云端取完整的行，替换 row_lists 中只有对比列的行
+        对比之后被删除或者移出当前区域的行不再返回，由下一轮处理
+        """
+        ids = [row["id"] for rows in row_lists for row in rows]
+        full_rows = {}
+        for i in range(0, len(ids), chunk_size):
+            for row in await cloud_fetch(self.province_code, self.city_code, self.town_code, ids[i:i + chunk_size]):
+                full_rows[row["id"]] = row
+
+        return [[full_rows[row["id"]] for row in rows if row["id"] in full_rows] for rows in row_lists]
+
+    @staticmethod
+    def _is_user_changed(cloud_row: Dict[Any, Any], remote_row: Dict[Any, Any]):
+        cloud_digest = cloud_row.get("digest")
+        remote_digest = remote_row.get("digest")
+        if remote_digest != cloud_digest:
+            logger.info("update user: {}, cloud_digest: {}, remote_digest: {}".format(
+                        cloud_row["id"], cloud_digest, remote_digest))
+            return True
+        return False
+
+    @staticmethod
+    def _is_feature_model_0330_changed(cloud_row: Dict[Any, Any], remote_row: Dict[Any, Any]):
+        cloud_timestamp = cloud_row.get("timestamp", -1)
+        remote_timestamp = remote_row.get("timestamp", -2)
+        if remote_timestamp != cloud_timestamp:
+            logger.info("update feature_model_0330: {}, cloud_timestamp: {}, remote_timestamp: {}".format(
+                        cloud_row["id"], cloud_timestamp, remote_timestamp))
+            return True
+        return False
+
+    async def _get_diff_ranges(self, table, end_id) -> List[Tuple[int, int]]:
+        """
+        对比云端和远程在 (-1, end_id] 上的分桶摘要（行数 + 行内容的哈希），
+        只继续细分摘要不一致的桶，返回需要逐行对比的 id 区间 [(begin_id, end_id), ...]
+        """
+        if end_id < 0:
+            return []
+        if g_conf_parameter.digest_enable != 1:
+            return [(-1, end_id)]
+
+        bucket_count = g_conf_parameter.digest_bucket_count
+        leaf_rows = g_conf_parameter.digest_leaf_rows
+
+        ranges = []
+        request_count = 0
+        todo = [(-1, end_id)]
+        while todo:
+            begin_id, end_id = todo.pop(0)
+            cloud_buckets, remote_buckets = await asyncio.gather(
+                    self._cloud_feature_proxy.get_range_digest(
+                            table, self.province_code, self.city_code, self.town_code, begin_id, end_id, bucket_count),
+                    self._remote_feature_proxy.get_range_digest(
+                            table, self.province_code, self.city_code, self.town_code, begin_id, end_id, bucket_count))
+            request_count += 1
+            self._report.current.pages += 1
+            self._report.current.rows += len(cloud_buckets) + len(remote_buckets)
+
+            cloud_map = {bucket["begin_id"]: bucket for bucket in cloud_buckets}
+            remote_map = {bucket["begin_id"]: bucket for bucket in remote_buckets}
+            for bucket_begin_id in sorted(set(cloud_map) | set(remote_map)):
+                cloud_bucket = cloud_map.get(bucket_begin_id, {})
+                remote_bucket = remote_map.get(bucket_begin_id, {})
+                if cloud_bucket.get("count") == remote_bucket.get("count") \
+                        and cloud_bucket.get("digest") == remote_bucket.get("digest"):
+                    continue
+
+                bucket_end_id = (cloud_bucket or remote_bucket)["end_id"]
+                rows = max(cloud_bucket.get("count", 0), remote_bucket.get("count", 0))
+                if rows <= leaf_rows or bucket_end_id - bucket_begin_id <= bucket_count:
+                    ranges.append((bucket_begin_id, bucket_end_id))
                 else:
-                    for _id in intersection_ids:
-                        cloud_instance = cloud_map[_id]
-                        remote_instance = remote_map[_id]
-
-                        for field, cloud_field_value in cloud_instance.items():
-                            if field == "id":
-                                continue
-                            remote_field_value = remote_instance[field]
-                            if remote_field_value != cloud_field_value:
-                                logger.info("update user: {}, key: {}, cloud_field_value: {}, remote_field_value: {}".format(
-                                        _id, field, cloud_field_value, remote_field_value))
-                                await self._remote_feature_proxy.update_user(cloud_instance)
-                                break
-
-                begin_id = max(remote_ids)
-        logger.info("[_user_check_for_update]->end: (-1,{})".format(end_id))
-
-    async def _feature_model_0330_check_for_insert(self, cloud_status: SyncStatus, remote_status: SyncStatus):
-        begin_id = remote_status.feature_model_0330_id
-        end_id = cloud_status.feature_model_0330_id
-        logger.info("[_feature_model_0330_check_for_insert]->begin: ({}, {})".format(begin_id, end_id))
-
-        if begin_id >= end_id:
-            logger.info("feature_check_for_insert, begin_id >= end_id, begin_id:{}, end_id:{}".format(begin_id, end_id))
-        else:
-            while begin_id < end_id:
-                rows = await self._cloud_feature_proxy.query_feature_model_0330_range(
-                                self.province_code, self.city_code, self.town_code, begin_id, end_id)
-                logger.debug("query_data:{} {} {} {}, count:{}".format(
-                        self.province_code, self.city_code, self.town_code, begin_id, end_id, len(rows)))
-                if not rows:
-                    break
+                    todo.append((bucket_begin_id, bucket_end_id))
 
-                for row in rows:
-                    begin_id = row["id"]
-                    logger.debug("[insert_feature_model_0330]->begin {}".format(begin_id))
-                    logger.debug("prepare insert data:{}".format(row))
-                    await self._remote_feature_proxy.add_feature_model_0330(row)
-                    logger.debug("[insert_feature_model_0330]->end {}".format(begin_id))
-
-        logger.info("[_feature_model_0330_check_for_insert]->end: ({}, {})".format(begin_id, end_id))
-
-    async def _feature_model_0330_check_for_insert_miss(self, cloud_status: SyncStatus, remote_status: SyncStatus):
-
-        def get_ids(user_records: List[Dict[Any, Any]]) -> List[int]:
-            return [record["id"] for record in user_records]
-
-        begin_id = -1
-        end_id = cloud_status.user_id
-        logger.info("[_feature_model_0330_check_for_insert_miss]->begin: (-1, {})".format(end_id))
-        if begin_id >= end_id:
-            logger.info("begin_id >= end_id, begin_id:{}, end_id:{}".format(begin_id, end_id))
-        else:
-            while begin_id < end_id:
-                cloud_records = await self._cloud_feature_proxy.query_feature_model_0330_range(
-                                        self.province_code, self.city_code, self.town_code, begin_id, end_id)
-                cloud_ids = set(get_ids(cloud_records))
-                if not cloud_ids:
-                    break
-                cloud_map = {line['id']: line for line in cloud_records}
+        # 合并相邻的区间，减少分页查询的次数
+        merged_ranges = []
+        for begin_id, end_id in sorted(ranges):
+            if merged_ranges and merged_ranges[-1][1] == begin_id:
+                merged_ranges[-1] = (merged_ranges[-1][0], end_id)
+            else:
+                merged_ranges.append((begin_id, end_id))
 
-                remote_records = await self._remote_feature_proxy.query_feature_model_0330_id_range(
-                                        self.province_code, self.city_code, self.town_code, begin_id, end_id)
-                remote_ids = set(get_ids(remote_records))
+        logger.info("[_get_diff_ranges] {}, digest requests: {}, diff ranges: {}".format(
+                    table, request_count, merged_ranges))
+        return merged_ranges
 
-                miss_ids = cloud_ids - remote_ids
-                if not miss_ids:
-                    logger.info("no miss_ids between: range({}, {})".format(begin_id, end_id))
-                else:
-                    for _id in miss_ids:
-                        logger.info("insert feature_model_0330:{}".format(_id))
-                        await self._remote_feature_proxy.add_feature_model_0330(cloud_map[_id])
-                begin_id = max(cloud_ids)
-        logger.info("[_feature_model_0330_check_for_insert_miss]->end: (-1,{})".format(end_id))
-
-    async def _feature_model_0330_check_for_delete(self, cloud_status: SyncStatus, remote_status: SyncStatus):
-        def get_ids(feature_records: List[Dict[Any, Any]]) -> List[int]:
-            return [record['id'] for record in feature_records]
-
-        begin_id = -1
-        end_id = remote_status.feature_model_0330_id
-        logger.info("[_feature_model_0330_check_for_delete]->begin, (-1, {})".format(end_id))
-
-        while begin_id < end_id:
-            remote_records = await self._remote_feature_proxy.query_feature_model_0330_id_range(
-                                    self.province_code, self.city_code, self.town_code, begin_id, end_id)
-            remote_ids = set(get_ids(remote_records))
-            if not remote_ids:
-                logger.info("not found ids for ({}, {})".format(begin_id, end_id))
-                break
+    async def _submit_batch(self, command, table, records: List[Dict[Any, Any]]):
+        """
+        一页数据的批量写交给写流水线，不等待写完成
+        feature 依赖其 user_id 对应的 user 写操作，user 写入确认后才会发起
+        """
+        if not records:
+            return
 
-            cloud_records = await self._cloud_feature_proxy.query_feature_model_0330_id_range(
-                                    self.province_code, self.city_code, self.town_code, begin_id, end_id)
-            cloud_ids = set(get_ids(cloud_records))
+        after = None
+        if table == "feature_model_0330":
+            after = [("user", record["user_id"]) for record in records]
+        await self._write_pipeline.submit(command, self._apply_batch, command, table, records,
+                                          keys=[(table, record["id"]) for record in records], after=after)
 
-            diff_ids = remote_ids - cloud_ids
-            if not diff_ids:
-                logger.info("no diff between:range({}, {})".format(begin_id, end_id))
-            else:
-                for _id in diff_ids:
-                    logger.info("delete feature_model_0330:{id}".format(_id))
-                    await self._remote_feature_proxy.del_feature_model_0330_by_id(_id)
-            begin_id = max(remote_ids)
-
-        logger.info("[_feature_model_0330_check_for_delete]->end, (-1, {})".format(end_id))
-    
-    async def _feature_model_0330_check_for_update(self, cloud_status: SyncStatus, remote_status: SyncStatus):
-        """
-        检测更新操作
-        """
-
-        def get_ids(user_records: List[Dict[Any, Any]]) -> List[int]:
-            return [record['id'] for record in user_records]
-
-        begin_id = -1
-        end_id = cloud_status.user_id
-        logger.info("[_user_check_for_update]->begin: (-1, {})".format(end_id))
-
-        if begin_id >= end_id:
-            logger.info("begin_id >= end_id, begin_id:{}, end_id:{}".format(begin_id, end_id))
-        else:
-            while begin_id < end_id:
-                remote_records = await self._remote_feature_proxy.query_feature_model_0330_time_range(
-                                        self.province_code, self.city_code, self.town_code, begin_id, end_id)
-                remote_map = {line['id']: line for line in remote_records}
-                remote_ids = set(get_ids(remote_records))
-                if not remote_ids:
-                    logger.info("not found ids for update")
-                    break
+    async def _submit_envelope(self, table, inserts: List[Dict[Any, Any]], updates: List[Dict[Any, Any]],
+                               deletes: List[Dict[Any, Any]]):
+        """
+        一页的插入、更新和删除合并成一个 batch 请求，在服务端的一个事务中执行
+        """
+        add_command, update_command, delete_command = self.table_row_commands[table]
+        commands = [dict(command=add_command, values=row) for row in inserts] \
+            + [dict(command=update_command, values=row) for row in updates] \
+            + [dict(command=delete_command, id=row["id"]) for row in deletes]
+        if not commands:
+            return
 
-                cloud_records = await self._cloud_feature_proxy.query_feature_model_0330_range(
-                                        self.province_code, self.city_code, self.town_code, begin_id, end_id)
-                cloud_map = {line['id']: line for line in cloud_records}
-                cloud_ids = set(get_ids(cloud_records))
+        after = None
+        if table == "feature_model_0330":
+            after = [("user", row["user_id"]) for row in inserts + updates]
+        await self._write_pipeline.submit("batch", self._apply_envelope, table, commands,
+                                          keys=[(table, row["id"]) for row in inserts + updates + deletes], after=after)
 
-                intersection_ids = remote_ids.intersection(cloud_ids)
-                if not intersection_ids:
-                    logger.info(
-                        "no intersection ids between:range({}, {})".format(begin_id, end_id))
-                else:
-                    for _id in intersection_ids:
-                        cloud_instance = cloud_map[_id]
-                        remote_instance = remote_map[_id]
+    async def _apply_envelope(self, table, commands: List[Dict[Any, Any]]) -> List[Tuple[str, int]]:
+        results = await self._remote_feature_proxy.batch(commands, fail_fast=g_conf_parameter.pipeline_envelope_fail_fast == 1)
+        return self._get_failed_keys("batch", table, results)
 
-                        cloud_timestamp = cloud_instance.get("timestamp", -1)
-                        remote_timestamp = remote_instance.get("timestamp", -2)
+    async def _apply_changes(self, table, commands: List[Dict[Any, Any]]) -> List[Tuple[str, int]]:
+        results = await self._remote_feature_proxy.batch(commands, fail_fast=False)
+        return self._get_failed_keys("batch", table, results)
 
-                        if remote_timestamp != cloud_timestamp:
-                            logger.info("update feature_model_0330: {}, cloud_timestamp: {}, remote_timestamp: {}".format(
-                                        _id, cloud_timestamp, remote_timestamp))
-                            await self._remote_feature_proxy.update_feature_model_0330(cloud_instance)
+    async def _apply_batch(self, command, table, records: List[Dict[Any, Any]]) -> List[Tuple[str, int]]:
+        results = await getattr(self._remote_feature_proxy, command)(records)
+        return self._get_failed_keys(command, table, results)
 
-                begin_id = max(remote_ids)
-        logger.info("[_user_check_for_update]->end: (-1,{})".format(end_id))
\ No newline at end of file
+    @staticmethod
+    def _get_failed_keys(command, table, results: List[Dict[Any, Any]]) -> List[Tuple[str, int]]:
+        """
+        批量写入时服务端返回每一行的结果（data 为行的 id），返回失败的行的 key，交给写流水线标记为失败；
+        全部失败时抛出异常。code 为 104 的 user 删除（还有 feature）推迟到下一轮，不算失败
+        """
+        deferred = [result.get("data") for result in results if result.get("code") == 104]
+        if deferred:
+            logger.info("{} deferred, id: {}".format(command, deferred))
+        failed = [result for result in results if result.get("code", 0) not in (0, 104)]
+        for result in failed:
+            logger.error("{} failed, id: {}, desc: {}".format(command, result.get("data"), result.get("desc")))
+        logger.info("{} rows: {}, failed: {}".format(command, len(results), len(failed)))
+        if failed and len(failed) == len(results):
+            raise ServerException(Error.SERVER_FAILED, "{} failed, all {} rows".format(command, len(results)))
+        return [(table, result.get("data")) for result in failed]
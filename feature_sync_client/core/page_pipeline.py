@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import time
+from typing import Dict, List, Tuple, Any
+
+from lib.logger import logger
+
+PAGE_SIZE = 1000
+
+
+class Page(object):
+    def __init__(self, begin_id, end_id, cloud_rows, remote_rows):
+        self.begin_id = begin_id
+        self.end_id = end_id
+        self.cloud_rows = cloud_rows  # type: List[Dict[Any, Any]]
+        self.remote_rows = remote_rows  # type: List[Dict[Any, Any]]
+
+    def __str__(self):
+        return "<Page ({}, {}], cloud: {}, remote: {}>".format(
+                self.begin_id, self.end_id, len(self.cloud_rows), len(self.remote_rows))
+
+
+def estimate_bytes(rows: List[Dict[Any, Any]], sample_size=16):
+    """
+    按前 sample_size 行估算一页数据的字节数，bytes / str 按长度，其他字段按 8 字节
+    """
+    if not rows:
+        return 0
+    sample = rows[:sample_size]
+    size = sum(len(value) if isinstance(value, (bytes, str)) else 8 for row in sample for value in row.values())
+    return size * len(rows) // len(sample)
+
+
+class PageSizer(object):
+    """
+    自适应的每页行数: 按上一页每行的平均字节数和拉取延迟，估算满足 target_bytes 和 target_latency 的行数，
+    每次最多翻倍或减半；没有取满的页只能说明更大的页也取不到更多数据，只减不增
+    """
+    def __init__(self, initial_size=PAGE_SIZE, min_size=100, max_size=20000, target_bytes=4 * 1024 * 1024, target_latency=1.0):
+        self._min_size = max(1, min_size)
+        self._max_size = max(self._min_size, max_size)
+        self._size = min(max(initial_size, self._min_size), self._max_size)
+        self._target_bytes = target_bytes
+        self._target_latency = target_latency
+
+    @property
+    def size(self):
+        return self._size
+
+    def on_page(self, row_count, page_bytes, latency, full):
+        if row_count <= 0:
+            return
+
+        size = self._size * 2
+        if page_bytes > 0:
+            size = min(size, int(self._target_bytes * row_count / page_bytes))
+        if latency > 0:
+            size = min(size, int(self._target_latency * row_count / latency))
+        if not full:
+            size = min(size, self._size)
+        size = min(max(size, self._size // 2, self._min_size), self._max_size)
+
+        if size != self._size:
+            logger.debug("[page_pipeline] page size {} -> {}, rows: {}, bytes: {}, latency: {}s".format(
+                         self._size, size, row_count, page_bytes, round(latency, 3)))
+            self._size = size
+
+
+class RowStream(object):
+    """
+    按 id 顺序返回行的异步迭代器（如 RemoteFeatureProxy.export_*_range），按页读取，多读的行可以放回
+    """
+    def __init__(self, rows):
+        self._rows = rows
+        self._buffer = []
+        self._done = False
+
+    async def read(self, begin_id, end_id, size):
+        rows = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        while len(rows) < size and not self._done:
+            try:
+                row = await self._rows.__anext__()
+            except StopAsyncIteration:
+                self._done = True
+                break
+            rows.append(row)
+        return rows
+
+    def unread(self, rows):
+        self._buffer = rows + self._buffer
+
+    async def close(self):
+        if not self._done:
+            await self._rows.aclose()
+
+
+class PagePipeline(object):
+    """
+    按 id 顺序分页遍历 ranges，云端和远程同一区间的数据页并发拉取
+    生产者把对齐后的页放进有界队列，消费者处理第 k 页（写请求在途）时，生产者已经在预取第 k+1 页
+
+    cloud_query / remote_query: async func(begin_id, end_id) -> rows，为 None 时该侧返回空页
+    remote_stream: func(begin_id, end_id) -> 按 id 顺序的行的异步迭代器，不为 None 时代替 remote_query，
+        每个区间只发一个流式请求，按云端的分页切分
+    page_sizer: 每页的行数，默认固定为 PAGE_SIZE，query 的第三个参数为 limit
+    """
+    def __init__(self, cloud_query, remote_query, ranges: List[Tuple[int, int]], prefetch=2, page_sizer=None,
+                 remote_stream=None):
+        self._cloud_query = cloud_query
+        self._remote_query = remote_query
+        self._remote_stream = remote_stream
+        self._ranges = ranges
+        self._prefetch = max(1, prefetch)
+        self._page_sizer = page_sizer or PageSizer(PAGE_SIZE, PAGE_SIZE, PAGE_SIZE)
+        self.page_count = 0
+
+    async def pages(self):
+        queue = asyncio.Queue(maxsize=self._prefetch)
+        producer = asyncio.ensure_future(self._produce(queue))
+        try:
+            while True:
+                page = await queue.get()
+                if page is None:
+                    break
+                if isinstance(page, Exception):
+                    raise page
+                self.page_count += 1
+                yield page
+        finally:
+            if not producer.done():
+                producer.cancel()
+
+    async def _produce(self, queue):
+        try:
+            for begin_id, end_id in self._ranges:
+                stream = None
+                if self._remote_stream is not None:
+                    stream = RowStream(self._remote_stream(begin_id, end_id))
+                try:
+                    while begin_id < end_id:
+                        page = await self._fetch_page(begin_id, end_id, stream)
+                        if page is None:
+                            break
+                        await queue.put(page)
+                        begin_id = page.end_id
+                finally:
+                    if stream is not None:
+                        await stream.close()
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            await queue.put(err)
+        await queue.put(None)
+
+    async def _fetch_page(self, begin_id, end_id, stream=None):
+        remote_query = self._remote_query
+        if stream is not None:
+            remote_query = stream.read
+        page_size = self._page_sizer.size
+        begin = time.time()
+        cloud_rows, remote_rows = await asyncio.gather(self._query(self._cloud_query, begin_id, end_id, page_size),
+                                                       self._query(remote_query, begin_id, end_id, page_size))
+        if not cloud_rows and not remote_rows:
+            return None
+
+        # 两侧都按 id 排序，某一侧取满一页时，只能确认到这一页的最大 id，两侧都截断到这个位置，剩下的留给下一页
+        page_end_id = end_id
+        full = False
+        for rows in (cloud_rows, remote_rows):
+            if len(rows) >= page_size:
+                full = True
+                page_end_id = min(page_end_id, rows[-1]["id"])
+        self._page_sizer.on_page(len(cloud_rows) + len(remote_rows),
+                                 estimate_bytes(cloud_rows) + estimate_bytes(remote_rows),
+                                 time.time() - begin, full)
+
+        if stream is not None:
+            stream.unread([row for row in remote_rows if row["id"] > page_end_id])
+        cloud_rows = [row for row in cloud_rows if row["id"] <= page_end_id]
+        remote_rows = [row for row in remote_rows if row["id"] <= page_end_id]
+        page = Page(begin_id, page_end_id, cloud_rows, remote_rows)
+        logger.debug("[page_pipeline] fetch {}".format(page))
+        return page
+
+    @staticmethod
+    async def _query(query, begin_id, end_id, limit):
+        if query is None:
+            return []
+        return await query(begin_id, end_id, limit)
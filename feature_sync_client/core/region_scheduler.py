@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import datetime
+import traceback
+import asyncio
+import multiprocessing
+import queue
+from typing import List, Tuple
+
+from lib.logger import logger
+from lib.utils import get_log_dir
+
+from core.conf_parameter import g_conf_parameter
+from core.feature_processor import FeatureProcessor
+
+
+def _worker_main(worker_index, config_path, regions: List[Tuple[int, Tuple[str, str, str]]], report_queue):
+    """
+    子进程入口: 重新加载配置，日志写到自己的文件，在自己的事件循环中并发同步分到的区域
+    每个区域每同步一轮，向 report_queue 发送一条报告；退出前（包括加载配置、创建 FeatureProcessor 出错时）
+    发送 {"worker": worker_index, "exit": True}
+    """
+    event_loop = None
+    processors = []
+    try:
+        g_conf_parameter.load_conf(config_path)
+
+        file_name, ext = os.path.splitext(g_conf_parameter.log_file_name)
+        logger.set_child_name('feature_sync_client_worker{}'.format(worker_index))
+        logger.set_file_path(get_log_dir())
+        logger.set_file_name("{}.worker{}{}".format(file_name, worker_index, ext))
+        logger.set_log_level(g_conf_parameter.log_level)
+        logger.set_back_count(g_conf_parameter.log_back_count)
+        logger.start()
+        logger.info("[worker{}] start, regions: {}".format(worker_index, [region for _, region in regions]))
+
+        event_loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(event_loop)
+        processors = [FeatureProcessor(*region, region_index=region_index) for region_index, region in regions]
+        event_loop.run_until_complete(asyncio.gather(
+                *[_run_region(worker_index, processor, report_queue) for processor in processors]))
+    except KeyboardInterrupt:
+        pass
+    except Exception:
+        logger.error("[worker{}] failed: {}".format(worker_index, traceback.format_exc()))
+    finally:
+        for processor in processors:
+            try:
+                event_loop.run_until_complete(processor.close())
+            except Exception:
+                logger.error(traceback.format_exc())
+        if event_loop is not None:
+            event_loop.close()
+        report_queue.put(dict(worker=worker_index, exit=True))
+        logger.info("[worker{}] exit".format(worker_index))
+
+
+async def _run_region(worker_index, processor: FeatureProcessor, report_queue):
+    region = "{}/{}/{}".format(processor.province_code, processor.city_code, processor.town_code)
+    cycle = 0
+    while True:
+        cycle += 1
+        begin = time.time()
+        error = None
+        try:
+            await processor.start()
+        except Exception:
+            error = traceback.format_exc()
+            logger.error(error)
+        cost = time.time() - begin
+
+        report_queue.put(dict(region=region,
+                              worker=worker_index,
+                              cycle=cycle,
+                              begin=str(datetime.datetime.fromtimestamp(begin)),
+                              cost=round(cost, 3),
+                              success=error is None,
+                              error=error,
+                              cloud_status=vars(processor.cloud_status) if processor.cloud_status else None,
+                              remote_status=vars(processor.remote_status) if processor.remote_status else None,
+                              cloud_database=processor.database_stats()))
+
+        if g_conf_parameter.sync_run_once == 1:
+            break
+        await asyncio.sleep(max(0, g_conf_parameter.sync_time_interval - cost))
+
+
+class RegionScheduler(object):
+    """
+    多区域同步: 区域按顺序轮流分到 workers 个子进程，每个子进程有自己的事件循环和数据库连接池，
+    主进程汇总每个区域最近一轮的状态和耗时
+    """
+    # 等待报告的超时秒数，超时后检查是否有子进程已经结束
+    poll_interval = 1.0
+
+    def __init__(self, config_path, regions: List[Tuple[str, str, str]], workers=1):
+        self._config_path = config_path
+        self._regions = list(enumerate(regions))
+        self._workers = max(1, min(workers, len(regions)))
+        self._processes = []
+        self.reports = {}  # 每个区域最近一轮的报告
+
+    def run(self):
+        report_queue = multiprocessing.Queue()
+        for worker_index in range(self._workers):
+            process = multiprocessing.Process(target=_worker_main,
+                                              name="feature_sync_worker{}".format(worker_index),
+                                              args=(worker_index, self._config_path,
+                                                    self._regions[worker_index::self._workers], report_queue))
+            process.start()
+            self._processes.append(process)
+        logger.info("[region_scheduler] start {} workers for {} regions".format(self._workers, len(self._regions)))
+
+        finished = set()
+        last_summary_cycle = 0
+        try:
+            while len(finished) < len(self._processes):
+                # 等待之前已经结束的子进程的消息都已经在队列中，等待超时说明它没有发送退出消息
+                dead = self._dead_workers(finished)
+                try:
+                    report = report_queue.get(timeout=self.poll_interval)
+                except queue.Empty:
+                    for worker_index in dead:
+                        logger.error("[region_scheduler] worker{} exited without the exit message, exitcode: {}".format(
+                                     worker_index, self._processes[worker_index].exitcode))
+                    finished.update(dead)
+                    continue
+                if report.get("exit"):
+                    finished.add(report["worker"])
+                    continue
+
+                self.reports[report["region"]] = report
+                logger.info("[region_scheduler] region: {}, worker: {}, cycle: {}, success: {}, cost: {}s, cloud: {}, remote: {}, cloud database: {}".format(
+                            report["region"], report["worker"], report["cycle"], report["success"], report["cost"],
+                            report["cloud_status"], report["remote_status"], report["cloud_database"]))
+
+                # 所有区域都完成了新的一轮时输出汇总
+                cycle = min(report["cycle"] for report in self.reports.values()) if len(self.reports) == len(self._regions) else 0
+                if cycle > last_summary_cycle:
+                    last_summary_cycle = cycle
+                    self.log_summary()
+        except KeyboardInterrupt:
+            logger.info("[region_scheduler] interrupted, wait for workers")
+        finally:
+            for process in self._processes:
+                process.join()
+            self._processes = []
+        self.log_summary()
+
+    def _dead_workers(self, finished):
+        """
+        已经结束但还没有收到退出消息的子进程
+        """
+        return [worker_index for worker_index, process in enumerate(self._processes)
+                if worker_index not in finished and not process.is_alive()]
+
+    def log_summary(self):
+        reports = list(self.reports.values())
+        failed = [report["region"] for report in reports if not report["success"]]
+        costs = [report["cost"] for report in reports]
+        logger.info("[region_scheduler] summary, regions: {}/{}, failed: {}, max cost: {}s, total cost: {}s".format(
+                    len(reports), len(self._regions), failed,
+                    max(costs) if costs else 0, round(sum(costs), 3)))
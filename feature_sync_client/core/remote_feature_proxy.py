@@ -2,8 +2,12 @@
 # -*- coding: utf-8 -*-
 
 from typing import Dict, List, Any
+import collections
 
 from lib.async_http_response_proxy import AsyncHttpClientProxy, AsyncHttpResponseProxy
+from lib.exceptions import ServerException, Error
+from lib.compression import Compression
+from lib.wire_format import WireFormat, JSON, MSGPACK, loads as wire_loads, decode_bytes_fields
 
 from core.conf_parameter import g_conf_parameter
 
@@ -11,93 +15,195 @@ from core.conf_parameter import g_conf_parameter
 class RemoteFeatureProxy(object):
     def __init__(self):
         self.feature_server_url = g_conf_parameter.remote_feature_url
+        self._session = None
+        self._compression = Compression(encodings=g_conf_parameter.compression_encodings,
+                                        level=g_conf_parameter.compression_level,
+                                        min_size=g_conf_parameter.compression_min_size)
+        self._wire_format = WireFormat([MSGPACK, JSON] if g_conf_parameter.remote_wire_format == "msgpack" else [JSON])
+        # 所有请求发送和接收的字节数，见 AsyncHttpClientProxy
+        self.transfer = collections.Counter()
+
+    def _get_client(self) -> AsyncHttpClientProxy:
+        """
+        所有请求复用同一个 session 的连接池，第一次使用时创建
+        """
+        if self._session is None or self._session.closed:
+            self._session = AsyncHttpClientProxy.create_session(
+                                            limit=g_conf_parameter.remote_pool_limit,
+                                            limit_per_host=g_conf_parameter.remote_pool_limit_per_host,
+                                            keepalive_timeout=g_conf_parameter.remote_keepalive_timeout,
+                                            dns_cache_ttl=g_conf_parameter.remote_dns_cache_ttl,
+                                            timeout=g_conf_parameter.remote_request_timeout)
+        return AsyncHttpClientProxy(session=self._session, compression=self._compression, wire_format=self._wire_format,
+                                    transfer=self.transfer)
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
 
     async def get_sync_status(self, province_code, city_code, town_code) -> Dict[Any, Any]:
         """
         获取远程的状态
         :return:
         """
-        client = AsyncHttpClientProxy()
+        client = self._get_client()
         response = await client.get(self.feature_server_url, command="get_sync_status", province_code=province_code,
                                     city_code=city_code, town_code=town_code)
-        response_data = response.json
+        response_data = response.data
         return response_data["data"]
 
-    async def query_user_id_range(self, province_code, city_code, town_code, begin_id, end_id):
-        return await self._query_info_by_id_range("query_user_id_range", province_code, city_code, town_code, begin_id, end_id)
+    async def get_range_digest(self, table, province_code, city_code, town_code, begin_id, end_id, bucket_count):
+        client = self._get_client()
+        response = await client.get(self.feature_server_url, command="get_range_digest", table=table,
+                                    province_code=province_code, city_code=city_code, town_code=town_code,
+                                    begin_id=begin_id, end_id=end_id, bucket_count=bucket_count)
+        response_data = response.data
+        if response_data.get("code", 0) != 0:
+            raise ServerException(Error.SERVER_FAILED, "get_range_digest failed: {}".format(response_data.get("desc")))
+        return response_data["data"]
+
+    async def query_user_id_range(self, province_code, city_code, town_code, begin_id, end_id, limit=1000):
+        return await self._query_info_by_id_range("query_user_id_range", province_code, city_code, town_code, begin_id, end_id, limit)
+
+    async def query_user_range(self, province_code, city_code, town_code, begin_id, end_id, limit=1000):
+        return await self._query_info_by_id_range("query_user_range", province_code, city_code, town_code, begin_id, end_id, limit)
 
-    async def query_user_range(self, province_code, city_code, town_code, begin_id, end_id):
-        return await self._query_info_by_id_range("query_user_range", province_code, city_code, town_code, begin_id, end_id)
+    async def query_user_digest_range(self, province_code, city_code, town_code, begin_id, end_id, limit=1000):
+        return await self._query_info_by_id_range("query_user_digest_range", province_code, city_code, town_code, begin_id, end_id, limit)
 
     async def add_user(self, values):
-        client = AsyncHttpClientProxy()
-        request_data = dict(
-            command="add_user",
-            values=values
-        )
-        await client.post(self.feature_server_url, json=request_data)
+        await self._post(dict(command="add_user", values=values))
 
     async def del_user_by_id(self, user_id):
-        client = AsyncHttpClientProxy()
-        request_data = dict(
-            command="del_user_by_id",
-            id=user_id
-        )
-        await client.post(self.feature_server_url, json=request_data)
+        await self._post(dict(command="del_user_by_id", id=user_id))
 
     async def update_user(self, values):
         self._print("update_user", values)
 
-        client = AsyncHttpClientProxy()
-        request_data = dict(
-            command="update_user",
-            values=values
-        )
-        await client.post(self.feature_server_url, json=request_data)
+        await self._post(dict(command="update_user", values=values))
+
+    async def add_users_batch(self, values_list) -> List[Dict[Any, Any]]:
+        return await self._post_batch("add_users_batch", values_list)
+
+    async def update_users_batch(self, values_list) -> List[Dict[Any, Any]]:
+        return await self._post_batch("update_users_batch", values_list)
 
-    async def query_feature_model_0330_id_range(self, province_code, city_code, town_code, begin_id, end_id):
-        return await self._query_info_by_id_range("query_feature_model_0330_id_range", province_code, city_code, town_code, begin_id, end_id)
+    async def query_feature_model_0330_id_range(self, province_code, city_code, town_code, begin_id, end_id, limit=1000):
+        return await self._query_info_by_id_range("query_feature_model_0330_id_range", province_code, city_code, town_code, begin_id, end_id, limit)
 
-    async def query_feature_model_0330_time_range(self, province_code, city_code, town_code, begin_id, end_id):
-        return await self._query_info_by_id_range("query_feature_model_0330_time_range", province_code, city_code, town_code, begin_id, end_id)
+    async def query_feature_model_0330_time_range(self, province_code, city_code, town_code, begin_id, end_id, limit=1000):
+        return await self._query_info_by_id_range("query_feature_model_0330_time_range", province_code, city_code, town_code, begin_id, end_id, limit)
 
-    async def query_feature_model_0330_range(self, province_code, city_code, town_code, begin_id, end_id):
-        return await self._query_info_by_id_range("query_feature_model_0330_range", province_code, city_code, town_code, begin_id, end_id)
+    async def query_feature_model_0330_range(self, province_code, city_code, town_code, begin_id, end_id, limit=1000):
+        return await self._query_info_by_id_range("query_feature_model_0330_range", province_code, city_code, town_code, begin_id, end_id, limit)
          
     async def add_feature_model_0330(self, values):
-        client = AsyncHttpClientProxy()
-        request_data = dict(
-            command="add_feature_model_0330",
-            values=values
-        )
-        await client.post(self.feature_server_url, json=request_data)
+        await self._post(dict(command="add_feature_model_0330", values=values))
 
     async def del_feature_model_0330_by_id(self, feature_id):
         self._print("del_feature_model_0330_by_id", feature_id)
 
-        client = AsyncHttpClientProxy()
-        request_data = dict(
-            command="del_feature_model_0330_by_id",
-            id=feature_id
-        )
-        await client.post(self.feature_server_url, json=request_data)
+        await self._post(dict(command="del_feature_model_0330_by_id", id=feature_id))
 
     async def update_feature_model_0330(self, values):
         self._print("update_feature_model_0330", values)
 
-        client = AsyncHttpClientProxy()
+        await self._post(dict(command="update_feature_model_0330", values=values))
+
+    async def add_feature_model_0330_batch(self, values_list) -> List[Dict[Any, Any]]:
+        return await self._post_batch("add_feature_model_0330_batch", values_list)
+
+    async def update_feature_model_0330_batch(self, values_list) -> List[Dict[Any, Any]]:
+        return await self._post_batch("update_feature_model_0330_batch", values_list)
+
+    async def batch(self, commands, fail_fast=True) -> List[Dict[Any, Any]]:
+        """
+        多条命令在服务端的一个事务中按顺序执行，commands 为 [{"command": "add_user", "values": {...}}, {"command": "del_user_by_id", "id": 1}, ...]
+        fail_fast 时任意一条失败则全部回滚并抛出异常，否则返回每一条命令的结果
+        """
+        if not commands:
+            return []
+
+        client = self._get_client()
         request_data = dict(
-            command="update_feature_model_0330",
-            values=values
+            command="batch",
+            fail_fast=1 if fail_fast else 0,
+            commands=commands
         )
-        await client.post(self.feature_server_url, json=request_data)
+        response = await client.post(self.feature_server_url, body=request_data)
+        response_data = response.data
+        if response_data.get("code", 0) != 0:
+            errors = [result for result in response_data.get("data") or [] if result.get("code") == 102]
+            raise ServerException(Error.SERVER_FAILED, "batch failed: {}, {}".format(response_data.get("desc"), errors[:1]))
+        return response_data["data"]
 
-    async def _query_info_by_id_range(self, command, province_code, city_code, town_code, begin_id, end_id):
-        client = AsyncHttpClientProxy()
+    async def _post_batch(self, command, values_list):
+        """
+        一页数据一次 POST，返回每一行的结果 [{"code": 0, "desc": "sucess", "data": id}, ...]
+        """
+        if not values_list:
+            return []
+        return await self._post(dict(command=command, values=values_list))
+
+    async def _post(self, request_data):
+        """
+        写请求，响应的 code 不为 0 时抛出异常，返回响应的 data
+        """
+        client = self._get_client()
+        response = await client.post(self.feature_server_url, body=request_data)
+        response_data = response.data
+        if response_data.get("code", 0) != 0:
+            raise ServerException(Error.SERVER_FAILED, "{} failed: {}".format(request_data["command"], response_data.get("desc")))
+        return response_data.get("data")
+
+    async def _query_info_by_id_range(self, command, province_code, city_code, town_code, begin_id, end_id, limit=1000):
+        client = self._get_client()
         response = await client.get(self.feature_server_url, command=command,
-                        province_code=province_code, city_code=city_code, town_code=town_code, begin_id=begin_id, end_id=end_id)
-        response_data = response.json
-        return response_data["data"]
+                        province_code=province_code, city_code=city_code, town_code=town_code, begin_id=begin_id, end_id=end_id,
+                        limit=limit)
+        response_data = response.data
+        return self._decode_rows(response_data["data"])
+
+    async def export_user_range(self, province_code, city_code, town_code, begin_id, end_id):
+        async for row in self._export_range("export_user_range", province_code, city_code, town_code, begin_id, end_id):
+            yield row
+
+    async def export_user_digest_range(self, province_code, city_code, town_code, begin_id, end_id):
+        async for row in self._export_range("export_user_digest_range", province_code, city_code, town_code, begin_id, end_id):
+            yield row
+
+    async def export_feature_model_0330_time_range(self, province_code, city_code, town_code, begin_id, end_id):
+        async for row in self._export_range("export_feature_model_0330_time_range",
+                                            province_code, city_code, town_code, begin_id, end_id):
+            yield row
+
+    async def _export_range(self, command, province_code, city_code, town_code, begin_id, end_id):
+        """
+        一个请求流式读取 (begin_id, end_id] 内的所有行，按 id 顺序逐行返回
+        服务端最后一行是结果 {"code": 0, "desc": "sucess", "data": 行数}，没有读到结果说明数据不完整
+        """
+        client = self._get_client()
+        url = "{}/export".format(self.feature_server_url.rstrip("/"))
+        async for line in client.get_lines(url, command=command, province_code=province_code, city_code=city_code,
+                                           town_code=town_code, begin_id=begin_id, end_id=end_id):
+            row = wire_loads(line)
+            if "code" in row:
+                if row["code"] != 0:
+                    raise ServerException(Error.SERVER_FAILED, "{} failed: {}".format(command, row.get("desc")))
+                return
+            yield self._decode_rows([row])[0]
+
+        raise ServerException(Error.SERVER_FAILED, "{} interrupted, ({}, {}]".format(command, begin_id, end_id))
+
+    @staticmethod
+    def _decode_rows(rows):
+        """
+        json 响应中的 pic_md5 / feature 是 base64，还原成和云端查询结果一样的 bytes；请求中的 bytes 由 wire_format 编码
+        """
+        for row in rows or []:
+            decode_bytes_fields(row)
+        return rows
 
     def _print(self, func, data):
         print("============ in {} ==========".format(func))
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from lib.testing import run
+
+from core.change_source import ChangeSource, ChangeLogChangeSource
+from core.checkpoint_store import CheckpointStore
+
+REGION = "320000/321000/321084"
+
+
+def change_log(log_id, table, action, row_id, town_code="321084", old_town_code=None):
+    return dict(id=log_id, table_name=table, action=action, row_id=row_id, user_id=row_id,
+                province_code="320000", city_code="321000", town_code=town_code,
+                old_province_code="320000" if old_town_code else None, old_city_code="321000" if old_town_code else None,
+                old_town_code=old_town_code)
+
+
+class CloudProxy(object):
+    """
+    代替 CloudFeatureProxy: 变更日志和当前区域内的行
+    """
+    def __init__(self, logs, rows):
+        self._logs = logs
+        self._rows = rows
+
+    async def get_max_change_log_id(self):
+        return self._logs[-1]["id"] if self._logs else -1
+
+    async def query_change_log(self, begin_id, limit):
+        return [log for log in self._logs if log["id"] > begin_id][:limit]
+
+    async def query_user_by_ids(self, province_code, city_code, town_code, ids):
+        return [self._rows[_id] for _id in ids if _id in self._rows]
+
+    async def query_feature_model_0330_by_ids(self, province_code, city_code, town_code, ids):
+        return []
+
+
+class ChangeLogChangeSourceTest(unittest.TestCase):
+    def source(self, logs, rows, position=0):
+        store = CheckpointStore()
+        if position is not None:
+            store.set_value(REGION, ChangeSource.position_name, dict(change_log_id=position))
+        return ChangeLogChangeSource(CloudProxy(logs, rows), store, REGION, "320000", "321000", "321084"), store
+
+    def test_events(self):
+        logs = [change_log(1, "user", "insert", 1),
+                change_log(2, "user", "update", 2, old_town_code="321084"),
+                change_log(3, "user", "delete", 3),
+                change_log(4, "user", "insert", 4, town_code="321085"),
+                change_log(5, "sync_other", "insert", 5)]
+        source, store = self.source(logs, {1: dict(id=1), 2: dict(id=2)})
+        events = run(lambda: source.read_events(10))
+        self.assertEqual([(event.action, event.row_id) for event in events], [("insert", 1), ("update", 2), ("delete", 3)])
+        self.assertEqual(events[0].values, dict(id=1))
+
+        self.assertTrue(source.commit())
+        self.assertEqual(store.get_value(REGION, ChangeSource.position_name), dict(change_log_id=5))
+
+    def test_update_out_of_region_is_delete(self):
+        logs = [change_log(1, "user", "update", 1, town_code="321085", old_town_code="321084"),
+                change_log(2, "user", "update", 2, town_code="321085", old_town_code="321086"),
+                change_log(3, "user", "update", 3, town_code="321084", old_town_code="321085")]
+        source, _ = self.source(logs, {3: dict(id=3)})
+        events = run(lambda: source.read_events(10))
+        self.assertEqual([(event.action, event.row_id) for event in events], [("delete", 1), ("update", 3)])
+
+    def test_first_run_starts_from_head(self):
+        source, store = self.source([change_log(1, "user", "insert", 1), change_log(2, "user", "insert", 2)], {}, position=None)
+        self.assertEqual(run(lambda: source.read_events(10)), [])
+        self.assertTrue(source.commit())
+        self.assertEqual(store.get_value(REGION, ChangeSource.position_name), dict(change_log_id=2))
+        self.assertEqual(run(lambda: source.read_events(10)), [])
+        self.assertFalse(source.commit())
+
+    def test_reset_reads_again(self):
+        source, store = self.source([change_log(1, "user", "insert", 1)], {1: dict(id=1)})
+        self.assertEqual(len(run(lambda: source.read_events(10))), 1)
+        source.reset()
+        self.assertFalse(source.commit())
+        self.assertEqual(store.get_value(REGION, ChangeSource.position_name), dict(change_log_id=0))
+        self.assertEqual(len(run(lambda: source.read_events(10))), 1)
+
+    def test_abstract(self):
+        with self.assertRaises(TypeError):
+            ChangeSource(CloudProxy([], {}), CheckpointStore(), REGION, "320000", "321000", "321084")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import tempfile
+import unittest
+
+from lib.testing import run
+
+from core.checkpoint_store import CheckpointStore, PassProgress
+from core.page_pipeline import Page
+
+REGION = "320000/321000/321084"
+
+
+class Flush(object):
+    """
+    代替 WritePipeline.join，按调用的顺序返回 failures 中的失败 keys
+    """
+    def __init__(self, failures=None):
+        self._failures = list(failures or [])
+        self.count = 0
+
+    async def __call__(self):
+        self.count += 1
+        return self._failures.pop(0) if self._failures else []
+
+
+def page(end_id):
+    return Page(end_id - 10, end_id, [], [])
+
+
+class CheckpointStoreTest(unittest.TestCase):
+    def test_save_and_load(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "checkpoint")
+            store = CheckpointStore(path)
+            store.set_watermark(REGION, "user", "merge", 120)
+            store.set_value(REGION, "cdc_position", dict(change_log_id=7))
+            store.save()
+            store = CheckpointStore(path)
+
+        self.assertEqual(store.get_watermark(REGION, "user", "merge"), 120)
+        self.assertEqual(store.get_watermark(REGION, "feature_model_0330", "merge"), -1)
+        self.assertEqual(store.get_value(REGION, "cdc_position"), dict(change_log_id=7))
+        self.assertTrue(store.has_pending_pass(REGION))
+
+
+class PassProgressTest(unittest.TestCase):
+    ranges = [(-1, 100), (200, 300)]
+
+    def progress(self, store, flush, save_pages=2, max_pages=0):
+        return PassProgress(store, REGION, "user", "merge", self.ranges, flush, save_pages=save_pages, max_pages=max_pages)
+
+    def test_clip(self):
+        self.assertEqual(PassProgress._clip(self.ranges, -1), self.ranges)
+        self.assertEqual(PassProgress._clip(self.ranges, 50), [(50, 100), (200, 300)])
+        self.assertEqual(PassProgress._clip(self.ranges, 100), [(200, 300)])
+        self.assertEqual(PassProgress._clip(self.ranges, 250), [(250, 300)])
+        self.assertEqual(PassProgress._clip(self.ranges, 300), [])
+
+    def test_resume(self):
+        store = CheckpointStore()
+        store.set_watermark(REGION, "user", "merge", 250)
+        self.assertEqual(self.progress(store, Flush()).ranges, [(250, 300)])
+
+        # 上一轮已经到末尾，从头开始
+        store.set_watermark(REGION, "user", "merge", 300)
+        self.assertEqual(self.progress(store, Flush()).ranges, self.ranges)
+
+    def test_advance_save_and_finish(self):
+        async def main():
+            store = CheckpointStore()
+            flush = Flush()
+            progress = self.progress(store, flush, save_pages=2)
+            self.assertFalse(await progress.advance(page(10)))
+            self.assertEqual(store.get_watermark(REGION, "user", "merge"), -1)
+            self.assertFalse(await progress.advance(page(20)))
+            self.assertEqual(store.get_watermark(REGION, "user", "merge"), 20)
+            await progress.finish()
+            return store, flush
+
+        store, flush = run(main)
+        self.assertEqual(store.get_watermark(REGION, "user", "merge"), -1)
+        self.assertEqual(flush.count, 2)
+
+    def test_max_pages(self):
+        async def main():
+            store = CheckpointStore()
+            progress = self.progress(store, Flush(), save_pages=10, max_pages=2)
+            stopped = [await progress.advance(page(10)), await progress.advance(page(20))]
+            await progress.finish()
+            return store, stopped
+
+        store, stopped = run(main)
+        self.assertEqual(stopped, [False, True])
+        self.assertEqual(store.get_watermark(REGION, "user", "merge"), 20)
+
+    def test_failed_writes_keep_watermark(self):
+        async def main():
+            store = CheckpointStore()
+            progress = self.progress(store, Flush([[], [("user", 15)]]), save_pages=1)
+            await progress.advance(page(10))
+            await progress.advance(page(20))
+            await progress.advance(page(30))
+            await progress.finish()
+            return store
+
+        # 第二页有写失败，水位停在第一页，本轮之后的页和 finish 都不再保存
+        self.assertEqual(run(main).get_watermark(REGION, "user", "merge"), 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from core.diff_engine import merge_join
+
+
+def is_changed(cloud_row, remote_row):
+    return cloud_row["timestamp"] != remote_row["timestamp"]
+
+
+def ids(rows):
+    return [row["id"] for row in rows]
+
+
+class MergeJoinTest(unittest.TestCase):
+    def test_insert_delete_update(self):
+        cloud_rows = [dict(id=1, timestamp=1), dict(id=2, timestamp=2), dict(id=4, timestamp=4), dict(id=6, timestamp=6)]
+        remote_rows = [dict(id=2, timestamp=2), dict(id=3, timestamp=3), dict(id=4, timestamp=0), dict(id=7, timestamp=7)]
+        result = merge_join(cloud_rows, remote_rows, is_changed)
+        self.assertEqual(ids(result.inserts), [1, 6])
+        self.assertEqual(ids(result.deletes), [3, 7])
+        self.assertEqual(ids(result.updates), [4])
+        # 更新使用云端的行
+        self.assertEqual(result.updates[0]["timestamp"], 4)
+
+    def test_unsorted_input(self):
+        cloud_rows = [dict(id=5, timestamp=5), dict(id=1, timestamp=1), dict(id=3, timestamp=3)]
+        remote_rows = [dict(id=3, timestamp=0), dict(id=2, timestamp=2)]
+        result = merge_join(cloud_rows, remote_rows, is_changed)
+        self.assertEqual(ids(result.inserts), [1, 5])
+        self.assertEqual(ids(result.deletes), [2])
+        self.assertEqual(ids(result.updates), [3])
+
+    def test_one_side_empty(self):
+        rows = [dict(id=1, timestamp=1), dict(id=2, timestamp=2)]
+        result = merge_join(rows, [], is_changed)
+        self.assertEqual((ids(result.inserts), result.deletes, result.updates), ([1, 2], [], []))
+        result = merge_join([], rows, is_changed)
+        self.assertEqual((result.inserts, ids(result.deletes), result.updates), ([], [1, 2], []))
+
+    def test_identical(self):
+        rows = [dict(id=_id, timestamp=_id) for _id in range(10)]
+        result = merge_join(rows, [dict(row) for row in rows], is_changed)
+        self.assertEqual((result.inserts, result.deletes, result.updates), ([], [], []))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import unittest
+import collections
+from unittest import mock
+
+from lib.testing import run
+
+from core.conf_parameter import g_conf_parameter
+from core.feature_processor import FeatureProcessor
+from core.change_source import ChangeEvent
+from core.checkpoint_store import CheckpointStore
+from core.cycle_report import CycleReport
+from core.write_pipeline import AimdWindow, WritePipeline
+
+
+class FakeChangeSource(object):
+    """
+    每次从保存的位置读到末尾，commit 保存位置，reset 放弃
+    """
+    def __init__(self, events):
+        self.events = events
+        self.position = 0
+        self._pending_position = None
+
+    async def read_events(self, batch_size):
+        events = self.events[self.position:self.position + batch_size]
+        self._pending_position = self.position + len(events) if events else None
+        return events
+
+    def commit(self):
+        if self._pending_position is None:
+            return False
+        self.position, self._pending_position = self._pending_position, None
+        return True
+
+    def reset(self):
+        self._pending_position = None
+
+
+class FakeRemoteFeatureProxy(object):
+    """
+    记录 batch 请求，failing_ids 中的行一直返回 102
+    """
+    def __init__(self, failing_ids=()):
+        self.failing_ids = set(failing_ids)
+        self.requests = []
+
+    async def batch(self, commands, fail_fast=True):
+        self.requests.append((commands, fail_fast))
+        results = []
+        for command in commands:
+            _id = command["values"]["id"] if "values" in command else command["id"]
+            results.append(dict(code=102, desc="failed", data=_id) if _id in self.failing_ids else dict(code=0, desc="sucess", data=_id))
+        return results
+
+
+def user_event(action, _id):
+    values = None if action == "delete" else dict(id=_id, uid="uid{}".format(_id), province_code="320000")
+    return ChangeEvent("user", action, _id, values=values)
+
+
+class SyncChangesTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.multiple(g_conf_parameter, create=True, cdc_batch_size=100, cdc_max_retries=3)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def processor(remote, change_source):
+        # 不经过 __init__，不需要配置和云端数据库
+        processor = FeatureProcessor.__new__(FeatureProcessor)
+        processor._region = "320000/321000/-1"
+        processor._remote_feature_proxy = remote
+        processor._change_source = change_source
+        processor._checkpoint_store = CheckpointStore()
+        processor._write_pipeline = WritePipeline(AimdWindow(initial_size=4))
+        processor._cdc_failures = 0
+        processor._last_full_scan_time = time.time()
+        return processor
+
+    @staticmethod
+    def sync_changes(processor):
+        processor._write_pipeline.reset()
+        processor._report = CycleReport(processor._region, collections.Counter())
+        run(processor.sync_changes)
+        return processor._report.to_dict()
+
+    def test_upsert_commands(self):
+        # 插入和更新都是 upsert，重新读取同一批时重复执行的结果相同
+        events = [user_event("insert", 1), user_event("update", 1), user_event("update", 2), user_event("delete", 3)]
+        remote = FakeRemoteFeatureProxy()
+        source = FakeChangeSource(events)
+        self.sync_changes(self.processor(remote, source))
+
+        self.assertEqual([(command["command"], command.get("id") or command["values"]["id"])
+                          for commands, _ in remote.requests for command in commands],
+                         [("upsert_user", 1), ("upsert_user", 2), ("del_user_by_id", 3)])
+        self.assertEqual({fail_fast for _, fail_fast in remote.requests}, {False})
+        self.assertEqual(source.position, 4)
+
+    def test_skip_after_retries(self):
+        events = [user_event("insert", 1), user_event("insert", 2)]
+        remote = FakeRemoteFeatureProxy(failing_ids=[2])
+        source = FakeChangeSource(events)
+        processor = self.processor(remote, source)
+
+        for _ in range(2):
+            self.sync_changes(processor)
+            self.assertEqual(source.position, 0)
+            self.assertIsNone(processor._checkpoint_store.get_value(processor._region, "cdc_skipped"))
+
+        report = self.sync_changes(processor)
+        self.assertEqual(source.position, 2)
+        self.assertEqual(len(remote.requests), 3)
+        skipped = processor._checkpoint_store.get_value(processor._region, "cdc_skipped")
+        self.assertEqual((skipped["keys"], skipped["count"]), ([["user", 2]], 1))
+        changes = [pass_report for pass_report in report["passes"] if pass_report["name"] == "changes"][0]
+        self.assertEqual(changes["operations"]["skipped"], 1)
+        # 这一轮立即全量对比，失败的行不再阻止之后的写
+        self.assertEqual(processor._last_full_scan_time, 0)
+        self.assertEqual(processor._cdc_failures, 0)
+
+        # 之后的变更正常写入
+        source.events.append(user_event("update", 1))
+        self.sync_changes(processor)
+        self.assertEqual(source.position, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
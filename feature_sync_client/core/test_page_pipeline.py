@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from lib.testing import run
+
+from core.page_pipeline import PagePipeline, PageSizer
+
+
+def range_query(rows):
+    async def query(begin_id, end_id, limit):
+        return [row for row in rows if begin_id < row["id"] <= end_id][:limit]
+    return query
+
+
+def range_stream(rows):
+    async def stream(begin_id, end_id):
+        for row in rows:
+            if begin_id < row["id"] <= end_id:
+                yield row
+    return stream
+
+
+class PageSizerTest(unittest.TestCase):
+    def sizer(self):
+        return PageSizer(initial_size=1000, min_size=100, max_size=20000, target_bytes=4 * 1024 * 1024, target_latency=1.0)
+
+    def test_double_when_small_and_fast(self):
+        sizer = self.sizer()
+        sizer.on_page(1000, 100 * 1000, 0.1, True)
+        self.assertEqual(sizer.size, 2000)
+
+    def test_bytes_target(self):
+        sizer = self.sizer()
+        sizer.on_page(1000, 6 * 1024 * 1024, 0.1, True)
+        self.assertEqual(sizer.size, 666)
+
+    def test_latency_target(self):
+        sizer = self.sizer()
+        sizer.on_page(1000, 1000, 1.25, True)
+        self.assertEqual(sizer.size, 800)
+
+    def test_halve_at_most(self):
+        sizer = self.sizer()
+        sizer.on_page(1000, 1000, 100.0, True)
+        self.assertEqual(sizer.size, 500)
+
+    def test_no_grow_when_not_full(self):
+        sizer = self.sizer()
+        sizer.on_page(10, 100, 0.01, False)
+        self.assertEqual(sizer.size, 1000)
+
+    def test_empty_page(self):
+        sizer = self.sizer()
+        sizer.on_page(0, 0, 0.5, False)
+        self.assertEqual(sizer.size, 1000)
+
+    def test_bounds(self):
+        sizer = PageSizer(initial_size=150, min_size=100, max_size=200)
+        sizer.on_page(150, 1, 0.01, True)
+        self.assertEqual(sizer.size, 200)
+        for _ in range(3):
+            sizer.on_page(200, 1, 100.0, True)
+        self.assertEqual(sizer.size, 100)
+        self.assertEqual(PageSizer(initial_size=50000, min_size=100, max_size=200).size, 200)
+
+
+class PagePipelineTest(unittest.TestCase):
+    cloud_rows = [dict(id=_id) for _id in (1, 2, 3, 5, 8, 9, 10, 11, 20)]
+    remote_rows = [dict(id=_id) for _id in (2, 4, 5, 6, 7, 9, 12, 30)]
+
+    def collect(self, ranges, remote_stream=False):
+        async def main():
+            pipeline = PagePipeline(range_query(self.cloud_rows),
+                                    None if remote_stream else range_query(self.remote_rows),
+                                    ranges, prefetch=2, page_sizer=PageSizer(3, 3, 3),
+                                    remote_stream=range_stream(self.remote_rows) if remote_stream else None)
+            return [page async for page in pipeline.pages()], pipeline.page_count
+        return run(main)
+
+    def assert_aligned(self, pages, ranges):
+        for page in pages:
+            for row in page.cloud_rows + page.remote_rows:
+                self.assertTrue(page.begin_id < row["id"] <= page.end_id, "{} not in {}".format(row, page))
+        in_ranges = lambda rows: [row["id"] for row in rows if any(begin < row["id"] <= end for begin, end in ranges)]
+        self.assertEqual([row["id"] for page in pages for row in page.cloud_rows], in_ranges(self.cloud_rows))
+        self.assertEqual([row["id"] for page in pages for row in page.remote_rows], in_ranges(self.remote_rows))
+
+    def test_pages_cover_both_sides(self):
+        ranges = [(-1, 100)]
+        pages, page_count = self.collect(ranges)
+        self.assert_aligned(pages, ranges)
+        self.assertEqual(page_count, len(pages))
+        self.assertTrue(all(len(page.cloud_rows) <= 3 and len(page.remote_rows) <= 3 for page in pages))
+
+    def test_only_ranges(self):
+        ranges = [(-1, 3), (8, 12)]
+        pages, _ = self.collect(ranges)
+        self.assert_aligned(pages, ranges)
+
+    def test_remote_stream(self):
+        ranges = [(-1, 6), (6, 100)]
+        pages, _ = self.collect(ranges, remote_stream=True)
+        self.assert_aligned(pages, ranges)
+
+    def test_error_raised(self):
+        async def fail(begin_id, end_id, limit):
+            raise RuntimeError("query failed")
+
+        async def main():
+            pipeline = PagePipeline(range_query(self.cloud_rows), fail, [(-1, 100)])
+            return [page async for page in pipeline.pages()]
+
+        with self.assertRaises(RuntimeError):
+            run(main)
+
+
+if __name__ == '__main__':
+    unittest.main()
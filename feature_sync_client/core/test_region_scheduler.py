@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import unittest
+from unittest import mock
+
+from core import region_scheduler
+from core.region_scheduler import RegionScheduler
+
+REGIONS = [("320000", "321000", "321084"), ("320000", "321000", "321085")]
+
+
+def killed_worker(worker_index, config_path, regions, report_queue):
+    os._exit(1)
+
+
+class RegionSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(RegionScheduler, "poll_interval", 0.1)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_worker_fails_to_start(self):
+        # 配置文件不存在，子进程在创建 FeatureProcessor 之前出错，仍然发送退出消息
+        scheduler = RegionScheduler("/nonexistent/feature_sync_client.conf", REGIONS, workers=2)
+        scheduler.run()
+        self.assertEqual(scheduler.reports, {})
+
+    def test_worker_killed(self):
+        with mock.patch.object(region_scheduler, "_worker_main", killed_worker):
+            scheduler = RegionScheduler("/nonexistent/feature_sync_client.conf", REGIONS, workers=2)
+            scheduler.run()
+        self.assertEqual(scheduler.reports, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from lib import wire_format
+from lib.testing import run
+from lib.exceptions import ServerException
+from lib.wire_format import JSON, MSGPACK, decode_bytes_fields
+
+from core.remote_feature_proxy import RemoteFeatureProxy
+
+FEATURE = bytes(range(256)) * 4
+
+
+def feature_row():
+    return dict(id=1, user_id=2, timestamp=3, feature_id=0, feature=FEATURE, province_code="320000")
+
+
+class WireFormatTest(unittest.TestCase):
+    formats = [JSON, MSGPACK] if wire_format.msgpack is not None else [JSON]
+
+    def test_decode_rows(self):
+        # 服务端的响应（query_*_range 和 export_*_range 的每一行）
+        for content_type in self.formats:
+            data = wire_format.loads(wire_format.dumps(dict(code=0, data=[feature_row()]), content_type), content_type)
+            self.assertEqual(RemoteFeatureProxy._decode_rows(data["data"]), [feature_row()], content_type)
+        line = wire_format.json_dumps(feature_row())
+        self.assertEqual(RemoteFeatureProxy._decode_rows([wire_format.loads(line)]), [feature_row()])
+
+    def test_request_values(self):
+        # post(body=...) 按协商的格式编码，服务端用同样的 decode_bytes_fields 还原
+        for content_type in self.formats:
+            body = dict(command="add_feature_model_0330_batch", values=[feature_row()])
+            data = wire_format.loads(wire_format.dumps(body, content_type), content_type)
+            self.assertEqual([decode_bytes_fields(values) for values in data["values"]], [feature_row()], content_type)
+
+
+class FakeResponse(object):
+    def __init__(self, data):
+        self.data = data
+
+
+class FakeClient(object):
+    """
+    记录 POST 的请求，按顺序返回 responses
+    """
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    async def post(self, url, body=None):
+        self.requests.append(body)
+        return FakeResponse(self.responses.pop(0))
+
+
+class WriteTest(unittest.TestCase):
+    @staticmethod
+    def proxy(client):
+        # 不经过 __init__，不需要配置
+        proxy = RemoteFeatureProxy.__new__(RemoteFeatureProxy)
+        proxy.feature_server_url = "http://127.0.0.1:8000/feature"
+        proxy._print = lambda func, data: None
+        proxy._get_client = lambda: client
+        return proxy
+
+    def single_row_writes(self, proxy):
+        return [
+            ("add_user", lambda: proxy.add_user(dict(id=1))),
+            ("update_user", lambda: proxy.update_user(dict(id=1))),
+            ("del_user_by_id", lambda: proxy.del_user_by_id(1)),
+            ("add_feature_model_0330", lambda: proxy.add_feature_model_0330(feature_row())),
+            ("update_feature_model_0330", lambda: proxy.update_feature_model_0330(feature_row())),
+            ("del_feature_model_0330_by_id", lambda: proxy.del_feature_model_0330_by_id(1)),
+        ]
+
+    def test_single_row_success(self):
+        client = FakeClient([dict(code=0, desc="sucess", data=1)] * 6)
+        proxy = self.proxy(client)
+        for command, write in self.single_row_writes(proxy):
+            run(write)
+        self.assertEqual([request["command"] for request in client.requests],
+                         [command for command, _ in self.single_row_writes(proxy)])
+
+    def test_single_row_failure(self):
+        # 服务端单行写的异常（如没有影响任何行）返回 code 100
+        client = FakeClient([dict(code=100, desc="not found row")] * 6)
+        proxy = self.proxy(client)
+        for command, write in self.single_row_writes(proxy):
+            with self.assertRaises(ServerException, msg=command) as context:
+                run(write)
+            self.assertIn(command, str(context.exception.args))
+
+    def test_batch_failure(self):
+        proxy = self.proxy(FakeClient([dict(code=101, desc="no support command")]))
+        with self.assertRaises(ServerException):
+            run(lambda: proxy.add_users_batch([dict(id=1)]))
+
+
+if __name__ == '__main__':
+    unittest.main()
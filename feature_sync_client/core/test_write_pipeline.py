@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import unittest
+
+from lib.testing import run
+
+from core.write_pipeline import AimdWindow, WritePipeline
+
+
+class AimdWindowTest(unittest.TestCase):
+    def test_grow_one_per_window(self):
+        window = AimdWindow(min_size=1, max_size=32, initial_size=4, latency_target=2.0)
+        for _ in range(4):
+            window.on_success(0.1)
+        self.assertEqual(window.limit, 4)
+        window.on_success(0.1)
+        self.assertEqual(window.limit, 5)
+
+    def test_halve_once_per_latency_target(self):
+        window = AimdWindow(initial_size=8, latency_target=2.0)
+        window.on_error()
+        self.assertEqual(window.limit, 4)
+        window.on_error()
+        self.assertEqual(window.limit, 4)
+
+    def test_slow_ack_decrease(self):
+        window = AimdWindow(initial_size=8, latency_target=0.5)
+        window.on_success(1.0)
+        self.assertEqual(window.limit, 4)
+
+    def test_bounds(self):
+        window = AimdWindow(min_size=2, max_size=3, initial_size=10, latency_target=0)
+        self.assertEqual(window.limit, 3)
+        window.on_success(0)
+        self.assertEqual(window.limit, 3)
+        window.on_error()
+        window.on_error()
+        self.assertEqual(window.limit, 2)
+
+
+class WritePipelineTest(unittest.TestCase):
+    def test_dependency_order(self):
+        async def main():
+            pipeline = WritePipeline(AimdWindow(initial_size=4))
+            order = []
+
+            async def write(name, delay):
+                await asyncio.sleep(delay)
+                order.append(name)
+
+            await pipeline.submit("user", write, "user", 0.02, keys=[("user", 1)])
+            await pipeline.submit("feature", write, "feature", 0, keys=[("feature_model_0330", 1)], after=[("user", 1)])
+            self.assertEqual(await pipeline.join(), [])
+            return order
+
+        self.assertEqual(run(main), ["user", "feature"])
+
+    def test_raised_failure_skips_dependents(self):
+        async def main():
+            pipeline = WritePipeline(AimdWindow(initial_size=4))
+            written = []
+
+            async def fail():
+                raise RuntimeError("server error")
+
+            async def write(name):
+                written.append(name)
+
+            await pipeline.submit("user", fail, keys=[("user", 1), ("user", 2)])
+            await pipeline.submit("feature", write, "feature", keys=[("feature_model_0330", 1)], after=[("user", 2)])
+            failed_keys = await pipeline.join()
+            return written, failed_keys, pipeline.error_count
+
+        written, failed_keys, error_count = run(main)
+        self.assertEqual(written, [])
+        self.assertEqual(set(failed_keys), {("user", 1), ("user", 2), ("feature_model_0330", 1)})
+        self.assertEqual(error_count, 1)
+
+    def test_partial_failure_only_marks_returned_keys(self):
+        async def main():
+            window = AimdWindow(initial_size=8)
+            pipeline = WritePipeline(window)
+            written = []
+
+            async def users():
+                await asyncio.sleep(0.01)
+                return [("user", 2)]
+
+            async def write(name):
+                written.append(name)
+
+            await pipeline.submit("users", users, keys=[("user", 1), ("user", 2)])
+            await pipeline.submit("feature 1", write, 1, keys=[("feature_model_0330", 1)], after=[("user", 1)])
+            await pipeline.submit("feature 2", write, 2, keys=[("feature_model_0330", 2)], after=[("user", 2)])
+            failed_keys = await pipeline.join()
+            return written, failed_keys, window.limit, await pipeline.join()
+
+        written, failed_keys, limit, failed_keys_again = run(main)
+        self.assertEqual(written, [1])
+        self.assertEqual(set(failed_keys), {("user", 2), ("feature_model_0330", 2)})
+        self.assertEqual(limit, 4)
+        self.assertEqual(failed_keys_again, [])
+
+    def test_failed_key_before_submit(self):
+        async def main():
+            pipeline = WritePipeline(AimdWindow(initial_size=4))
+            written = []
+
+            async def users():
+                return [("user", 1)]
+
+            async def write(name):
+                written.append(name)
+
+            await pipeline.submit("users", users, keys=[("user", 1), ("user", 2)])
+            await asyncio.sleep(0.01)
+            # user 的写已经完成并失败，之后提交的 feature 也不会发起
+            await pipeline.submit("feature", write, 1, keys=[("feature_model_0330", 1)], after=[("user", 1)])
+            return written, await pipeline.join()
+
+        written, failed_keys = run(main)
+        self.assertEqual(written, [])
+        self.assertEqual(set(failed_keys), {("user", 1), ("feature_model_0330", 1)})
+
+    def test_failed_key_across_join(self):
+        async def main():
+            pipeline = WritePipeline(AimdWindow(initial_size=4))
+            written = []
+
+            async def users():
+                return [("user", 1)]
+
+            async def write(name):
+                written.append(name)
+
+            # user 阶段保存水位时 join 了一次，feature 阶段仍然不写失败的 user 的 feature
+            await pipeline.submit("users", users, keys=[("user", 1), ("user", 2)])
+            user_failed_keys = await pipeline.join()
+            await pipeline.submit("feature 1", write, 1, keys=[("feature_model_0330", 1)], after=[("user", 1)])
+            await pipeline.submit("feature 2", write, 2, keys=[("feature_model_0330", 2)], after=[("user", 2)])
+            feature_failed_keys = await pipeline.join()
+
+            # 下一轮开始时清除
+            pipeline.reset()
+            await pipeline.submit("feature 1", write, 1, keys=[("feature_model_0330", 1)], after=[("user", 1)])
+            return written, user_failed_keys, feature_failed_keys, await pipeline.join()
+
+        written, user_failed_keys, feature_failed_keys, failed_keys = run(main)
+        self.assertEqual(user_failed_keys, [("user", 1)])
+        self.assertEqual(feature_failed_keys, [("feature_model_0330", 1)])
+        self.assertEqual(written, [2, 1])
+        self.assertEqual(failed_keys, [])
+
+    def test_failed_key_written_again(self):
+        async def main():
+            pipeline = WritePipeline(AimdWindow(initial_size=4))
+            written = []
+
+            async def fail():
+                raise RuntimeError("server error")
+
+            async def write(name):
+                written.append(name)
+
+            await pipeline.submit("user", fail, keys=[("user", 1)])
+            await pipeline.join()
+            # 同一轮中 user 再次写入成功后，它的 feature 可以写
+            await pipeline.submit("user", write, "user", keys=[("user", 1)])
+            await pipeline.submit("feature", write, "feature", keys=[("feature_model_0330", 1)], after=[("user", 1)])
+            return written, await pipeline.join()
+
+        self.assertEqual(run(main), (["user", "feature"], []))
+
+    def test_in_flight_limit(self):
+        async def main():
+            pipeline = WritePipeline(AimdWindow(min_size=1, max_size=2, initial_size=2, latency_target=10))
+            in_flight = [0, 0]
+
+            async def write():
+                in_flight[0] += 1
+                in_flight[1] = max(in_flight[1], in_flight[0])
+                await asyncio.sleep(0.01)
+                in_flight[0] -= 1
+
+            for i in range(6):
+                await pipeline.submit("write", write, keys=[("user", i)])
+            await pipeline.join()
+            return in_flight[1], pipeline.submit_count
+
+        self.assertEqual(run(main), (2, 6))
+
+
+if __name__ == '__main__':
+    unittest.main()
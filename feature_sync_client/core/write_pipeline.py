@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import functools
+import time
+import traceback
+from typing import List, Any
+
+from lib.logger import logger
+
+
+class AimdWindow(object):
+    """
+    AIMD 并发窗口: 请求成功且延迟低于目标时线性增长（每确认一个窗口的请求 +1），
+    出错或延迟超过目标时减半，一个延迟周期内只减一次
+    """
+    def __init__(self, min_size=1, max_size=32, initial_size=4, latency_target=2.0, decrease_factor=0.5):
+        self._min_size = max(1, min_size)
+        self._max_size = max(self._min_size, max_size)
+        self._size = float(min(max(initial_size, self._min_size), self._max_size))
+        self._latency_target = latency_target
+        self._decrease_factor = decrease_factor
+        self._last_decrease_time = 0
+
+    @property
+    def limit(self):
+        return int(self._size)
+
+    def on_success(self, latency):
+        if latency > self._latency_target:
+            self._decrease("latency {}s > {}s".format(round(latency, 3), self._latency_target))
+        else:
+            self._resize(min(self._max_size, self._size + 1.0 / self._size), "ack")
+
+    def on_error(self):
+        self._decrease("error")
+
+    def _decrease(self, reason):
+        now = time.time()
+        if now - self._last_decrease_time < self._latency_target:
+            return
+        self._last_decrease_time = now
+        self._resize(max(self._min_size, self._size * self._decrease_factor), reason)
+
+    def _resize(self, size, reason):
+        old_limit = self.limit
+        self._size = size
+        if self.limit != old_limit:
+            logger.info("[write_pipeline] window {} -> {}, reason: {}".format(old_limit, self.limit, reason))
+
+
+class WritePipeline(object):
+    """
+    远程写操作的并发流水线，最多同时有 window.limit 个写请求在途
+    每个写操作可以带上 keys（如 ("user", 1)），after 中的 key 对应的写操作确认后才会发起，
+    用来保证 feature 在其 user_id 对应的 user 写入之后才写
+    写操作抛出异常时它的所有 keys 记为失败；批量写只有部分行失败时返回失败的 keys，只有这些 key 记为失败，
+    依赖失败的 key 的写操作不再发起。失败的 key 在 reset 之前一直保留（跨过 join），
+    user 阶段失败的 user 在 feature 阶段仍然会阻止它的 feature；之后同一个 key 写成功时解除
+    """
+    def __init__(self, window: AimdWindow):
+        self._window = window
+        self._in_flight = 0
+        self._condition = asyncio.Condition()
+        self._tasks = set()
+        self._pending = {}
+        self._failed_keys = set()
+        # 上一次 join 之后新失败的 keys
+        self._joined_failed_keys = set()
+        self.submit_count = 0
+        self.error_count = 0
+
+    @property
+    def window(self):
+        return self._window
+
+    async def submit(self, name, coro_func, *args, keys=None, after=None):
+        """
+        等待窗口有空位后发起写操作，不等待写完成
+        """
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._in_flight < self._window.limit)
+            self._in_flight += 1
+
+        keys = keys or []
+        dependencies = [(key, self._pending.get(key)) for key in after or []
+                        if key in self._pending or key in self._failed_keys]
+        task = asyncio.ensure_future(self._run(name, coro_func, args, keys, dependencies))
+        for key in keys:
+            self._pending[key] = task
+        self._tasks.add(task)
+        task.add_done_callback(functools.partial(self._on_done, keys))
+        self.submit_count += 1
+        return task
+
+    async def join(self) -> List[Any]:
+        """
+        等待所有在途的写操作完成，返回上一次 join 之后失败的 keys，为空表示全部确认
+        """
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+        failed_keys = list(self._joined_failed_keys)
+        self._pending.clear()
+        self._joined_failed_keys.clear()
+        logger.info("[write_pipeline] joined, window: {}, submit: {}, error: {}, failed keys: {}".format(
+                    self._window.limit, self.submit_count, self.error_count, len(failed_keys)))
+        return failed_keys
+
+    def reset(self):
+        """
+        每一轮开始时调用，清除上一轮失败的 keys
+        """
+        self._failed_keys.clear()
+        self._joined_failed_keys.clear()
+
+    def _fail(self, keys):
+        self._failed_keys.update(keys)
+        self._joined_failed_keys.update(keys)
+
+    async def _run(self, name, coro_func, args, keys, dependencies):
+        try:
+            for key, dependency in dependencies:
+                if dependency is not None:
+                    await asyncio.shield(dependency)
+                if key in self._failed_keys:
+                    logger.error("[write_pipeline] skip {}, dependency {} failed".format(name, key))
+                    self._fail(keys)
+                    return False
+
+            begin = time.time()
+            try:
+                failed_keys = await coro_func(*args)
+            except Exception:
+                logger.error("[write_pipeline] {} failed: {}".format(name, traceback.format_exc()))
+                self.error_count += 1
+                self._window.on_error()
+                self._fail(keys)
+                return False
+
+            if failed_keys:
+                logger.error("[write_pipeline] {} partially failed, keys: {}".format(name, failed_keys))
+                self.error_count += 1
+                self._window.on_error()
+                self._fail(failed_keys)
+                self._failed_keys.difference_update(set(keys) - set(failed_keys))
+                return False
+
+            self._window.on_success(time.time() - begin)
+            self._failed_keys.difference_update(keys)
+            return True
+        finally:
+            async with self._condition:
+                self._in_flight -= 1
+                self._condition.notify_all()
+
+    def _on_done(self, keys, task):
+        self._tasks.discard(task)
+        for key in keys:
+            if self._pending.get(key) is task:
+                del self._pending[key]
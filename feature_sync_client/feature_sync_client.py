@@ -1,22 +1,26 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import io
 import traceback
 import asyncio
 import datetime
 import argparse
+import cProfile
+import pstats
 
 from lib.logger import logger
 from lib.utils import get_log_dir
 
 from core.conf_parameter import g_conf_parameter
 from core.feature_processor import FeatureProcessor
+from core.region_scheduler import RegionScheduler
 
 
 class FeatureSyncService(object):
     def __init__(self, event_loop):
         self._event_loop = event_loop
-        self._feature_processor = FeatureProcessor()
+        self._feature_processor = FeatureProcessor(*g_conf_parameter.sync_regions[0])
 
     def start_service(self):
         try:
@@ -37,6 +41,7 @@ class FeatureSyncService(object):
 
         if g_conf_parameter.sync_run_once == 1:
             logger.info("only run once so complete")
+            await self.close()
         else:
             tmp = datetime.datetime.now()
             if tmp > next_time:
@@ -49,11 +54,41 @@ class FeatureSyncService(object):
         end = datetime.datetime.now()
         logger.info("end sync feature at: {}, cost:{}s".format(end, round((end-now).total_seconds(), 3)))
 
+    async def close(self):
+        try:
+            await self._feature_processor.close()
+        except Exception:
+            logger.error(traceback.format_exc())
+
+
+def profile_cycle(profile_path):
+    """
+    在 cProfile 下同步一轮（只同步第一个区域），结果以 pstats 格式写到 profile_path，
+    可以用 python3 -m pstats 或 snakeviz 查看，按累计时间排序的前 30 个函数写到日志
+    """
+    event_loop = asyncio.get_event_loop()
+    feature_processor = FeatureProcessor(*g_conf_parameter.sync_regions[0])
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+        try:
+            event_loop.run_until_complete(feature_processor.start())
+        finally:
+            profiler.disable()
+    finally:
+        event_loop.run_until_complete(feature_processor.close())
+        profiler.dump_stats(profile_path)
+
+        output = io.StringIO()
+        pstats.Stats(profiler, stream=output).sort_stats("cumulative").print_stats(30)
+        logger.info("profile saved to {}\n{}".format(profile_path, output.getvalue()))
+
 
 def main():
     # 解析配置文件
     parser = argparse.ArgumentParser()
     parser.add_argument('-c', '--config', dest='config_path', default='./conf/feature_sync_client.conf', help='set conf file')
+    parser.add_argument('--profile', dest='profile_path', default=None, help='profile one sync cycle and save the stats to this file')
     args = parser.parse_args()
     
     g_conf_parameter.load_conf(args.config_path)
@@ -66,6 +101,18 @@ def main():
     logger.set_back_count(g_conf_parameter.log_back_count)
     logger.start()
 
+    if args.profile_path:
+        logger.info("{0} feature_sync_client profile one cycle use conf file: {1} {0}".format("*" * 10, args.config_path))
+        profile_cycle(args.profile_path)
+        return
+
+    if len(g_conf_parameter.sync_regions) > 1 or g_conf_parameter.sync_workers > 1:
+        logger.info("{0} feature_sync_client start use conf file: {1}, regions: {2}, workers: {3} {0}".format(
+                    "*" * 10, args.config_path, g_conf_parameter.sync_regions, g_conf_parameter.sync_workers))
+        RegionScheduler(args.config_path, g_conf_parameter.sync_regions, g_conf_parameter.sync_workers).run()
+        logger.info("complete sync or for uncaught exception")
+        return
+
     event_loop = asyncio.get_event_loop()
     feature_sync_service = FeatureSyncService(event_loop=event_loop)
     try:
@@ -74,6 +121,7 @@ def main():
         event_loop.run_until_complete(feature_sync_service.sync_feature())
         event_loop.run_forever()
     except KeyboardInterrupt:
+        event_loop.run_until_complete(feature_sync_service.close())
         event_loop.stop()
         event_loop.close()
 
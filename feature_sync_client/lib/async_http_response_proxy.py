@@ -1,16 +1,21 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import asyncio
 import aiohttp
 import json as _json
 
 from lib.exceptions import CallServiceException
+from lib.compression import decompress
+from lib import wire_format as _wire_format
 
 
 class AsyncHttpResponseProxy(object):
     def __init__(self, response=None, content=None):
         self._response = response
         self._content = content
+        # 响应体解压前的字节数
+        self.raw_size = 0
 
     @property
     def method(self):
@@ -41,8 +46,13 @@ class AsyncHttpResponseProxy(object):
         return self._response
 
     async def set_response(self, response):
+        """
+        session 关闭了自动解压，这里按 Content-Encoding 解压（支持 aiohttp 不支持的 zstd）
+        """
         self._response = response
-        self._content = await response.read()
+        raw = await response.read()
+        self.raw_size = len(raw)
+        self._content = decompress(raw, response.headers.get("Content-Encoding"))
 
     @property
     def content(self):
@@ -60,46 +70,142 @@ class AsyncHttpResponseProxy(object):
 
         return _json.loads(stripped.decode())
 
+    @property
+    def data(self):
+        """
+        按响应的 Content-Type 解码（json 或 msgpack）
+        """
+        if not self._content.strip():
+            return None
+
+        return _wire_format.loads(self._content, self.headers.get("Content-Type"))
+
 
 class AsyncHttpClientProxy(object):
+    """
+    传入 session 时复用长连接，否则每次请求新建一个 ClientSession
+    传入 compression（lib.compression.Compression）时协商请求体和响应体的压缩
+    传入 wire_format（lib.wire_format.WireFormat）时协商请求体和响应体的数据格式，post(body=...) 按协商的格式编码
+    传入 transfer（collections.Counter）时累计请求数和发送、接收的字节数（压缩后的请求体和响应体）:
+        transfer["requests"], transfer["sent"], transfer["received"]
+    """
+    def __init__(self, session=None, compression=None, wire_format=None, transfer=None):
+        self._session = session
+        self._compression = compression
+        self._wire_format = wire_format
+        self._transfer = transfer
+
     @staticmethod
-    async def get(url, *, params=None, **kwargs):
+    def create_session(limit=100, limit_per_host=0, keepalive_timeout=60, dns_cache_ttl=300, timeout=300):
+        """
+        创建长期使用的 session: keep-alive 连接池，限制单个 host 的连接数，缓存 DNS 解析结果
+        需要在事件循环中调用，使用完毕后 await session.close()
+        """
+        connector = aiohttp.TCPConnector(limit=limit,
+                                         limit_per_host=limit_per_host,
+                                         keepalive_timeout=keepalive_timeout,
+                                         use_dns_cache=dns_cache_ttl > 0,
+                                         ttl_dns_cache=dns_cache_ttl if dns_cache_ttl > 0 else None)
+        return aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=timeout),
+                                     auto_decompress=False)
+
+    async def get(self, url, *, params=None, **kwargs):
         if params is not None:
             kwargs.update(params)
 
-        response = AsyncHttpResponseProxy()
-
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url, params=kwargs) as resp:
-                    await response.set_response(resp)
-        except Exception as e:
-            raise CallServiceException(method="GET", url=url, errmsg=e)
-
-        return response
+        return await self._request("GET", url, params=kwargs)
 
-    @staticmethod
-    async def post(url, *, params=None, data=None, json=None, headers=None, **kwargs):
-        if json is not None:
+    async def post(self, url, *, params=None, data=None, json=None, body=None, headers=None, **kwargs):
+        if body is not None:
+            content_type = self._wire_format.request_format if self._wire_format is not None else _wire_format.JSON
+            headers = dict(headers or {})
+            headers["Content-Type"] = content_type
+            data = _wire_format.dumps(body, content_type)
+        elif json is not None:
             if headers is None:
                 headers = {"Content-Type": "application/json; charset=UTF-8"}
             data = _json.dumps(json)
 
+        return await self._request("POST", url, data=data, params=params, headers=headers, **kwargs)
+
+    async def get_lines(self, url, *, params=None, chunk_size=65536, **kwargs):
+        """
+        流式读取 GET 的响应体，按行返回（不含换行符），用于 NDJSON 之类的分块响应
+        不用 StreamReader 的按行读取，它对单行长度有限制
+        """
+        if params is not None:
+            kwargs.update(params)
+        if self._transfer is not None:
+            self._transfer["requests"] += 1
+
+        try:
+            if self._session is not None:
+                async with self._session.get(url, params=kwargs) as resp:
+                    async for line in self._iter_lines(resp, chunk_size):
+                        yield line
+            else:
+                async with aiohttp.ClientSession() as session:
+                    async with session.get(url, params=kwargs) as resp:
+                        async for line in self._iter_lines(resp, chunk_size):
+                            yield line
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise CallServiceException(method="GET", url=url, errmsg=e)
+
+    async def _iter_lines(self, resp, chunk_size):
+        resp.raise_for_status()
+        buffer = b""
+        async for chunk in resp.content.iter_chunked(chunk_size):
+            if self._transfer is not None:
+                self._transfer["received"] += len(chunk)
+            lines = (buffer + chunk).split(b"\n")
+            buffer = lines.pop()
+            for line in lines:
+                if line:
+                    yield line
+        if buffer:
+            yield buffer
+
+    async def _request(self, method, url, headers=None, data=None, **kwargs):
         response = AsyncHttpResponseProxy()
 
+        if self._wire_format is not None:
+            headers = dict(headers or {})
+            headers["Accept"] = self._wire_format.accept
+
+        if self._compression is not None:
+            headers = dict(headers or {})
+            headers["Accept-Encoding"] = self._compression.accept_encoding
+            if isinstance(data, str):
+                data = data.encode()
+            data, encoding = self._compression.compress_body(data)
+            if encoding is not None:
+                headers["Content-Encoding"] = encoding
+        if self._transfer is not None:
+            self._transfer["requests"] += 1
+            if isinstance(data, (bytes, str)):
+                self._transfer["sent"] += len(data)
+
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, data=data, params=params, headers=headers, **kwargs) as resp:
+            if self._session is not None:
+                async with self._session.request(method, url, headers=headers, data=data, **kwargs) as resp:
                     await response.set_response(resp)
+            else:
+                async with aiohttp.ClientSession(auto_decompress=False) as session:
+                    async with session.request(method, url, headers=headers, data=data, **kwargs) as resp:
+                        await response.set_response(resp)
         except Exception as e:
-            raise CallServiceException(method="GET", url=url, errmsg=e)
-
+            raise CallServiceException(method=method, url=url, errmsg=e)
+
+        if self._transfer is not None:
+            self._transfer["received"] += response.raw_size
+        if self._compression is not None:
+            self._compression.on_response_headers(response.headers)
+        if self._wire_format is not None:
+            self._wire_format.on_response_headers(response.headers)
         return response
 
 
 if __name__ == '__main__':
-    import asyncio
-
     async def test_example():
         url = "http://httpbin.org"
         client = AsyncHttpClientProxy()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import gzip
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def available_encodings():
+    """
+    本机支持的压缩格式，按优先级排序，zstd 需要安装 zstandard
+    """
+    if zstandard is not None:
+        return ["zstd", "gzip"]
+    return ["gzip"]
+
+
+def parse_encodings(header):
+    """
+    解析 Accept-Encoding 之类的头，"zstd, gzip;q=0.5, br;q=0" -> ["zstd", "gzip"]
+    """
+    encodings = []
+    for item in (header or "").split(","):
+        parts = item.strip().split(";")
+        encoding = parts[0].strip().lower()
+        if not encoding:
+            continue
+        q = 1.0
+        for param in parts[1:]:
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0
+        if q > 0:
+            encodings.append(encoding)
+    return encodings
+
+
+def choose_encoding(header, encodings):
+    """
+    从 encodings（本端的优先级）中选第一个对端也支持的格式，没有则返回 None
+    """
+    accepted = parse_encodings(header)
+    for encoding in encodings:
+        if encoding in accepted:
+            return encoding
+    return None
+
+
+def compress(data, encoding, level=6):
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    if encoding == "gzip":
+        return gzip.compress(data, compresslevel=max(1, min(9, level)))
+    raise ValueError("no support encoding <{}>".format(encoding))
+
+
+def decompress(data, encoding):
+    if not encoding or encoding == "identity":
+        return data
+    if encoding == "zstd":
+        if zstandard is None:
+            raise ValueError("no support encoding <zstd>, zstandard is not installed")
+        # 流式压缩的数据头中可能没有原始长度，用 decompressobj 解压
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    if encoding == "gzip":
+        return gzip.decompress(data)
+    raise ValueError("no support encoding <{}>".format(encoding))
+
+
+class Compression(object):
+    """
+    http 请求/响应体的压缩协商:
+        请求带 Accept-Encoding，响应按对端支持的格式压缩；
+        对端在响应中用 Accept-Encoding 声明它能解压的请求体格式（RFC 7694），之后超过 min_size 的请求体才压缩
+    """
+    def __init__(self, encodings=None, level=6, min_size=1024):
+        available = available_encodings()
+        self.encodings = [encoding for encoding in (available if encodings is None else encodings) if encoding in available]
+        self.level = level
+        self.min_size = min_size
+        self._request_encoding = None
+
+    @property
+    def enabled(self):
+        return bool(self.encodings)
+
+    @property
+    def accept_encoding(self):
+        return ", ".join(self.encodings) if self.encodings else "identity"
+
+    def on_response_headers(self, headers):
+        if self.enabled and "Accept-Encoding" in headers:
+            self._request_encoding = choose_encoding(headers.get("Accept-Encoding"), self.encodings)
+
+    def compress_body(self, data):
+        """
+        返回 (data, encoding)，不压缩时 encoding 为 None
+        """
+        if self._request_encoding is None or data is None or len(data) < self.min_size:
+            return data, None
+        return compress(data, self._request_encoding, self.level), self._request_encoding
@@ -14,9 +14,14 @@ class ConfigParserEx(object):
     def __init__(self, path):
         self.path = path
 
-    def get_config(self, section, key):
+    def get_config(self, section, key, fallback=None):
+        """
+        fallback 不为 None 时，配置项不存在则返回 fallback
+        """
         config = ConfigParser.ConfigParser()
         config.read(self.path)
+        if fallback is not None and not config.has_option(section, key):
+            return fallback
         return config.get(section, key)
 
     def set_config(self, section, key, value):
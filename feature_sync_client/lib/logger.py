@@ -62,6 +62,12 @@ class DailyLogger(BaseLogger):
         self._logger_level = temp_level_dict.get(level.lower(), logging.NOTSET)
 
     def start(self):
+        """
+        可以重复调用，比如子进程中换成自己的日志文件，之前的文件 handler 会被移除
+        """
+        if self._file_handler is not None:
+            self._logger.removeHandler(self._file_handler)
+            self._file_handler.close()
         self._logger = self._basic_logger.getChild(self._child_name)
 
         self._file_handler = logging.handlers.TimedRotatingFileHandler(
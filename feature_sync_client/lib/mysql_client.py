@@ -2,20 +2,75 @@
 # -*- coding: utf-8 -*-
 
 import asyncio
+import random
 import aiomysql
 from datetime import datetime, date
-import traceback
 
 from lib.logger import logger
 
+# 连接已经不可用（服务端断开、网络中断、协议错乱），丢弃这个连接，换一个连接重试
+CONNECTION_ERROR_CODES = {2002, 2003, 2006, 2013, 2014, 2055}
+# 暂时的错误（连接数满、锁等待超时、死锁），退避后重试
+TRANSIENT_ERROR_CODES = {1040, 1203, 1205, 1213}
+
+CONNECTION = "connection"
+TRANSIENT = "transient"
+
+
+def classify_error(err):
+    """
+    返回 CONNECTION / TRANSIENT，数据错误、语法错误等重试也不会成功的返回 None
+    """
+    if isinstance(err, (ConnectionError, asyncio.IncompleteReadError, aiomysql.InterfaceError)):
+        return CONNECTION
+    if isinstance(err, aiomysql.OperationalError) and err.args:
+        if err.args[0] in CONNECTION_ERROR_CODES:
+            return CONNECTION
+        if err.args[0] in TRANSIENT_ERROR_CODES:
+            return TRANSIENT
+    return None
+
+
+class _PooledConnection(object):
+    """
+    从连接池取一个连接，出现连接级的错误时关闭这个连接（连接池不再复用），不影响其他连接
+    """
+    def __init__(self, client):
+        self._client = client
+        self._pool = None
+        self._conn = None
+
+    async def __aenter__(self):
+        self._pool, self._conn = await self._client._acquire()
+        return self._conn
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc is not None and classify_error(exc) == CONNECTION:
+            self._client.discard_count += 1
+            self._conn.close()
+        await self._pool.release(self._conn)
+
 
 class MysqlClient(object):
     def __init__(self):
         self._pool = None
+        self._rebuild_lock = None
+        # 指标: 连接池重建次数、丢弃的连接数、重试次数、空闲连接 ping 失败次数、取连接的次数和等待的总秒数
+        self.rebuild_count = 0
+        self.discard_count = 0
+        self.retry_count = 0
+        self.ping_failed_count = 0
+        self.acquire_count = 0
+        self.acquire_wait = 0.0
 
     def initialize(self, minsize=1, maxsize=10, loop=None,
                         host="localhost", port=3306, user=None, password="", db=None, charset='utf8',
-                        autocommit=True):
+                        autocommit=True,
+                        max_retries=3, retry_backoff=0.05, retry_backoff_max=2.0, ping_idle=30, pool_recycle=3600):
+        """
+        max_retries: 连接级/暂时的错误最多重试的次数，第 n 次重试前等待 [0, min(retry_backoff_max, retry_backoff * 2^n)) 秒
+        ping_idle: 空闲超过这个秒数的连接取出时先 ping，不通时换一个连接；pool_recycle: 空闲超过这个秒数的连接直接关闭，-1 不回收
+        """
         self._minsize = minsize
         self._maxsize = maxsize
         self._loop = loop or asyncio.get_event_loop()
@@ -26,86 +81,136 @@ class MysqlClient(object):
         self._db = db
         self._charset = charset
         self._autocommit = autocommit
+        self._max_retries = max_retries
+        self._retry_backoff = retry_backoff
+        self._retry_backoff_max = retry_backoff_max
+        self._ping_idle = ping_idle
+        self._pool_recycle = pool_recycle
 
     async def create_pool(self):
-        self._pool = await aiomysql.create_pool(minsize=self._minsize,
-                                                maxsize=self._maxsize,
-                                                loop=self._loop,
-                                                host=self._host,
-                                                port=self._port,
-                                                user=self._user,
-                                                password=self._password,
-                                                db=self._db,
-                                                charset=self._charset,
-                                                autocommit=self._autocommit)
+        self._pool = await self._create_pool()
+
+    async def _create_pool(self):
+        return await aiomysql.create_pool(minsize=self._minsize,
+                                          maxsize=self._maxsize,
+                                          loop=self._loop,
+                                          pool_recycle=self._pool_recycle,
+                                          host=self._host,
+                                          port=self._port,
+                                          user=self._user,
+                                          password=self._password,
+                                          db=self._db,
+                                          charset=self._charset,
+                                          autocommit=self._autocommit)
 
     async def close(self):
-        self._pool.close()
-        await self._pool.wait_closed()
-
-    async def query_one(self, statement, parameter=None):
-        result = None
-        try:
-            result = await self._query_one(statement, parameter)
-        except Exception:
-            logger.error(traceback.format_exc())
-            await self.close()
+        if self._pool is None:
+            return
+        pool, self._pool = self._pool, None
+        pool.close()
+        await pool.wait_closed()
+
+    def stats(self):
+        return dict(pool_size=self._pool.size if self._pool is not None else 0,
+                    pool_free=self._pool.freesize if self._pool is not None else 0,
+                    pool_rebuild=self.rebuild_count,
+                    connection_discard=self.discard_count,
+                    retry=self.retry_count,
+                    ping_failed=self.ping_failed_count,
+                    acquire_count=self.acquire_count,
+                    acquire_wait_seconds=round(self.acquire_wait, 6))
+
+    def _connection(self):
+        return _PooledConnection(self)
+
+    async def _acquire(self):
+        """
+        返回 (pool, conn)，空闲超过 ping_idle 秒的连接先 ping，不通时关闭换下一个
+        """
+        if self._pool is None:
             await self.create_pool()
-            result = await self._query_one(statement, parameter)
+        pool = self._pool
+        begin = self._loop.time()
+        try:
+            for _ in range(self._maxsize):
+                conn = await pool.acquire()
+                if self._ping_idle < 0 or self._loop.time() - conn.last_usage < self._ping_idle:
+                    return pool, conn
+                try:
+                    await conn.ping(reconnect=False)
+                    return pool, conn
+                except Exception as err:
+                    self.ping_failed_count += 1
+                    logger.warning("[mysql] discard idle connection, ping failed: {}".format(err))
+                    conn.close()
+                    await pool.release(conn)
+            return pool, await pool.acquire()
+        finally:
+            self.acquire_count += 1
+            self.acquire_wait += self._loop.time() - begin
+
+    async def _rebuild(self, pool):
+        """
+        连续出现连接级的错误时（如数据库切换了地址）换一个新的连接池，旧连接池中正在执行的语句不受影响，执行完后关闭
+        """
+        if self._rebuild_lock is None:
+            self._rebuild_lock = asyncio.Lock()
+        async with self._rebuild_lock:
+            if pool is not self._pool:
+                # 其他请求已经重建过了
+                return
+            self._pool = await self._create_pool()
+            self.rebuild_count += 1
+            logger.warning("[mysql] rebuild connection pool, count: {}".format(self.rebuild_count))
+            if pool is not None:
+                pool.close()
+                asyncio.ensure_future(pool.wait_closed())
+
+    async def _retry(self, func, *args):
+        """
+        连接级的错误和暂时的错误按指数退避加随机抖动重试，其他错误直接抛出；连续两次连接级的错误后重建连接池
+        """
+        connection_errors = 0
+        attempt = 0
+        while True:
+            pool = self._pool
+            try:
+                return await func(*args)
+            except Exception as err:
+                kind = classify_error(err)
+                if kind is None or attempt >= self._max_retries:
+                    raise
+                logger.warning("[mysql] {} error, retry {}/{}: {}".format(kind, attempt + 1, self._max_retries, err))
+                if kind == CONNECTION:
+                    connection_errors += 1
+                    if connection_errors >= 2:
+                        connection_errors = 0
+                        await self._rebuild(pool)
+                else:
+                    connection_errors = 0
+
+            self.retry_count += 1
+            await asyncio.sleep(random.uniform(0, min(self._retry_backoff_max, self._retry_backoff * 2 ** attempt)))
+            attempt += 1
 
-        return result
+    async def query_one(self, statement, parameter=None):
+        return await self._retry(self._query_one, statement, parameter)
 
     async def query_many(self, statement, parameter=None, size=None):
-        result = None
-        try:
-            result = await self._query_many(statement, parameter, size)
-        except Exception:
-            logger.error(traceback.format_exc())
-            await self.close()
-            await self.create_pool()
-            result = await self._query_many(statement, parameter, size)
-
-        return result
+        return await self._retry(self._query_many, statement, parameter, size)
 
     async def query_all(self, statement, parameter=None):
-        result = None
-        try:
-            result = await self._query_all(statement, parameter)
-        except Exception:
-            logger.error(traceback.format_exc())
-            await self.close()
-            await self.create_pool()
-            result = await self._query_all(statement, parameter)
-
-        return result
+        return await self._retry(self._query_all, statement, parameter)
 
     async def execute(self, statement, parameter=None):
-        result = None
-        try:
-            result = await self._execute(statement, parameter)
-        except Exception:
-            logger.error(traceback.format_exc())
-            await self.close()
-            await self.create_pool()
-            result = await self._execute(statement, parameter)
-
-        return result
+        return await self._retry(self._execute, statement, parameter)
 
     async def executemany(self, statement, parameter=None):
-        result = None
-        try:
-            result = await self._executemany(statement, parameter)
-        except Exception:
-            logger.error(traceback.format_exc())
-            await self.close()
-            await self.create_pool()
-            result = await self._executemany(statement, parameter)
-
-        return result
+        return await self._retry(self._executemany, statement, parameter)
 
     async def _query_one(self, statement, parameter=None):
         result = None
-        async with self._pool.acquire() as conn:
+        async with self._connection() as conn:
             async with conn.cursor() as cursor:
                 await cursor.execute(statement, parameter)
                 row_names = [d[0] for d in cursor.description]
@@ -116,7 +221,7 @@ class MysqlClient(object):
 
     async def _query_many(self, statement, parameter=None, size=None):
         result = None
-        async with self._pool.acquire() as conn:
+        async with self._connection() as conn:
             async with conn.cursor() as cursor:
                 await cursor.execute(statement, parameter)
                 row_names = [d[0] for d in cursor.description]
@@ -127,7 +232,7 @@ class MysqlClient(object):
 
     async def _query_all(self, statement, parameter=None):
         result = None
-        async with self._pool.acquire() as conn:
+        async with self._connection() as conn:
             async with conn.cursor() as cursor:
                 await cursor.execute(statement, parameter)
                 row_names = [d[0] for d in cursor.description]
@@ -138,7 +243,7 @@ class MysqlClient(object):
 
     async def _execute(self, statement, parameter=None):
         row_count, last_row_id = 0, 0
-        async with self._pool.acquire() as conn:
+        async with self._connection() as conn:
             async with conn.cursor() as cursor:
                 await cursor.execute(statement, parameter)
                 row_count, last_row_id = cursor.rowcount, cursor.lastrowid
@@ -147,7 +252,7 @@ class MysqlClient(object):
 
     async def _executemany(self, statement, parameter=None):
         row_count, last_row_id = 0, 0
-        async with self._pool.acquire() as conn:
+        async with self._connection() as conn:
             async with conn.cursor() as cursor:
                 await cursor.executemany(statement, parameter)
                 row_count, last_row_id = cursor.rowcount, cursor.lastrowid
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import base64
+import datetime
+import decimal
+import json
+
+from lib.compression import parse_encodings
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON = "application/json"
+MSGPACK = "application/x-msgpack"
+
+# user / feature_model_0330 中的二进制列，JSON 中是 base64 文本（见 _default），msgpack 中直接是 bytes
+BYTES_FIELDS = ("pic_md5", "feature")
+
+
+def available_formats():
+    """
+    本机支持的数据格式，按优先级排序，msgpack 需要安装 msgpack
+    """
+    if msgpack is not None:
+        return [MSGPACK, JSON]
+    return [JSON]
+
+
+def parse_content_type(header):
+    """
+    "application/json; charset=UTF-8" -> "application/json"
+    """
+    return (header or "").split(";")[0].strip().lower()
+
+
+def choose_format(header, formats):
+    """
+    从 formats（本端的优先级）中选第一个 Accept 中接受的格式，没有则返回 JSON
+    """
+    accepted = parse_encodings(header)
+    for content_type in formats:
+        if content_type in accepted:
+            return content_type
+    return JSON
+
+
+def _default(obj):
+    # bytes 在 JSON 中用 base64 表示，msgpack 中直接是 bin 类型，不会走到这里
+    if isinstance(obj, bytes):
+        return base64.b64encode(obj).decode()
+    if isinstance(obj, decimal.Decimal):
+        return int(obj) if obj == obj.to_integral_value() else float(obj)
+    if isinstance(obj, (datetime.datetime, datetime.date)):
+        return str(obj)
+    raise TypeError("Object of type {} is not serializable".format(type(obj).__name__))
+
+
+def decode_bytes_fields(values):
+    """
+    把一行中 JSON 传输的二进制列（base64 文本）还原成 bytes，msgpack 传输的已经是 bytes，不变
+    """
+    for field in BYTES_FIELDS:
+        if isinstance(values.get(field), str):
+            values[field] = base64.b64decode(values[field].encode())
+    return values
+
+
+def json_dumps(obj, **kwargs):
+    return json.dumps(obj, default=_default, **kwargs)
+
+
+def dumps(obj, content_type=JSON):
+    if content_type == MSGPACK:
+        return msgpack.packb(obj, use_bin_type=True, default=_default)
+    if content_type == JSON:
+        return json_dumps(obj).encode()
+    raise ValueError("no support content type <{}>".format(content_type))
+
+
+def loads(data, content_type=JSON):
+    content_type = parse_content_type(content_type) or JSON
+    if content_type == MSGPACK:
+        if msgpack is None:
+            raise ValueError("no support content type <{}>, msgpack is not installed".format(MSGPACK))
+        return msgpack.unpackb(data, raw=False)
+    # 没有 Content-Type 或者是 text/plain 之类的，按 json 解析
+    return json.loads(data.decode() if isinstance(data, bytes) else data)
+
+
+class WireFormat(object):
+    """
+    http 请求/响应体的数据格式协商:
+        请求带 Accept，对端按支持的格式返回，msgpack 中 bytes 原样传输，JSON 中 bytes 用 base64；
+        对端返回过 msgpack 之后，请求体也用 msgpack
+    """
+    def __init__(self, formats=None):
+        available = available_formats()
+        self.formats = [content_type for content_type in (available if formats is None else formats)
+                        if content_type in available]
+        if JSON not in self.formats:
+            self.formats.append(JSON)
+        self.request_format = JSON
+
+    @property
+    def binary(self):
+        return self.request_format == MSGPACK
+
+    @property
+    def accept(self):
+        return ", ".join(self.formats)
+
+    def on_response_headers(self, headers):
+        if parse_content_type(headers.get("Content-Type")) == MSGPACK and MSGPACK in self.formats:
+            self.request_format = MSGPACK
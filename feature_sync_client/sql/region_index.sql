@@ -0,0 +1,24 @@
+-- 区域查询的索引，在云端数据库中执行，可以重复执行（索引已经存在时跳过）
+-- 整个城市（town_code = -1）的查询用 (province_code, city_code, id)，按区县的查询用 (province_code, city_code, town_code, id)，
+-- MAX(id) 和按 id 排序的范围查询都可以直接在索引上完成
+
+DROP PROCEDURE IF EXISTS `sync_add_index`;
+DELIMITER //
+CREATE PROCEDURE `sync_add_index`(IN table_name_ VARCHAR(64), IN index_name_ VARCHAR(64), IN columns_ VARCHAR(255))
+BEGIN
+  IF NOT EXISTS (SELECT 1 FROM information_schema.statistics
+                 WHERE table_schema = DATABASE() AND table_name = table_name_ AND index_name = index_name_) THEN
+    SET @ddl = CONCAT('ALTER TABLE `', table_name_, '` ADD INDEX `', index_name_, '` (', columns_, ')');
+    PREPARE stmt FROM @ddl;
+    EXECUTE stmt;
+    DEALLOCATE PREPARE stmt;
+  END IF;
+END //
+DELIMITER ;
+
+CALL `sync_add_index`('user', 'idx_region_city_id', '`province_code`, `city_code`, `id`');
+CALL `sync_add_index`('user', 'idx_region_town_id', '`province_code`, `city_code`, `town_code`, `id`');
+CALL `sync_add_index`('feature_model_0330', 'idx_region_city_id', '`province_code`, `city_code`, `id`');
+CALL `sync_add_index`('feature_model_0330', 'idx_region_town_id', '`province_code`, `city_code`, `town_code`, `id`');
+
+DROP PROCEDURE IF EXISTS `sync_add_index`;
@@ -0,0 +1,53 @@
+-- CDC 的变更日志表(cdc source = change_log 时使用)，在云端数据库中执行，可以重复执行
+-- user / feature_model_0330 的每一次增删改由触发器记录一行，客户端按 id 顺序读取
+-- update 同时记录修改前的区域(old_*)，行被移出区域时客户端按删除处理
+
+CREATE TABLE IF NOT EXISTS `sync_change_log` (
+  `id` bigint(20) NOT NULL AUTO_INCREMENT,
+  `table_name` varchar(64) NOT NULL,
+  `action` varchar(16) NOT NULL,
+  `row_id` int(11) NOT NULL,
+  `user_id` int(11) DEFAULT NULL,
+  `province_code` varchar(64) DEFAULT NULL,
+  `city_code` varchar(64) DEFAULT NULL,
+  `town_code` varchar(64) DEFAULT NULL,
+  `old_province_code` varchar(64) DEFAULT NULL,
+  `old_city_code` varchar(64) DEFAULT NULL,
+  `old_town_code` varchar(64) DEFAULT NULL,
+  `create_time` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+
+DROP TRIGGER IF EXISTS `user_sync_after_insert`;
+CREATE TRIGGER `user_sync_after_insert` AFTER INSERT ON `user` FOR EACH ROW
+  INSERT INTO `sync_change_log` (table_name, action, row_id, user_id, province_code, city_code, town_code)
+  VALUES ('user', 'insert', NEW.id, NEW.id, NEW.province_code, NEW.city_code, NEW.town_code);
+
+DROP TRIGGER IF EXISTS `user_sync_after_update`;
+CREATE TRIGGER `user_sync_after_update` AFTER UPDATE ON `user` FOR EACH ROW
+  INSERT INTO `sync_change_log` (table_name, action, row_id, user_id, province_code, city_code, town_code,
+                                 old_province_code, old_city_code, old_town_code)
+  VALUES ('user', 'update', NEW.id, NEW.id, NEW.province_code, NEW.city_code, NEW.town_code,
+          OLD.province_code, OLD.city_code, OLD.town_code);
+
+DROP TRIGGER IF EXISTS `user_sync_after_delete`;
+CREATE TRIGGER `user_sync_after_delete` AFTER DELETE ON `user` FOR EACH ROW
+  INSERT INTO `sync_change_log` (table_name, action, row_id, user_id, province_code, city_code, town_code)
+  VALUES ('user', 'delete', OLD.id, OLD.id, OLD.province_code, OLD.city_code, OLD.town_code);
+
+DROP TRIGGER IF EXISTS `feature_model_0330_sync_after_insert`;
+CREATE TRIGGER `feature_model_0330_sync_after_insert` AFTER INSERT ON `feature_model_0330` FOR EACH ROW
+  INSERT INTO `sync_change_log` (table_name, action, row_id, user_id, province_code, city_code, town_code)
+  VALUES ('feature_model_0330', 'insert', NEW.id, NEW.user_id, NEW.province_code, NEW.city_code, NEW.town_code);
+
+DROP TRIGGER IF EXISTS `feature_model_0330_sync_after_update`;
+CREATE TRIGGER `feature_model_0330_sync_after_update` AFTER UPDATE ON `feature_model_0330` FOR EACH ROW
+  INSERT INTO `sync_change_log` (table_name, action, row_id, user_id, province_code, city_code, town_code,
+                                 old_province_code, old_city_code, old_town_code)
+  VALUES ('feature_model_0330', 'update', NEW.id, NEW.user_id, NEW.province_code, NEW.city_code, NEW.town_code,
+          OLD.province_code, OLD.city_code, OLD.town_code);
+
+DROP TRIGGER IF EXISTS `feature_model_0330_sync_after_delete`;
+CREATE TRIGGER `feature_model_0330_sync_after_delete` AFTER DELETE ON `feature_model_0330` FOR EACH ROW
+  INSERT INTO `sync_change_log` (table_name, action, row_id, user_id, province_code, city_code, town_code)
+  VALUES ('feature_model_0330', 'delete', OLD.id, OLD.user_id, OLD.province_code, OLD.city_code, OLD.town_code);
@@ -24,6 +24,39 @@ class ConfParameter(object):
         self.mysql_password = self.config_parser.get_config("MYSQL", "password")
         self.mysql_db = self.config_parser.get_config("MYSQL", "db")
         self.mysql_use_ssl = int(self.config_parser.get_config("MYSQL", "use_ssl"))
+        self.mysql_index_check = int(self.config_parser.get_config("MYSQL", "index_check", "1"))
+        self.mysql_max_retries = int(self.config_parser.get_config("MYSQL", "max_retries", "3"))
+        self.mysql_ping_idle = int(self.config_parser.get_config("MYSQL", "ping_idle", "30"))
+        self.mysql_pool_recycle = int(self.config_parser.get_config("MYSQL", "pool_recycle", "3600"))
+        # 所有 worker 的连接数之和不超过 max_connections（0 不限制，每个 worker 最多 10 个），每个 worker 启动时建立 pool_minsize 个连接
+        self.mysql_max_connections = int(self.config_parser.get_config("MYSQL", "max_connections", "40"))
+        if self.mysql_max_connections > 0:
+            self.mysql_pool_maxsize = max(1, self.mysql_max_connections // max(1, self.workers_num))
+        else:
+            self.mysql_pool_maxsize = 10
+        self.mysql_pool_minsize = max(0, min(int(self.config_parser.get_config("MYSQL", "pool_minsize", "2")), self.mysql_pool_maxsize))
+
+        self.status_cache_ttl = int(self.config_parser.get_config("STATUS", "cache_ttl_ms", "60000")) / 1000.0
+
+        self.metrics_enable = int(self.config_parser.get_config("METRICS", "enable", "1"))
+        self.metrics_flush_interval = int(self.config_parser.get_config("METRICS", "flush_interval", "5"))
+
+        _compression_encodings = self.config_parser.get_config("COMPRESSION", "encodings", "zstd,gzip")
+        self.compression_encodings = [encoding.strip() for encoding in _compression_encodings.split(",") if encoding.strip()]
+        self.compression_level = int(self.config_parser.get_config("COMPRESSION", "level", "6"))
+        self.compression_min_size = int(self.config_parser.get_config("COMPRESSION", "min_size", "1024"))
+
+        self.index_enable = int(self.config_parser.get_config("INDEX", "enable", "0"))
+        _index_regions = self.config_parser.get_config("INDEX", "regions", "")
+        self.index_regions = [self._parse_region(region) for region in _index_regions.split(",") if region.strip()]
+
+    @staticmethod
+    def _parse_region(region):
+        codes = [code.strip() for code in region.strip().split("/")]
+        if len(codes) < 2 or len(codes) > 3:
+            raise ValueError("invalid region <{}>, expect province_code/city_code/town_code".format(region))
+        town_code = codes[2] if len(codes) == 3 and codes[2] else '-1'
+        return codes[0], codes[1], town_code
 
 
 g_conf_parameter = ConfParameter()
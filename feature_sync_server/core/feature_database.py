@@ -1,47 +1,72 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from typing import Dict, Any
-import base64
+from typing import Dict, List, Any
+import asyncio
 import json
 
-from lib.utils import single_ton, common_result
+from lib.utils import single_ton, common_result, get_state_dir
 from lib.mysql_client import MysqlClient
+from lib.region_sql import region_statement, check_region_index
 from lib.logger import logger
+from lib.wire_format import decode_bytes_fields
 
 from core.conf_parameter import g_conf_parameter
+from core.id_index import IdIndexes, SharedIdIndex
+from core.region_summary import RegionSummary
+
+# query_*_range 每页的默认行数和最大行数
+DEFAULT_PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 50000
 
 
 @single_ton
 class FeatureDatabase(object):
-    stmt_get_max_user_id = "select MAX(`id`) as id from user where province_code=%(province_code)s and city_code=%(city_code)s \
+    stmt_get_max_user_id = "select MAX(`id`) as id from user \
+                            where province_code=%(province_code)s and city_code=%(city_code)s \
                             and (%(town_code)s='-1' or town_code=%(town_code)s)"
     stmt_add_user = "insert user (id,uid,pic_md5,province_code,town_code,city_code) \
                         values (%(id)s,%(uid)s,%(pic_md5)s,%(province_code)s,%(town_code)s,%(city_code)s)"
     stmt_query_user_id_range = "select id from user \
                             where province_code=%(province_code)s and city_code=%(city_code)s \
                             and (%(town_code)s='-1' or town_code=%(town_code)s) \
-                            and id>%(begin_id)s and id<=%(end_id)s LIMIT 1000"
+                            and id>%(begin_id)s and id<=%(end_id)s order by id LIMIT %(limit)s"
     stmt_query_user_range = "select * from user \
                             where province_code=%(province_code)s and city_code=%(city_code)s \
                             and (%(town_code)s='-1' or town_code=%(town_code)s) \
-                            and id>%(begin_id)s and id<=%(end_id)s LIMIT 1000"
+                            and id>%(begin_id)s and id<=%(end_id)s order by id LIMIT %(limit)s"
+    # 每一行内容的摘要，与分桶摘要中每一行的计算方式相同，对比时不用传输 pic_md5
+    stmt_query_user_digest_range = "select id, MD5(CONCAT_WS('#', id, uid, MD5(pic_md5), province_code, city_code, town_code)) as digest \
+                            from user \
+                            where province_code=%(province_code)s and city_code=%(city_code)s \
+                            and (%(town_code)s='-1' or town_code=%(town_code)s) \
+                            and id>%(begin_id)s and id<=%(end_id)s order by id LIMIT %(limit)s"
     stmt_del_user_by_id = "delete from user where id=%(id)s"
+    # 与 del_user_by_id 相同，还有 feature 的 user 不删除，用一条语句完成，可以放在事务中
+    stmt_del_user_without_feature_by_id = "delete from user where id=%(id)s \
+                            and not exists (select 1 from feature_model_0330 where user_id=%(id)s)"
     stmt_update_user = "update user set \
                         province_code=%(province_code)s, city_code=%(city_code)s, uid=%(uid)s, \
                         town_code=%(town_code)s, pic_md5=%(pic_md5)s where id=%(id)s"
+    # upsert_user 在 stmt_update_user 之后执行，id 不存在时才插入
+    stmt_add_user_if_absent = "insert user (id,uid,pic_md5,province_code,town_code,city_code) \
+                        select %(id)s,%(uid)s,%(pic_md5)s,%(province_code)s,%(town_code)s,%(city_code)s from dual \
+                        where not exists (select 1 from user where id=%(id)s)"
 
     stmt_get_max_feature_model_0330_id = "select MAX(`id`) as id from feature_model_0330 \
                                             where province_code=%(province_code)s and city_code=%(city_code)s \
                                             and (%(town_code)s='-1' or town_code=%(town_code)s)"
+    # 两张表最后修改的时间（MySQL 5.7 及以上，重启后在第一次修改之前为 NULL）
+    stmt_get_change_time = "select UNIX_TIMESTAMP(MAX(update_time)) as change_time from information_schema.tables \
+                            where table_schema=DATABASE() and table_name in ('user', 'feature_model_0330')"
     stmt_query_feature_model_0330_id_range = "select id from feature_model_0330 \
                                             where province_code=%(province_code)s and city_code=%(city_code)s \
                                             and (%(town_code)s='-1' or town_code=%(town_code)s) \
-                                            and id>%(begin_id)s and id<=%(end_id)s LIMIT 1000"
+                                            and id>%(begin_id)s and id<=%(end_id)s order by id LIMIT %(limit)s"
     stmt_query_feature_model_0330_time_range = "select id, timestamp from feature_model_0330 \
                                             where province_code=%(province_code)s and city_code=%(city_code)s \
                                             and (%(town_code)s='-1' or town_code=%(town_code)s) \
-                                            and id>%(begin_id)s and id<=%(end_id)s LIMIT 1000"
+                                            and id>%(begin_id)s and id<=%(end_id)s order by id LIMIT %(limit)s"
     stmt_del_feature_model_0330_by_id = "delete from feature_model_0330 where id=%(id)s"
     stmt_get_feature_model_0330_by_user_id = "select * from feature_model_0330 where user_id =%(user_id)s limit 1"
     stmt_add_feature_model_0330 = "insert feature_model_0330 (id,user_id,timestamp,feature_id,feature,province_code,city_code,town_code) \
@@ -50,26 +75,99 @@ class FeatureDatabase(object):
                                         user_id=%(user_id)s, timestamp=%(timestamp)s, feature_id=%(feature_id)s, feature=%(feature)s,\
                                         province_code=%(province_code)s, city_code=%(city_code)s, town_code=%(town_code)s \
                                         where id=%(id)s"
+    stmt_add_feature_model_0330_if_absent = "insert feature_model_0330 (id,user_id,timestamp,feature_id,feature,province_code,city_code,town_code) \
+                                    select %(id)s,%(user_id)s,%(timestamp)s,%(feature_id)s,%(feature)s,%(province_code)s,%(city_code)s,%(town_code)s \
+                                    from dual where not exists (select 1 from feature_model_0330 where id=%(id)s)"
+
+    # 流式导出整个区间，没有 LIMIT，按 id 排序
+    stmt_export_user_range = "select * from user \
+                            where province_code=%(province_code)s and city_code=%(city_code)s \
+                            and (%(town_code)s='-1' or town_code=%(town_code)s) \
+                            and id>%(begin_id)s and id<=%(end_id)s order by id"
+    stmt_export_user_id_range = "select id from user \
+                            where province_code=%(province_code)s and city_code=%(city_code)s \
+                            and (%(town_code)s='-1' or town_code=%(town_code)s) \
+                            and id>%(begin_id)s and id<=%(end_id)s order by id"
+    stmt_export_user_digest_range = "select id, MD5(CONCAT_WS('#', id, uid, MD5(pic_md5), province_code, city_code, town_code)) as digest \
+                            from user \
+                            where province_code=%(province_code)s and city_code=%(city_code)s \
+                            and (%(town_code)s='-1' or town_code=%(town_code)s) \
+                            and id>%(begin_id)s and id<=%(end_id)s order by id"
+    stmt_export_feature_model_0330_range = "select * from feature_model_0330 \
+                                            where province_code=%(province_code)s and city_code=%(city_code)s \
+                                            and (%(town_code)s='-1' or town_code=%(town_code)s) \
+                                            and id>%(begin_id)s and id<=%(end_id)s order by id"
+    stmt_export_feature_model_0330_time_range = "select id, timestamp from feature_model_0330 \
+                                            where province_code=%(province_code)s and city_code=%(city_code)s \
+                                            and (%(town_code)s='-1' or town_code=%(town_code)s) \
+                                            and id>%(begin_id)s and id<=%(end_id)s order by id"
+
+    # 按 id 分桶的摘要: 行数 + 每一行内容 md5 的前 64 位按位异或，与客户端云端的计算方式相同
+    stmt_get_user_range_digest = "select (id - %(begin_id)s - 1) DIV %(bucket_size)s as bucket, count(*) as count, \
+                            BIT_XOR(CAST(CONV(SUBSTRING(MD5(CONCAT_WS('#', id, uid, MD5(pic_md5), \
+                                province_code, city_code, town_code)), 1, 16), 16, 10) AS UNSIGNED)) as digest \
+                            from user \
+                            where province_code=%(province_code)s and city_code=%(city_code)s \
+                            and (%(town_code)s='-1' or town_code=%(town_code)s) \
+                            and id>%(begin_id)s and id<=%(end_id)s group by bucket"
+    stmt_get_feature_model_0330_range_digest = "select (id - %(begin_id)s - 1) DIV %(bucket_size)s as bucket, count(*) as count, \
+                            BIT_XOR(CAST(CONV(SUBSTRING(MD5(CONCAT_WS('#', id, user_id, timestamp, feature_id, MD5(feature), \
+                                province_code, city_code, town_code)), 1, 16), 16, 10) AS UNSIGNED)) as digest \
+                            from feature_model_0330 \
+                            where province_code=%(province_code)s and city_code=%(city_code)s \
+                            and (%(town_code)s='-1' or town_code=%(town_code)s) \
+                            and id>%(begin_id)s and id<=%(end_id)s group by bucket"
 
     def __init__(self):
         self._database_client = None
         self._request_handlers = {
             "get_sync_status": self.get_sync_status,
+            "get_range_digest": self.get_range_digest,
+            "get_database_stats": self.get_database_stats,
 
             "query_user_id_range": self.query_user_id_range,
             "query_user_range": self.query_user_range,
+            "query_user_digest_range": self.query_user_digest_range,
             "add_user": self.add_user,
             "del_user_by_id": self.del_user_by_id,
             "update_user": self.update_user,
+            "add_users_batch": self.add_users_batch,
+            "update_users_batch": self.update_users_batch,
 
             "query_feature_model_0330_id_range": self.query_feature_model_0330_id_range,
             "query_feature_model_0330_time_range": self.query_feature_model_0330_time_range,
             "add_feature_model_0330": self.add_feature_model_0330,
             "del_feature_model_0330_by_id": self.del_feature_model_0330_by_id,
             "update_feature_model_0330": self.update_feature_model_0330,
+            "add_feature_model_0330_batch": self.add_feature_model_0330_batch,
+            "update_feature_model_0330_batch": self.update_feature_model_0330_batch,
+
+            "batch": self.batch,
+        }
+        # batch 中支持的命令: (语句, 表, 是否删除)，upsert_* 依次执行更新和不存在时插入两条语句
+        self._batch_commands = {
+            "add_user": ((self.stmt_add_user,), "user", False),
+            "update_user": ((self.stmt_update_user,), "user", False),
+            "upsert_user": ((self.stmt_update_user, self.stmt_add_user_if_absent), "user", False),
+            "del_user_by_id": ((self.stmt_del_user_without_feature_by_id,), "user", True),
+            "add_feature_model_0330": ((self.stmt_add_feature_model_0330,), "feature_model_0330", False),
+            "update_feature_model_0330": ((self.stmt_update_feature_model_0330,), "feature_model_0330", False),
+            "upsert_feature_model_0330": ((self.stmt_update_feature_model_0330, self.stmt_add_feature_model_0330_if_absent),
+                                          "feature_model_0330", False),
+            "del_feature_model_0330_by_id": ((self.stmt_del_feature_model_0330_by_id,), "feature_model_0330", True),
+        }
+        self._export_statements = {
+            "export_user_id_range": self.stmt_export_user_id_range,
+            "export_user_range": self.stmt_export_user_range,
+            "export_user_digest_range": self.stmt_export_user_digest_range,
+            "export_feature_model_0330_range": self.stmt_export_feature_model_0330_range,
+            "export_feature_model_0330_time_range": self.stmt_export_feature_model_0330_time_range,
         }
         self._ssl_context = None
 
+        self._id_indexes = None
+        self._region_summary = None  # type: RegionSummary
+
     async def _initial_database_client(self):
         """
         初始化数据库连接
@@ -84,69 +182,328 @@ class FeatureDatabase(object):
                                     user=g_conf_parameter.mysql_user,
                                     password=g_conf_parameter.mysql_password,
                                     db=g_conf_parameter.mysql_db,
-                                    ssl=self._ssl_context)
+                                    ssl=self._ssl_context,
+                                    minsize=g_conf_parameter.mysql_pool_minsize,
+                                    maxsize=g_conf_parameter.mysql_pool_maxsize,
+                                    max_retries=g_conf_parameter.mysql_max_retries,
+                                    ping_idle=g_conf_parameter.mysql_ping_idle,
+                                    pool_recycle=g_conf_parameter.mysql_pool_recycle)
         await self._database_client.create_pool()
 
+    async def start(self):
+        """
+        worker 启动时（before_server_start）调用: 创建连接池并预先建立 minsize 个连接，打开共享索引
+        """
+        if self._database_client is None:
+            await self._initial_database_client()
+        self._initial_id_indexes()
+        if self._region_summary is None:
+            self._region_summary = RegionSummary(g_conf_parameter.status_cache_ttl)
+        logger.info("[database] pool ready, minsize: {}, maxsize: {}".format(
+                    g_conf_parameter.mysql_pool_minsize, g_conf_parameter.mysql_pool_maxsize))
+
     async def dispatch_request(self, data):
         command = data.get("command", "")
+        return await self._request_handlers.get(command, self.handler_default)(data)
 
+    def _initial_id_indexes(self):
+        """
+        打开配置的区域的共享索引，索引文件由主进程在启动 worker 之前生成
+        """
+        if g_conf_parameter.index_enable == 1 and g_conf_parameter.index_regions and self._id_indexes is None:
+            self._id_indexes = IdIndexes(get_state_dir(), g_conf_parameter.index_regions)
+
+    async def close(self):
+        if self._database_client is not None:
+            await self._database_client.close()
+            self._database_client = None
+        if self._id_indexes is not None:
+            self._id_indexes.close()
+            self._id_indexes = None
+
+    async def build_id_indexes(self):
+        """
+        从数据库生成所有区域的 (id, timestamp) 索引文件，在主进程中启动 worker 之前执行一次
+        """
+        self._initial_id_indexes()
+        if self._id_indexes is None:
+            return
+
+        commands = {
+            "user": "export_user_id_range",
+            "feature_model_0330": "export_feature_model_0330_time_range",
+        }
+        for (table, region), index in self._id_indexes.items():
+            data = dict(command=commands[table], province_code=region[0], city_code=region[1], town_code=region[2],
+                        begin_id=-1, end_id=2 ** 62)
+            records = []
+            async for rows in self.export_range(data, size=10000):
+                records.extend((row["id"], int(row.get("timestamp") or 0)) for row in rows)
+            SharedIdIndex.build(index.path, records)
+            logger.info("[id_index] build {} {}, records: {}".format(table, "/".join(region), len(records)))
+
+    async def check_region_indexes(self, regions):
+        """
+        启动时 EXPLAIN 每个区域（整个城市和按区县两种语句）按 id 的范围查询，没有用到 sql/region_index.sql 中的索引时打印警告
+        """
+        if self._database_client is None:
+            try:
+                await self._initial_database_client()
+            except Exception as e:
+                logger.warning("[region_index] skip index check, connect database failed: {}".format(e))
+                self._database_client = None
+                return
+
+        statements = {
+            "query_user_id_range": self.stmt_query_user_id_range,
+            "query_feature_model_0330_time_range": self.stmt_query_feature_model_0330_time_range,
+        }
+        for province_code, city_code, town_code in regions:
+            for name, statement in statements.items():
+                await check_region_index(self._database_client, name, statement,
+                                         dict(province_code=province_code, city_code=city_code, town_code=town_code,
+                                              begin_id=-1, end_id=2 ** 31, limit=DEFAULT_PAGE_SIZE))
+
+    def _get_id_index(self, table, data):
+        if self._id_indexes is None:
+            return None
+        return self._id_indexes.get(table, data)
+
+    def support_export(self, command):
+        return command in self._export_statements
+
+    async def export_range(self, data, size=1000):
+        """
+        流式导出 (begin_id, end_id] 内的所有行，每次返回最多 size 行，command 见 _export_statements
+        """
         if self._database_client is None:
             await self._initial_database_client()
-            
-        return await self._request_handlers.get(command, self.handler_default)(data)
+
+        parameter = dict(province_code=data.get("province_code"),
+                         city_code=data.get("city_code"),
+                         town_code=data.get("town_code", "-1"),
+                         begin_id=int(data["begin_id"]),
+                         end_id=int(data["end_id"]))
+        statement = region_statement(self._export_statements[data["command"]], parameter["town_code"])
+        async for rows in self._database_client.iterate(statement, parameter, size):
+            yield rows
 
     async def handler_default(self, data):
         return common_result(code=101, desc="no support command <{}>".format(data.get("command", "")), data=data)
 
     async def get_sync_status(self, data):
         """
-        获取同步状态
+        获取同步状态: 区域内两张表的最大 id 和最后修改的时间，按区域缓存，见 RegionSummary；
+        有共享索引时最大 id 和行数每次从索引取（所有 worker 的写都能看到），没有索引时不统计行数，行数为 None
         :return:
         """
-        max_feature_model_0330_id = await self._database_client.query_one(self.stmt_get_max_feature_model_0330_id,
-                                                                            parameter=data)
-        max_feature_model_0330_id = max_feature_model_0330_id["id"]
-        if max_feature_model_0330_id is None:
-            max_feature_model_0330_id = -1
-
-        max_user_id = await self._database_client.query_one(self.stmt_get_max_user_id,
-                                                            parameter=data)
-        max_user_id = max_user_id["id"]
-        if max_user_id is None:
-            max_user_id = -1
-
-        ret = {
-            'user_id': max_user_id,
-            'feature_model_0330_id': max_feature_model_0330_id
-        }
-        return common_result(data=ret)
+        region = RegionSummary.region(data)
+        status = self._region_summary.get(region)
+        if status is None:
+            max_user_id, max_feature_model_0330_id, change_time = await asyncio.gather(
+                self._get_max_id("user", self.stmt_get_max_user_id, data),
+                self._get_max_id("feature_model_0330", self.stmt_get_max_feature_model_0330_id, data),
+                self._database_client.query_one(self.stmt_get_change_time))
+            status = {
+                'user_id': max_user_id,
+                'feature_model_0330_id': max_feature_model_0330_id,
+                'change_time': int(change_time["change_time"]) if change_time and change_time["change_time"] is not None else None
+            }
+            self._region_summary.set(region, status)
+
+        status = dict(status, user_count=None, feature_model_0330_count=None)
+        for table in IdIndexes.tables:
+            index = self._get_id_index(table, data)
+            if index is not None:
+                status["{}_id".format(table)], status["{}_count".format(table)] = index.max_id(), index.count()
+        return common_result(data=status)
+
+    async def _get_max_id(self, table, statement, data):
+        index = self._get_id_index(table, data)
+        if index is not None:
+            return index.max_id()
+
+        content = await self._database_client.query_one(region_statement(statement, data.get("town_code")), parameter=data)
+        if content["id"] is None:
+            return -1
+        return content["id"]
+
+    async def get_database_stats(self, data):
+        """
+        本 worker 数据库连接池的指标: 连接数、空闲连接数、重建次数、丢弃的连接数、重试次数、ping 失败次数、取连接的等待时间
+        """
+        return common_result(data=self.database_stats())
+
+    def database_stats(self):
+        return self._database_client.stats() if self._database_client is not None else {}
+
+    def support_command(self, command):
+        return command in self._request_handlers
+
+    async def get_range_digest(self, data):
+        """
+        把 (begin_id, end_id] 平均分成 bucket_count 个桶，返回每个非空桶的摘要
+        [{"begin_id": 1, "end_id": 2, "count": 1, "digest": 123}, ...]
+        """
+        statement = {
+            "user": self.stmt_get_user_range_digest,
+            "feature_model_0330": self.stmt_get_feature_model_0330_range_digest,
+        }.get(data.get("table"))
+        if statement is None:
+            return common_result(code=101, desc="no support table <{}>".format(data.get("table")))
+
+        begin_id, end_id = int(data["begin_id"]), int(data["end_id"])
+        bucket_size = max(1, -(-(end_id - begin_id) // int(data.get("bucket_count", 16))))
+        parameter = dict(province_code=data.get("province_code"),
+                         city_code=data.get("city_code"),
+                         town_code=data.get("town_code", "-1"),
+                         begin_id=begin_id,
+                         end_id=end_id,
+                         bucket_size=bucket_size)
+        content = await self._database_client.query_all(region_statement(statement, parameter["town_code"]), parameter=parameter)
+
+        buckets = [dict(begin_id=begin_id + c["bucket"] * bucket_size,
+                        end_id=min(end_id, begin_id + (c["bucket"] + 1) * bucket_size),
+                        count=c["count"],
+                        digest=int(c["digest"])) for c in content]
+        return common_result(data=buckets)
+
+    @staticmethod
+    def _range_parameter(data):
+        """
+        按 id 顺序分页查询的参数: limit 为每页行数，默认 DEFAULT_PAGE_SIZE，最多 MAX_PAGE_SIZE
+        GET 的参数都是字符串，LIMIT 需要整数
+        """
+        parameter = dict(data)
+        parameter["limit"] = max(1, min(MAX_PAGE_SIZE, int(data.get("limit", DEFAULT_PAGE_SIZE))))
+        return parameter
 
     async def query_user_id_range(self, data):
-        content = await self._database_client.query_all(self.stmt_query_user_id_range,
-                                                        parameter=data)
+        index = self._get_id_index("user", data)
+        if index is not None:
+            parameter = self._range_parameter(data)
+            records = index.range(int(parameter["begin_id"]), int(parameter["end_id"]), parameter["limit"])
+            return common_result(data=[dict(id=_id) for _id, _ in records])
+
+        content = await self._database_client.query_all(region_statement(self.stmt_query_user_id_range, data.get("town_code")),
+                                                        parameter=self._range_parameter(data))
             
         return common_result(data=content)
 
     async def query_user_range(self, data):
-        content = await self._database_client.query_all(self.stmt_query_user_range,
-                                                        parameter=data)
+        content = await self._database_client.query_all(region_statement(self.stmt_query_user_range, data.get("town_code")),
+                                                        parameter=self._range_parameter(data))
 
         # content 值 ((7026, '42489ff329f4456a8f241df79de797f1', b'python2的pickle编码的二进制', '510000', '511102', '511100'),)
-        for c in content:
-            if isinstance(c["pic_md5"], bytes):
-                c["pic_md5"] = base64.b64encode(c["pic_md5"]).decode()
-            
+        # pic_md5 保持 bytes，msgpack 响应中原样传输，json 响应中编码成 base64（lib.wire_format）
         return common_result(data=content)
 
-    async def add_user(self, data):
-        values = data.get("values")
+    async def query_user_digest_range(self, data):
+        content = await self._database_client.query_all(region_statement(self.stmt_query_user_digest_range, data.get("town_code")),
+                                                        parameter=self._range_parameter(data))
 
-        # 为了方便传输，values["pic_md5"] 是经过编码的 base64.b64encode(c["pic_md5"]).decode()，这里解码
-        if values["pic_md5"] is not None:
-            values["pic_md5"] = base64.b64decode(values["pic_md5"].encode())
+        return common_result(data=content)
+
+    async def _execute_batch(self, statement, values_list, fast_path, table):
+        """
+        整页数据在一个事务中写入，返回每一行的结果 [{"id": 1, "code": 0, "desc": "sucess"}, ...]
+        """
+        results = await self._database_client.execute_batch(statement, values_list, fast_path=fast_path)
+
+        content = []
+        failed_count = 0
+        for values, (row_count, errmsg) in zip(values_list, results):
+            if errmsg is None and row_count > 0:
+                content.append(common_result(data=values["id"]))
+            else:
+                failed_count += 1
+                content.append(common_result(code=102, desc=errmsg or "no row affected", data=values["id"]))
+
+        self._on_write(table, [values for values, result in zip(values_list, content) if result["code"] == 0])
+
+        logger.debug("batch write {} rows: {}, failed: {}".format(table, len(values_list), failed_count))
+        return common_result(data=content)
+
+    async def batch(self, data):
+        """
+        在一个事务中按顺序执行多条命令，commands 的每一项与单独请求时的参数相同（add_* / update_* / upsert_* 带 values，del_* 带 id）
+        fail_fast 为 1（默认）时任意一条失败则全部回滚，code 为 102；为 0 时只跳过失败的命令
+        upsert_* 行存在时更新（内容相同也算成功），不存在时插入，重复执行结果相同；删除不存在的行也算成功
+        del_user_by_id 在 user 还有 feature 时不删除，不算失败，结果的 code 为 104（推迟到 feature 删除之后）
+        返回每一条命令的结果 [{"code": 0, "desc": "sucess", "data": id}, ...]
+        """
+        commands = data.get("commands") or []
+        fail_fast = int(data.get("fail_fast", 1)) == 1
+
+        operations = []
+        for command in commands:
+            if command.get("command") not in self._batch_commands:
+                return common_result(code=101, desc="no support command <{}> in batch".format(command.get("command")))
+            statements, _, is_delete = self._batch_commands[command["command"]]
+            if is_delete:
+                # 删除没有影响任何行不算失败，带条件的 user 删除见下面的 104
+                operations.append((statements[0], dict(id=command.get("id")), True))
+                continue
+            parameter = decode_bytes_fields(command.get("values"))
+            # upsert_* 的两条语句只有一条会影响行，行内容没有变化时 MySQL 的更新也不影响行
+            allow_empty = len(statements) > 1
+            operations.extend((statement, parameter, allow_empty) for statement in statements)
+
+        committed, results = await self._database_client.execute_transaction(operations, fail_fast=fail_fast)
+
+        content = []
+        offset = 0
+        for command in commands:
+            statements, table, is_delete = self._batch_commands[command["command"]]
+            parameter = operations[offset][1]
+            command_results = results[offset:offset + len(statements)]
+            offset += len(statements)
+
+            errmsg = next((errmsg for _, errmsg in command_results if errmsg is not None), None)
+            if not committed and errmsg in (None, "not executed"):
+                # 回滚时只有失败的那一条是 102，之前已执行的和之后没有执行的都是 103
+                content.append(common_result(code=103, desc="rollback", data=parameter["id"]))
+                continue
+            if errmsg is not None:
+                content.append(common_result(code=102, desc=errmsg, data=parameter["id"]))
+                continue
+            if is_delete and table == "user" and command_results[0][0] == 0:
+                content.append(common_result(code=104, desc="deferred, user not found or has feature", data=parameter["id"]))
+                continue
+            content.append(common_result(data=parameter["id"]))
+            if is_delete:
+                self._on_delete(table, [parameter["id"]])
+            else:
+                self._on_write(table, [parameter])
+
+        logger.debug("batch commands: {}, committed: {}, failed: {}".format(
+                     len(commands), committed, len([result for result in content if result["code"] != 0])))
+        if not committed:
+            return common_result(code=102, desc="rollback", data=content)
+        return common_result(data=content)
+
+    def _on_write(self, table, values_list: List[Dict[Any, Any]]):
+        """
+        写操作成功后更新共享索引和区域的同步状态
+        """
+        if self._id_indexes is not None:
+            self._id_indexes.on_write(table, values_list)
+        if self._region_summary is not None:
+            self._region_summary.on_write(table, values_list)
+
+    def _on_delete(self, table, ids: List[int]):
+        ids = [int(_id) for _id in ids]
+        if self._id_indexes is not None:
+            self._id_indexes.on_delete(table, ids)
+        if self._region_summary is not None:
+            self._region_summary.on_delete(table, ids)
+
+    async def add_user(self, data):
+        values = decode_bytes_fields(data.get("values"))
 
         row_count, _ = await self._database_client.execute(self.stmt_add_user, parameter=values)
         assert row_count > 0, "fail to insert user:{}".format(values)
+        self._on_write("user", [values])
 
         logger.debug("insert data {} success".format(values))
         return common_result(data=row_count)
@@ -161,42 +518,59 @@ class FeatureDatabase(object):
 
         row_count, _ = await self._database_client.execute(self.stmt_del_user_by_id, parameter=data)
         assert row_count > 0, "not found user row with id: {}".format(data)
+        self._on_delete("user", [user_id])
 
         logger.debug("delete data {} success".format(data))
         return common_result(data=row_count)
 
     async def update_user(self, data):
-        values = data.get("values")
-
-        # 为了方便传输，values["pic_md5"] 是经过编码的 base64.b64encode(c["pic_md5"]).decode()，这里解码
-        if values["pic_md5"] is not None:
-            values["pic_md5"] = base64.b64decode(values["pic_md5"].encode())
+        values = decode_bytes_fields(data.get("values"))
 
         row_count, _ = await self._database_client.execute(self.stmt_update_user, parameter=values)
         assert row_count > 0, "fail to update user:{}".format(values)
+        self._on_write("user", [values])
 
         logger.debug("update data {} success".format(values))
         return common_result(data=row_count)
 
+    async def add_users_batch(self, data):
+        values_list = [decode_bytes_fields(values) for values in data.get("values") or []]
+        return await self._execute_batch(self.stmt_add_user, values_list, True, "user")
+
+    async def update_users_batch(self, data):
+        values_list = [decode_bytes_fields(values) for values in data.get("values") or []]
+        return await self._execute_batch(self.stmt_update_user, values_list, False, "user")
+
     async def query_feature_model_0330_id_range(self, data):
-        content = await self._database_client.query_all(self.stmt_query_feature_model_0330_id_range,
-                                                        parameter=data)
+        index = self._get_id_index("feature_model_0330", data)
+        if index is not None:
+            parameter = self._range_parameter(data)
+            records = index.range(int(parameter["begin_id"]), int(parameter["end_id"]), parameter["limit"])
+            return common_result(data=[dict(id=_id) for _id, _ in records])
+
+        content = await self._database_client.query_all(region_statement(self.stmt_query_feature_model_0330_id_range, data.get("town_code")),
+                                                        parameter=self._range_parameter(data))
             
         return common_result(data=content)
 
     async def query_feature_model_0330_time_range(self, data):
-        content = await self._database_client.query_all(self.stmt_query_feature_model_0330_time_range,
-                                                        parameter=data)
+        index = self._get_id_index("feature_model_0330", data)
+        if index is not None:
+            parameter = self._range_parameter(data)
+            records = index.range(int(parameter["begin_id"]), int(parameter["end_id"]), parameter["limit"])
+            return common_result(data=[dict(id=_id, timestamp=timestamp) for _id, timestamp in records])
+
+        content = await self._database_client.query_all(region_statement(self.stmt_query_feature_model_0330_time_range, data.get("town_code")),
+                                                        parameter=self._range_parameter(data))
             
         return common_result(data=content)
 
     async def add_feature_model_0330(self, data):
-        values = data.get("values")
-        if values["feature"] is not None:
-            values["feature"] = values["feature"].encode()
+        values = decode_bytes_fields(data.get("values"))
 
         row_count, _ = await self._database_client.execute(self.stmt_add_feature_model_0330, parameter=values)
         assert row_count > 0, "fail to insert feature_model_0330:{}".format(values)
+        self._on_write("feature_model_0330", [values])
 
         logger.debug("insert data {} success".format(values))
         return common_result(data=row_count)
@@ -204,15 +578,23 @@ class FeatureDatabase(object):
     async def del_feature_model_0330_by_id(self, data):
         row_count, _ = await self._database_client.execute(self.stmt_del_feature_model_0330_by_id, parameter=data)
         assert row_count > 0, "not found feature_model_0330 row with id: {}".format(data)
+        self._on_delete("feature_model_0330", [data.get("id")])
         return common_result(data=row_count)
 
     async def update_feature_model_0330(self, data):
-        values = data.get("values")
-        if values["feature"] is not None:
-            values["feature"] = values["feature"].encode()
+        values = decode_bytes_fields(data.get("values"))
 
         row_count, _ = await self._database_client.execute(self.stmt_update_feature_model_0330, parameter=values)
         assert row_count > 0, "fail to update feature_model_0330:{}".format(values)
+        self._on_write("feature_model_0330", [values])
 
         logger.debug("update data {} success".format(values))
         return common_result(data=row_count)
+
+    async def add_feature_model_0330_batch(self, data):
+        values_list = [decode_bytes_fields(values) for values in data.get("values") or []]
+        return await self._execute_batch(self.stmt_add_feature_model_0330, values_list, True, "feature_model_0330")
+
+    async def update_feature_model_0330_batch(self, data):
+        values_list = [decode_bytes_fields(values) for values in data.get("values") or []]
+        return await self._execute_batch(self.stmt_update_feature_model_0330, values_list, False, "feature_model_0330")
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import mmap
+import fcntl
+import struct
+import contextlib
+from typing import Dict, List, Tuple, Any
+
+from lib.logger import logger
+
+HEADER = struct.Struct("<8sq")  # magic, count
+MAGIC = b"IDINDEX1"
+RECORD_SIZE = 16  # id, timestamp 各 8 字节
+MIN_CAPACITY = 1024
+
+
+class SharedIdIndex(object):
+    """
+    一个区域一张表的 (id, timestamp) 索引，按 id 排序存放在 mmap 的文件中，所有 worker 进程共享
+    读写都在文件锁（flock）中进行；空间不够时文件扩大一倍，其他进程下次加锁时发现文件变大后重新映射
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._mm = None
+        self._values = None  # memoryview，按 int64 访问: [id0, timestamp0, id1, timestamp1, ...]
+
+    @staticmethod
+    def build(path, records: List[Tuple[int, int]]):
+        """
+        用按 id 排序的 [(id, timestamp), ...] 重新生成索引文件，写入临时文件后替换
+        """
+        capacity = max(MIN_CAPACITY, len(records) * 2)
+        tmp_path = "{}.tmp".format(path)
+        with open(tmp_path, "wb") as f:
+            f.write(HEADER.pack(MAGIC, len(records)))
+            for i in range(0, len(records), 65536):
+                chunk = records[i:i + 65536]
+                f.write(struct.pack("<{}q".format(len(chunk) * 2), *[value for record in chunk for value in record]))
+            f.truncate(HEADER.size + capacity * RECORD_SIZE)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def range(self, begin_id, end_id, limit) -> List[Tuple[int, int]]:
+        """
+        按 id 顺序返回 (begin_id, end_id] 内最多 limit 个 (id, timestamp)
+        """
+        with self._locked(exclusive=False):
+            count = self._count()
+            lo = self._upper_bound(begin_id, count)
+            hi = min(lo + limit, self._upper_bound(end_id, count))
+            if hi <= lo:
+                return []
+            values = self._values[lo * 2:hi * 2].tolist()
+            return list(zip(values[0::2], values[1::2]))
+
+    def max_id(self):
+        with self._locked(exclusive=False):
+            count = self._count()
+            return self._values[(count - 1) * 2] if count > 0 else -1
+
+    def count(self):
+        with self._locked(exclusive=False):
+            return self._count()
+
+    def upsert(self, records: List[Tuple[int, int]]):
+        if not records:
+            return
+        with self._locked(exclusive=True):
+            count = self._count()
+            for _id, timestamp in records:
+                i = self._lower_bound(_id, count)
+                if i < count and self._values[i * 2] == _id:
+                    self._values[i * 2 + 1] = timestamp
+                    continue
+
+                if (count + 1) * RECORD_SIZE + HEADER.size > len(self._mm):
+                    self._grow()
+                # 大部分插入是追加在最后，不需要移动
+                offset = HEADER.size + i * RECORD_SIZE
+                if i < count:
+                    self._mm.move(offset + RECORD_SIZE, offset, (count - i) * RECORD_SIZE)
+                self._values[i * 2] = _id
+                self._values[i * 2 + 1] = timestamp
+                count += 1
+            self._set_count(count)
+
+    def delete(self, ids: List[int]):
+        if not ids:
+            return
+        with self._locked(exclusive=True):
+            count = self._count()
+            for _id in ids:
+                i = self._lower_bound(_id, count)
+                if i >= count or self._values[i * 2] != _id:
+                    continue
+                offset = HEADER.size + i * RECORD_SIZE
+                if i < count - 1:
+                    self._mm.move(offset, offset + RECORD_SIZE, (count - i - 1) * RECORD_SIZE)
+                count -= 1
+            self._set_count(count)
+
+    def close(self):
+        self._unmap()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    @contextlib.contextmanager
+    def _locked(self, exclusive):
+        if self._file is None:
+            self._file = open(self.path, "r+b")
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            if self._mm is None or len(self._mm) != os.fstat(self._file.fileno()).st_size:
+                self._map()
+            yield
+        finally:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+
+    def _map(self):
+        self._unmap()
+        self._mm = mmap.mmap(self._file.fileno(), 0)
+        magic, _ = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            raise ValueError("invalid id index file <{}>".format(self.path))
+        self._values = memoryview(self._mm)[HEADER.size:].cast("q")
+
+    def _unmap(self):
+        if self._values is not None:
+            self._values.release()
+            self._values = None
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+
+    def _grow(self):
+        capacity = (len(self._mm) - HEADER.size) // RECORD_SIZE * 2
+        self._file.truncate(HEADER.size + capacity * RECORD_SIZE)
+        self._map()
+        logger.info("[id_index] {} grow to {} records".format(self.path, capacity))
+
+    def _count(self):
+        return HEADER.unpack_from(self._mm, 0)[1]
+
+    def _set_count(self, count):
+        HEADER.pack_into(self._mm, 0, MAGIC, count)
+
+    def _lower_bound(self, _id, count):
+        """
+        第一个 id >= _id 的位置
+        """
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._values[mid * 2] < _id:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _upper_bound(self, _id, count):
+        """
+        第一个 id > _id 的位置
+        """
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._values[mid * 2] <= _id:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+
+class IdIndexes(object):
+    """
+    配置的每个区域、每张表一个 SharedIdIndex；town_code 为 -1 的区域包含整个城市
+    写操作成功后调用 on_write / on_delete 保持索引与数据库一致；行被更新到其他区域时从原区域的索引中删除
+    """
+    tables = ("user", "feature_model_0330")
+
+    def __init__(self, state_dir, regions: List[Tuple[str, str, str]]):
+        self._regions = list(regions)
+        self._indexes = {}  # type: Dict[Tuple[str, Tuple[str, str, str]], SharedIdIndex]
+        for table in self.tables:
+            for region in self._regions:
+                path = os.path.join(state_dir, "id_index.{}.{}.mmap".format(table, "_".join(region)))
+                self._indexes[(table, region)] = SharedIdIndex(path)
+
+    def items(self):
+        return list(self._indexes.items())
+
+    def get(self, table, data) -> SharedIdIndex:
+        """
+        data 为请求参数，没有这个区域的索引时返回 None
+        """
+        region = (data.get("province_code"), data.get("city_code"), data.get("town_code") or "-1")
+        return self._indexes.get((table, region))
+
+    def on_write(self, table, values_list: List[Dict[Any, Any]]):
+        for region in self._regions:
+            index = self._indexes[(table, region)]
+            index.upsert([self._record(values) for values in values_list if self._match(region, values)])
+            index.delete([values["id"] for values in values_list if not self._match(region, values)])
+
+    def on_delete(self, table, ids: List[int]):
+        for region in self._regions:
+            self._indexes[(table, region)].delete(ids)
+
+    def close(self):
+        for index in self._indexes.values():
+            index.close()
+
+    @staticmethod
+    def _match(region, values):
+        province_code, city_code, town_code = region
+        return values.get("province_code") == province_code and values.get("city_code") == city_code \
+            and (town_code == "-1" or values.get("town_code") == town_code)
+
+    @staticmethod
+    def _record(values):
+        return int(values["id"]), int(values.get("timestamp") or 0)
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import glob
+import json
+import time
+import bisect
+import collections
+from typing import Dict, List, Any
+
+from lib.logger import logger
+
+# 请求耗时直方图的桶（秒）
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# 数据库连接池的指标，MysqlClient.stats() 中的计数器和当前值
+POOL_COUNTERS = ("pool_rebuild", "connection_discard", "retry", "ping_failed", "acquire_count", "acquire_wait_seconds")
+POOL_GAUGES = ("pool_size", "pool_free")
+
+
+class Metrics(object):
+    """
+    一个 worker 的请求指标: 按 command 统计请求数（按 code 分）、耗时直方图、行数、请求/响应字节数
+    每个 worker 定期把快照写到 state/metrics/worker.<pid>.json，/metrics 读取所有 worker 的快照相加后输出 Prometheus 文本格式
+    """
+    def __init__(self):
+        self._requests = collections.Counter()  # (command, code) -> 请求数
+        self._latency_buckets = collections.defaultdict(lambda: [0] * (len(LATENCY_BUCKETS) + 1))
+        self._latency_sum = collections.Counter()
+        self._rows = collections.Counter()
+        self._request_bytes = collections.Counter()
+        self._response_bytes = collections.Counter()
+
+    def observe(self, command, code, latency, rows=0, request_bytes=0, response_bytes=0):
+        self._requests[(command, code)] += 1
+        self._latency_buckets[command][bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+        self._latency_sum[command] += latency
+        self._rows[command] += rows
+        self._request_bytes[command] += request_bytes
+        self._response_bytes[command] += response_bytes
+
+    def snapshot(self, database_stats=None) -> Dict[str, Any]:
+        return dict(requests=[[command, code, count] for (command, code), count in self._requests.items()],
+                    latency_buckets=dict(self._latency_buckets),
+                    latency_sum=dict(self._latency_sum),
+                    rows=dict(self._rows),
+                    request_bytes=dict(self._request_bytes),
+                    response_bytes=dict(self._response_bytes),
+                    database=database_stats or {})
+
+    def dump(self, directory, database_stats=None):
+        """
+        原子地写入本 worker 的快照
+        """
+        path = os.path.join(directory, "worker.{}.json".format(os.getpid()))
+        tmp_path = "{}.tmp".format(path)
+        with open(tmp_path, "w") as f:
+            json.dump(self.snapshot(database_stats), f)
+        os.replace(tmp_path, path)
+
+
+def metrics_dir(state_dir):
+    directory = os.path.join(state_dir, "metrics")
+    if not os.path.isdir(directory):
+        os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def clear_snapshots(directory):
+    """
+    启动时删除上一次运行留下的快照
+    """
+    for path in glob.glob(os.path.join(directory, "worker.*.json")):
+        os.remove(path)
+
+
+def load_snapshots(directory, max_age) -> List[Dict[str, Any]]:
+    """
+    读取 max_age 秒内更新过的快照，更早的是已经退出的 worker
+    """
+    snapshots = []
+    now = time.time()
+    for path in glob.glob(os.path.join(directory, "worker.*.json")):
+        try:
+            if now - os.path.getmtime(path) > max_age:
+                continue
+            with open(path) as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError) as err:
+            logger.warning("[metrics] skip {}: {}".format(path, err))
+    return snapshots
+
+
+def _merge(snapshots: List[Dict[str, Any]]) -> Dict[str, Any]:
+    merged = dict(requests=collections.Counter(),
+                  latency_buckets=collections.defaultdict(lambda: [0] * (len(LATENCY_BUCKETS) + 1)),
+                  latency_sum=collections.Counter(),
+                  rows=collections.Counter(),
+                  request_bytes=collections.Counter(),
+                  response_bytes=collections.Counter(),
+                  database=collections.Counter())
+    for snapshot in snapshots:
+        for command, code, count in snapshot["requests"]:
+            merged["requests"][(command, code)] += count
+        for command, buckets in snapshot["latency_buckets"].items():
+            merged["latency_buckets"][command] = [a + b for a, b in zip(merged["latency_buckets"][command], buckets)]
+        for key in ("latency_sum", "rows", "request_bytes", "response_bytes", "database"):
+            merged[key].update(snapshot[key])
+    return merged
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(snapshots: List[Dict[str, Any]]) -> str:
+    """
+    所有 worker 的快照相加后输出 Prometheus 文本格式（text/plain; version=0.0.4）
+    """
+    merged = _merge(snapshots)
+    lines = []
+
+    def metric(name, metric_type, help_text, samples):
+        lines.append("# HELP {} {}".format(name, help_text))
+        lines.append("# TYPE {} {}".format(name, metric_type))
+        for suffix, labels, value in samples:
+            label_text = ",".join('{}="{}"'.format(key, _escape(label)) for key, label in labels)
+            lines.append("{}{}{} {}".format(name, suffix, "{" + label_text + "}" if label_text else "", _format_value(value)))
+
+    metric("feature_sync_requests_total", "counter", "Requests by command and response code.",
+           [("", (("command", command), ("code", code)), count)
+            for (command, code), count in sorted(merged["requests"].items())])
+
+    samples = []
+    for command, buckets in sorted(merged["latency_buckets"].items()):
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), buckets):
+            cumulative += count
+            samples.append(("_bucket", (("command", command), ("le", bound)), cumulative))
+        samples.append(("_sum", (("command", command),), merged["latency_sum"][command]))
+        samples.append(("_count", (("command", command),), cumulative))
+    metric("feature_sync_request_duration_seconds", "histogram", "Request latency by command.", samples)
+
+    metric("feature_sync_rows_total", "counter", "Rows returned or affected by command.",
+           [("", (("command", command),), count) for command, count in sorted(merged["rows"].items())])
+    metric("feature_sync_request_bytes_total", "counter", "Request body bytes by command.",
+           [("", (("command", command),), count) for command, count in sorted(merged["request_bytes"].items())])
+    metric("feature_sync_response_bytes_total", "counter", "Response body bytes by command.",
+           [("", (("command", command),), count) for command, count in sorted(merged["response_bytes"].items())])
+
+    for key in POOL_GAUGES:
+        metric("feature_sync_mysql_{}".format(key), "gauge", "MySQL pool {} summed over workers.".format(key.replace("_", " ")),
+               [("", (), merged["database"].get(key, 0))])
+    for key in POOL_COUNTERS:
+        metric("feature_sync_mysql_{}_total".format(key), "counter", "MySQL pool {} summed over workers.".format(key.replace("_", " ")),
+               [("", (), merged["database"].get(key, 0))])
+    metric("feature_sync_workers", "gauge", "Workers that reported metrics.", [("", (), len(snapshots))])
+
+    return "\n".join(lines) + "\n"
+
+
+def count_rows(data):
+    """
+    响应的 data 中的行数: 查询返回的行数，写操作影响的行数，批量写中成功的行数
+    """
+    if isinstance(data, list):
+        if data and isinstance(data[0], dict) and "code" in data[0]:
+            return len([result for result in data if result.get("code") == 0])
+        return len(data)
+    if isinstance(data, int) and not isinstance(data, bool):
+        return data
+    return 0
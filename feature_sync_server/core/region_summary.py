@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+from typing import Dict, List, Tuple, Any
+
+class RegionSummary(object):
+    """
+    每个 worker 一份，按区域缓存 get_sync_status 中从数据库查询的部分:
+        {"user_id": 最大 id, "feature_model_0330_id": ..., "change_time": 最后修改的时间戳}
+    本 worker 的写操作成功后直接更新缓存，不重新查询:
+        插入/更新: 行所在区域的最大 id 取较大值；其他区域的最大 id 正是这一行时行可能移出了这个区域，只有这个区域的缓存失效
+        删除: 最大 id 是删除的行的区域缓存失效，其他区域的最大 id 不变
+        最后修改的时间是整张表的，所有区域都更新
+    其他 worker 的写操作在 ttl 秒之后才能看到，ttl 需要大于客户端同步一轮的间隔，缓存才能命中
+    """
+    def __init__(self, ttl):
+        self._ttl = ttl
+        self._entries = {}  # type: Dict[Tuple[str, str, str], Tuple[float, Dict[str, Any]]]
+
+    @staticmethod
+    def region(data) -> Tuple[str, str, str]:
+        return data.get("province_code"), data.get("city_code"), data.get("town_code") or "-1"
+
+    def get(self, region):
+        entry = self._entries.get(region)
+        if entry is None or entry[0] < time.time():
+            return None
+        return entry[1]
+
+    def set(self, region, status: Dict[str, Any]):
+        if self._ttl > 0:
+            self._entries[region] = (time.time() + self._ttl, status)
+
+    def on_write(self, table, values_list: List[Dict[Any, Any]]):
+        if not values_list:
+            return
+
+        name = "{}_id".format(table)
+        now = int(time.time())
+        for region, (_, status) in list(self._entries.items()):
+            ids = [int(values["id"]) for values in values_list if self._match(region, values)]
+            if status[name] in [int(values["id"]) for values in values_list if not self._match(region, values)]:
+                del self._entries[region]
+                continue
+            if ids:
+                status[name] = max([status[name]] + ids)
+            if status["change_time"] is not None:
+                status["change_time"] = now
+
+    def on_delete(self, table, ids: List[int]):
+        if not ids:
+            return
+
+        name = "{}_id".format(table)
+        now = int(time.time())
+        for region, (_, status) in list(self._entries.items()):
+            if status[name] in ids:
+                del self._entries[region]
+                continue
+            if status["change_time"] is not None:
+                status["change_time"] = now
+
+    @staticmethod
+    def _match(region, values):
+        province_code, city_code, town_code = region
+        return values.get("province_code") == province_code and values.get("city_code") == city_code \
+            and (town_code == "-1" or values.get("town_code") == town_code)
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import copy
+import unittest
+
+from lib.testing import run
+
+from core.feature_database import FeatureDatabase
+from core.region_summary import RegionSummary
+
+
+class MemoryDatabaseClient(object):
+    """
+    FeatureDatabase 写语句的内存替身，execute_transaction 与 MysqlClient.execute_transaction 相同；
+    与没有设置 CLIENT.FOUND_ROWS 的 MySQL 一样，更新的内容没有变化时影响 0 行，id 或 uid 重复时插入失败
+    """
+    def __init__(self):
+        self.tables = {"user": {}, "feature_model_0330": {}}
+        self.queries = []
+        database = FeatureDatabase()  # single_ton，语句在实例上取
+        self._statements = {
+            database.stmt_add_user: ("user", self._insert),
+            database.stmt_add_user_if_absent: ("user", self._insert_if_absent),
+            database.stmt_update_user: ("user", self._update),
+            database.stmt_del_user_without_feature_by_id: ("user", self._delete_user),
+            database.stmt_add_feature_model_0330: ("feature_model_0330", self._insert),
+            database.stmt_add_feature_model_0330_if_absent: ("feature_model_0330", self._insert_if_absent),
+            database.stmt_update_feature_model_0330: ("feature_model_0330", self._update),
+            database.stmt_del_feature_model_0330_by_id: ("feature_model_0330", self._delete),
+        }
+
+    async def query_one(self, statement, parameter=None):
+        """
+        只支持 get_sync_status 的查询: 区域内的最大 id 和最后修改的时间
+        """
+        self.queries.append(statement)
+        if "information_schema" in statement:
+            return dict(change_time=1700000000)
+        table = "user" if " from user " in statement else "feature_model_0330"
+        ids = [row["id"] for row in self.tables[table].values()
+               if (row["province_code"], row["city_code"]) == (parameter["province_code"], parameter["city_code"])
+               and parameter.get("town_code", "-1") in ("-1", row["town_code"])]
+        return dict(id=max(ids) if ids else None)
+
+    async def execute_transaction(self, operations, fail_fast=True):
+        result = []
+        begin = copy.deepcopy(self.tables)
+        for operation in operations:
+            statement, parameter = operation[:2]
+            allow_empty = len(operation) > 2 and operation[2]
+            savepoint = copy.deepcopy(self.tables)
+            table, execute = self._statements[statement]
+            try:
+                row_count = execute(table, parameter)
+                result.append((row_count, None if row_count > 0 or allow_empty else "no row affected"))
+            except ValueError as err:
+                result.append((0, str(err)))
+            if result[-1][1] is not None:
+                if fail_fast:
+                    self.tables = begin
+                    result.extend((0, "not executed") for _ in operations[len(result):])
+                    return False, result
+                self.tables = savepoint
+        return True, result
+
+    def _check_unique(self, table, values):
+        for row in self.tables[table].values():
+            if table == "user" and row["id"] != values["id"] and row["uid"] == values["uid"]:
+                raise ValueError("Duplicate entry '{}' for key 'uid'".format(values["uid"]))
+
+    def _insert(self, table, values):
+        if values["id"] in self.tables[table]:
+            raise ValueError("Duplicate entry '{}' for key 'PRIMARY'".format(values["id"]))
+        self._check_unique(table, values)
+        self.tables[table][values["id"]] = dict(values)
+        return 1
+
+    def _insert_if_absent(self, table, values):
+        if values["id"] in self.tables[table]:
+            return 0
+        return self._insert(table, values)
+
+    def _update(self, table, values):
+        row = self.tables[table].get(values["id"])
+        if row is None or row == values:
+            return 0
+        self._check_unique(table, values)
+        self.tables[table][values["id"]] = dict(values)
+        return 1
+
+    def _delete(self, table, parameter):
+        return 1 if self.tables[table].pop(parameter["id"], None) is not None else 0
+
+    def _delete_user(self, table, parameter):
+        if any(row["user_id"] == parameter["id"] for row in self.tables["feature_model_0330"].values()):
+            return 0
+        return self._delete(table, parameter)
+
+
+def user(_id, uid=None, town_code="321102"):
+    return dict(id=_id, uid=uid or "uid{}".format(_id), pic_md5=b"\x00\xff", province_code="320000", city_code="321000",
+                town_code=town_code)
+
+
+def feature(_id, user_id, timestamp=1):
+    return dict(id=_id, user_id=user_id, timestamp=timestamp, feature_id=0, feature=b"\x01\x02", province_code="320000",
+                city_code="321000", town_code="321102")
+
+
+class FeatureDatabaseTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = MemoryDatabaseClient()
+        self.database = FeatureDatabase()
+        self.database._database_client = self.client
+        self.database._id_indexes = None
+        self.database._region_summary = None
+
+    def batch(self, commands, fail_fast=1):
+        return run(lambda: self.database.batch(dict(command="batch", fail_fast=fail_fast, commands=commands)))
+
+    @staticmethod
+    def codes(response):
+        return [result["code"] for result in response["data"]]
+
+
+class UpsertTest(FeatureDatabaseTestCase):
+    def test_apply_twice(self):
+        # CDC 重新读取同一批变更时同样的写再执行一次
+        commands = [dict(command="upsert_user", values=user(1)),
+                    dict(command="upsert_feature_model_0330", values=feature(10, 1))]
+        for _ in range(2):
+            response = self.batch(commands, fail_fast=0)
+            self.assertEqual(response["code"], 0)
+            self.assertEqual(self.codes(response), [0, 0])
+        self.assertEqual(self.client.tables["user"], {1: user(1)})
+        self.assertEqual(self.client.tables["feature_model_0330"], {10: feature(10, 1)})
+
+        commands = [dict(command="upsert_user", values=user(1, town_code="321111")),
+                    dict(command="upsert_feature_model_0330", values=feature(10, 1, timestamp=2))]
+        for _ in range(2):
+            self.assertEqual(self.codes(self.batch(commands, fail_fast=0)), [0, 0])
+        self.assertEqual(self.client.tables["user"], {1: user(1, town_code="321111")})
+        self.assertEqual(self.client.tables["feature_model_0330"], {10: feature(10, 1, timestamp=2)})
+
+    def test_delete_twice(self):
+        self.batch([dict(command="add_user", values=user(1)), dict(command="add_feature_model_0330", values=feature(10, 1))])
+        commands = [dict(command="del_feature_model_0330_by_id", id=10), dict(command="del_user_by_id", id=1)]
+        self.assertEqual(self.codes(self.batch(commands, fail_fast=0)), [0, 0])
+        # 删除不存在的 feature 算成功，不存在的 user 与还有 feature 时相同，推迟
+        self.assertEqual(self.codes(self.batch(commands, fail_fast=0)), [0, 104])
+        self.assertEqual(self.client.tables, {"user": {}, "feature_model_0330": {}})
+
+    def test_upsert_error(self):
+        self.batch([dict(command="add_user", values=user(1))])
+        commands = [dict(command="upsert_user", values=user(2, uid="uid1")),
+                    dict(command="upsert_user", values=user(3))]
+        response = self.batch(commands, fail_fast=0)
+        self.assertEqual(self.codes(response), [102, 0])
+        self.assertIn("Duplicate entry", response["data"][0]["desc"])
+        self.assertEqual(sorted(self.client.tables["user"]), [1, 3])
+
+
+class BatchTest(FeatureDatabaseTestCase):
+    def commands(self):
+        self.batch([dict(command="add_user", values=user(1))])
+        return [dict(command="add_user", values=user(2)),
+                dict(command="add_user", values=user(3, uid="uid1")),
+                dict(command="update_user", values=user(1, town_code="321111"))]
+
+    def test_fail_fast_rollback(self):
+        response = self.batch(self.commands(), fail_fast=1)
+        self.assertEqual((response["code"], response["desc"]), (102, "rollback"))
+        # 失败的那一条 102，之前已执行的和之后没有执行的 103
+        self.assertEqual(self.codes(response), [103, 102, 103])
+        self.assertEqual([result["data"] for result in response["data"]], [2, 3, 1])
+        self.assertEqual(self.client.tables["user"], {1: user(1)})
+
+    def test_continue(self):
+        response = self.batch(self.commands(), fail_fast=0)
+        self.assertEqual(response["code"], 0)
+        self.assertEqual(self.codes(response), [0, 102, 0])
+        self.assertIn("Duplicate entry", response["data"][1]["desc"])
+        self.assertEqual(self.client.tables["user"], {1: user(1, town_code="321111"), 2: user(2)})
+
+    def test_no_row_affected(self):
+        response = self.batch([dict(command="update_user", values=user(5)), dict(command="add_user", values=user(6))], fail_fast=0)
+        self.assertEqual(self.codes(response), [102, 0])
+        self.assertEqual(response["data"][0]["desc"], "no row affected")
+
+    def test_deferred_user_delete(self):
+        self.batch([dict(command="add_user", values=user(1)), dict(command="add_feature_model_0330", values=feature(10, 1))])
+        # 还有 feature 的 user 不删除，104 不算失败，fail_fast 时也不回滚
+        response = self.batch([dict(command="del_user_by_id", id=1), dict(command="add_user", values=user(2))], fail_fast=1)
+        self.assertEqual(response["code"], 0)
+        self.assertEqual(self.codes(response), [104, 0])
+        self.assertEqual(sorted(self.client.tables["user"]), [1, 2])
+
+        # feature 删除之后，同一个事务中后面的 user 删除成功
+        response = self.batch([dict(command="del_feature_model_0330_by_id", id=10), dict(command="del_user_by_id", id=1)])
+        self.assertEqual(self.codes(response), [0, 0])
+        self.assertEqual(sorted(self.client.tables["user"]), [2])
+
+    def test_unsupported_command(self):
+        response = self.batch([dict(command="add_user", values=user(1)), dict(command="query_user_range")])
+        self.assertEqual(response["code"], 101)
+        self.assertEqual(self.client.tables["user"], {})
+
+
+class SyncStatusTest(FeatureDatabaseTestCase):
+    def setUp(self):
+        super(SyncStatusTest, self).setUp()
+        self.database._region_summary = RegionSummary(60)
+
+    def get_sync_status(self, town_code="-1"):
+        response = run(lambda: self.database.get_sync_status(dict(province_code="320000", city_code="321000", town_code=town_code)))
+        return response["data"]
+
+    def test_cached_between_cycles(self):
+        self.batch([dict(command="add_user", values=user(1)), dict(command="add_feature_model_0330", values=feature(10, 1))])
+        self.assertEqual(self.get_sync_status(), dict(user_id=1, user_count=None, feature_model_0330_id=10,
+                                                      feature_model_0330_count=None, change_time=1700000000))
+        self.assertEqual(len(self.client.queries), 3)
+
+        # 本 worker 的写直接更新缓存，不重新查询
+        self.batch([dict(command="add_user", values=user(2)), dict(command="upsert_user", values=user(3, town_code="321111"))])
+        status = self.get_sync_status()
+        self.assertEqual((status["user_id"], status["feature_model_0330_id"]), (3, 10))
+        self.assertEqual(self.get_sync_status(town_code="321102")["user_id"], 2)
+        self.assertEqual(len(self.client.queries), 6)
+        self.get_sync_status()
+        self.assertEqual(len(self.client.queries), 6)
+
+        # 删除区域内最大 id 的行之后重新查询
+        self.batch([dict(command="del_user_by_id", id=3)])
+        self.assertEqual(self.get_sync_status()["user_id"], 2)
+        self.assertEqual(len(self.client.queries), 9)
+
+
+if __name__ == '__main__':
+    unittest.main()
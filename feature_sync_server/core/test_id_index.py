@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+
+from core.id_index import SharedIdIndex, IdIndexes, MIN_CAPACITY
+
+REGION = ("320000", "321000", "-1")
+TOWN = ("320000", "321000", "321102")
+
+
+def _upsert_main(path, begin_id, end_id):
+    index = SharedIdIndex(path)
+    index.upsert([(_id, _id * 10) for _id in range(begin_id, end_id)])
+    index.close()
+
+
+class SharedIdIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.state_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.state_dir)
+        self.path = os.path.join(self.state_dir, "id_index.mmap")
+
+    def index(self, records=()):
+        SharedIdIndex.build(self.path, list(records))
+        index = SharedIdIndex(self.path)
+        self.addCleanup(index.close)
+        return index
+
+    def test_empty(self):
+        index = self.index()
+        self.assertEqual((index.max_id(), index.count()), (-1, 0))
+        self.assertEqual(index.range(-1, 100, 10), [])
+
+    def test_upsert(self):
+        index = self.index([(2, 20), (4, 40)])
+        # 追加、插入到中间、更新已有的 id
+        index.upsert([(6, 60), (1, 10), (3, 30), (4, 41)])
+        self.assertEqual(index.range(-1, 100, 100), [(1, 10), (2, 20), (3, 30), (4, 41), (6, 60)])
+        self.assertEqual((index.max_id(), index.count()), (6, 5))
+
+    def test_delete(self):
+        index = self.index([(1, 10), (2, 20), (3, 30)])
+        index.delete([2, 5, 3])
+        self.assertEqual(index.range(-1, 100, 100), [(1, 10)])
+        self.assertEqual((index.max_id(), index.count()), (1, 1))
+        index.delete([1])
+        self.assertEqual((index.max_id(), index.count()), (-1, 0))
+
+    def test_range(self):
+        index = self.index([(_id, _id) for _id in range(2, 21, 2)])
+        # (begin_id, end_id]: 不包括 begin_id，包括 end_id
+        self.assertEqual([_id for _id, _ in index.range(4, 10, 100)], [6, 8, 10])
+        self.assertEqual([_id for _id, _ in index.range(3, 11, 2)], [4, 6])
+        self.assertEqual([_id for _id, _ in index.range(20, 100, 10)], [])
+        self.assertEqual([_id for _id, _ in index.range(-1, 1, 10)], [])
+        self.assertEqual(index.range(10, 4, 10), [])
+
+    def test_grow(self):
+        index = self.index()
+        records = [(_id, _id * 10) for _id in range(MIN_CAPACITY * 3, 0, -1)]
+        index.upsert(records)
+        self.assertEqual(index.count(), len(records))
+        self.assertEqual(index.range(-1, MIN_CAPACITY * 3, MIN_CAPACITY * 3), sorted(records))
+        self.assertGreaterEqual(os.path.getsize(self.path), MIN_CAPACITY * 3 * 16)
+
+    def test_second_mapping_sees_grow(self):
+        first = self.index([(1, 10)])
+        second = SharedIdIndex(self.path)
+        self.addCleanup(second.close)
+        self.assertEqual(second.count(), 1)
+        size = os.path.getsize(self.path)
+
+        first.upsert([(_id, _id * 10) for _id in range(2, MIN_CAPACITY + 2)])
+        self.assertGreater(os.path.getsize(self.path), size)
+        # second 还映射着原来大小的文件，加锁时发现文件变大后重新映射
+        self.assertEqual(second.count(), MIN_CAPACITY + 1)
+        self.assertEqual(second.max_id(), MIN_CAPACITY + 1)
+        second.upsert([(MIN_CAPACITY + 2, 1)])
+        self.assertEqual(first.max_id(), MIN_CAPACITY + 2)
+
+    def test_grow_in_other_process(self):
+        index = self.index([(1, 10)])
+        self.assertEqual(index.count(), 1)
+
+        processes = [multiprocessing.Process(target=_upsert_main, args=(self.path, begin_id, begin_id + MIN_CAPACITY))
+                     for begin_id in (2, MIN_CAPACITY + 2)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+            self.assertEqual(process.exitcode, 0)
+
+        self.assertEqual(index.count(), MIN_CAPACITY * 2 + 1)
+        self.assertEqual(index.max_id(), MIN_CAPACITY * 2 + 1)
+        self.assertEqual(index.range(MIN_CAPACITY, MIN_CAPACITY + 2, 10), [(MIN_CAPACITY + 1, (MIN_CAPACITY + 1) * 10),
+                                                                           (MIN_CAPACITY + 2, (MIN_CAPACITY + 2) * 10)])
+
+
+class IdIndexesTest(unittest.TestCase):
+    def setUp(self):
+        self.state_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.state_dir)
+        self.indexes = IdIndexes(self.state_dir, [REGION, TOWN])
+        for _, index in self.indexes.items():
+            SharedIdIndex.build(index.path, [])
+        self.addCleanup(self.indexes.close)
+
+    def ids(self, region):
+        index = self.indexes.get("feature_model_0330", dict(province_code=region[0], city_code=region[1], town_code=region[2]))
+        return [_id for _id, _ in index.range(-1, 100, 100)]
+
+    @staticmethod
+    def feature(_id, town_code="321102"):
+        return dict(id=_id, timestamp=_id * 10, province_code="320000", city_code="321000", town_code=town_code)
+
+    def test_move(self):
+        self.indexes.on_write("feature_model_0330", [self.feature(1), self.feature(2), self.feature(3, "321111")])
+        self.assertEqual((self.ids(REGION), self.ids(TOWN)), ([1, 2, 3], [1, 2]))
+
+        # 更新到同一个城市的其他区县: 从区县的索引中删除，城市的索引中保留
+        self.indexes.on_write("feature_model_0330", [self.feature(2, "321111")])
+        self.assertEqual((self.ids(REGION), self.ids(TOWN)), ([1, 2, 3], [1]))
+
+        # 更新到其他城市
+        self.indexes.on_write("feature_model_0330", [dict(self.feature(1), city_code="321100")])
+        self.assertEqual((self.ids(REGION), self.ids(TOWN)), ([2, 3], []))
+
+    def test_delete(self):
+        self.indexes.on_write("feature_model_0330", [self.feature(1), self.feature(2)])
+        self.indexes.on_delete("feature_model_0330", [1])
+        self.assertEqual((self.ids(REGION), self.ids(TOWN)), ([2], [2]))
+
+    def test_get(self):
+        self.assertIsNotNone(self.indexes.get("user", dict(province_code="320000", city_code="321000")))
+        self.assertIsNone(self.indexes.get("user", dict(province_code="320000", city_code="321100")))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import tempfile
+import unittest
+
+from core.metrics import Metrics, render, count_rows, load_snapshots
+
+
+def round_trip(metrics, database_stats=None):
+    return json.loads(json.dumps(metrics.snapshot(database_stats)))
+
+
+class RenderTest(unittest.TestCase):
+    def render(self):
+        first = Metrics()
+        first.observe("query_user", 0, 0.004, rows=3, request_bytes=10, response_bytes=100)
+        first.observe("query_user", 102, 0.2)
+        second = Metrics()
+        second.observe("query_user", 0, 0.02, rows=2)
+        second.observe('say "hi"\n', 0, 60.0)
+        snapshots = [round_trip(first, dict(pool_size=4, pool_free=1, retry=2)), round_trip(second, dict(pool_size=3, retry=1))]
+        return render(snapshots).splitlines()
+
+    def test_requests_summed(self):
+        lines = self.render()
+        self.assertIn('feature_sync_requests_total{command="query_user",code="0"} 2', lines)
+        self.assertIn('feature_sync_requests_total{command="query_user",code="102"} 1', lines)
+        self.assertIn('feature_sync_rows_total{command="query_user"} 5', lines)
+
+    def test_histogram_cumulative(self):
+        lines = self.render()
+        self.assertIn('feature_sync_request_duration_seconds_bucket{command="query_user",le="0.005"} 1', lines)
+        self.assertIn('feature_sync_request_duration_seconds_bucket{command="query_user",le="0.025"} 2', lines)
+        self.assertIn('feature_sync_request_duration_seconds_bucket{command="query_user",le="0.25"} 3', lines)
+        self.assertIn('feature_sync_request_duration_seconds_bucket{command="query_user",le="+Inf"} 3', lines)
+        self.assertIn('feature_sync_request_duration_seconds_count{command="query_user"} 3', lines)
+        self.assertIn('feature_sync_request_duration_seconds_sum{command="query_user"} 0.224', lines)
+
+    def test_escape_and_gauges(self):
+        lines = self.render()
+        self.assertIn('feature_sync_request_duration_seconds_bucket{command="say \\"hi\\"\\n",le="30.0"} 0', lines)
+        self.assertIn('feature_sync_request_duration_seconds_bucket{command="say \\"hi\\"\\n",le="+Inf"} 1', lines)
+        self.assertIn("feature_sync_mysql_pool_size 7", lines)
+        self.assertIn("feature_sync_mysql_pool_free 1", lines)
+        self.assertIn("feature_sync_mysql_retry_total 3", lines)
+        self.assertIn("feature_sync_workers 2", lines)
+
+    def test_empty(self):
+        lines = render([]).splitlines()
+        self.assertIn("# TYPE feature_sync_requests_total counter", lines)
+        self.assertIn("feature_sync_workers 0", lines)
+
+    def test_dump_and_load(self):
+        metrics = Metrics()
+        metrics.observe("query_user", 0, 0.01)
+        with tempfile.TemporaryDirectory() as directory:
+            metrics.dump(directory)
+            snapshots = load_snapshots(directory, max_age=60)
+            self.assertEqual(os.listdir(directory), ["worker.{}.json".format(os.getpid())])
+        self.assertEqual(snapshots, [round_trip(metrics)])
+
+
+class CountRowsTest(unittest.TestCase):
+    def test_count_rows(self):
+        self.assertEqual(count_rows([dict(id=1), dict(id=2)]), 2)
+        self.assertEqual(count_rows([dict(code=0), dict(code=102), dict(code=0)]), 2)
+        self.assertEqual(count_rows(3), 3)
+        self.assertEqual(count_rows(True), 0)
+        self.assertEqual(count_rows(None), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
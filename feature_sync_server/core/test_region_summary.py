@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import unittest
+from unittest import mock
+
+from core.region_summary import RegionSummary
+
+CITY = ("320000", "321000", "-1")
+TOWN = ("320000", "321000", "321102")
+OTHER_TOWN = ("320000", "321000", "321111")
+
+
+def row(_id, town_code="321102"):
+    return dict(id=_id, province_code="320000", city_code="321000", town_code=town_code)
+
+
+def status(user_id, feature_model_0330_id=-1, change_time=1):
+    return dict(user_id=user_id, feature_model_0330_id=feature_model_0330_id, change_time=change_time)
+
+
+class RegionSummaryTest(unittest.TestCase):
+    def summary(self, ttl=60):
+        summary = RegionSummary(ttl)
+        summary.set(CITY, status(10))
+        summary.set(TOWN, status(8))
+        summary.set(OTHER_TOWN, status(10))
+        return summary
+
+    def test_ttl(self):
+        summary = self.summary()
+        self.assertEqual(summary.get(RegionSummary.region(dict(province_code="320000", city_code="321000"))), status(10))
+        with mock.patch.object(time, "time", return_value=time.time() + 61):
+            self.assertIsNone(summary.get(CITY))
+
+        summary = RegionSummary(0)
+        summary.set(CITY, status(10))
+        self.assertIsNone(summary.get(CITY))
+
+    def test_insert(self):
+        summary = self.summary()
+        summary.on_write("user", [row(12), row(9)])
+        self.assertEqual(summary.get(CITY)["user_id"], 12)
+        self.assertEqual(summary.get(TOWN)["user_id"], 12)
+        # 其他区域的最大 id 不变，最后修改的时间是整张表的
+        self.assertEqual(summary.get(OTHER_TOWN)["user_id"], 10)
+        self.assertGreater(summary.get(OTHER_TOWN)["change_time"], 1)
+        self.assertEqual(summary.get(CITY)["feature_model_0330_id"], -1)
+
+    def test_update_moves_max_row(self):
+        summary = self.summary()
+        # id 10 是 OTHER_TOWN 的最大 id，更新到 TOWN 之后 OTHER_TOWN 的最大 id 未知
+        summary.on_write("user", [row(10)])
+        self.assertIsNone(summary.get(OTHER_TOWN))
+        self.assertEqual(summary.get(TOWN)["user_id"], 10)
+        self.assertEqual(summary.get(CITY)["user_id"], 10)
+
+    def test_delete(self):
+        summary = self.summary()
+        summary.on_delete("user", [5])
+        self.assertEqual([summary.get(region)["user_id"] for region in (CITY, TOWN, OTHER_TOWN)], [10, 8, 10])
+
+        summary.on_delete("user", [10])
+        self.assertIsNone(summary.get(CITY))
+        self.assertIsNone(summary.get(OTHER_TOWN))
+        self.assertEqual(summary.get(TOWN)["user_id"], 8)
+
+        # 其他表的删除不影响 user 的最大 id
+        summary.on_delete("feature_model_0330", [8])
+        self.assertEqual(summary.get(TOWN)["user_id"], 8)
+
+    def test_change_time_not_supported(self):
+        summary = RegionSummary(60)
+        summary.set(TOWN, status(8, change_time=None))
+        summary.on_write("user", [row(9)])
+        summary.on_delete("user", [1])
+        self.assertEqual(summary.get(TOWN), status(9, change_time=None))
+
+
+if __name__ == '__main__':
+    unittest.main()
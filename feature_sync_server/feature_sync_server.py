@@ -2,25 +2,76 @@
 # -*- coding: utf-8 -*-
 
 from sanic import Sanic
-from sanic.response import json as sa_json
+from sanic.response import json as sa_json, raw as sa_raw, stream as sa_stream
 import traceback
 import asyncio
 import argparse
+import time
 
 from lib.logger import logger
-from lib.utils import get_log_dir
+from lib.utils import get_log_dir, get_state_dir, common_result
+from lib.compression import Compression, choose_encoding, compress, decompress
+from lib import wire_format
 
 from core.conf_parameter import g_conf_parameter
 from core.feature_database import FeatureDatabase
+from core.metrics import Metrics, metrics_dir, clear_snapshots, load_snapshots, render, count_rows
 
 g_feature_database = FeatureDatabase()
+g_compression = None
+g_metrics = Metrics()
+g_metrics_task = None
+
+
+def compress_response(request, response):
+    """
+    按请求的 Accept-Encoding 压缩响应体，并在 Accept-Encoding 中声明可以解压的请求体格式（RFC 7694）
+    """
+    if g_compression is None or not g_compression.enabled:
+        return response
+
+    response.headers["Accept-Encoding"] = g_compression.accept_encoding
+    response.headers["Vary"] = "Accept-Encoding"
+    encoding = choose_encoding(request.headers.get("Accept-Encoding"), g_compression.encodings)
+    if encoding is not None and len(response.body) >= g_compression.min_size:
+        response.body = compress(response.body, encoding, g_compression.level)
+        response.headers["Content-Encoding"] = encoding
+    return response
+
+
+def load_request_data(request):
+    if request.method == "GET":
+        return request.raw_args
+
+    body = request.body
+    encoding = request.headers.get("Content-Encoding")
+    if encoding:
+        body = decompress(body, encoding.lower())
+    return wire_format.loads(body, request.headers.get("Content-Type"))
+
+
+def dump_response(request, response):
+    """
+    请求的 Accept 中有 msgpack 时返回 msgpack（bytes 原样传输），否则返回 json（bytes 编码成 base64），
+    浏览器/curl 调试时默认是 json
+    """
+    content_type = wire_format.choose_format(request.headers.get("Accept"), wire_format.available_formats())
+    if content_type == wire_format.MSGPACK:
+        return sa_raw(wire_format.dumps(response, content_type), content_type=content_type)
+    return sa_json(response, dumps=wire_format.json_dumps)
 
 
 def warpper_response(func):
-    async def warpper(*args, **kwargs):
+    """
+    func(request, context) 的返回值或异常转成 {"code": ..., "desc": ..., "data": ...}，
+    func 在 context["command"] 中填写命令，用于按命令统计请求数、耗时、行数和字节数
+    """
+    async def warpper(request, *args, **kwargs):
+        begin = time.time()
+        context = {}
         code, desc, ret = 0, "", {}
         try:
-            ret = await func(*args, **kwargs)
+            ret = await func(request, context, *args, **kwargs)
         except Exception as err:
             logger.error(traceback.format_exc())
             code, desc = 100, "{}".format(err)
@@ -33,17 +84,91 @@ def warpper_response(func):
             response.update(ret)
         else:
             response["data"] = ret
-        return sa_json(response)
+        http_response = compress_response(request, dump_response(request, response))
+        g_metrics.observe(context.get("command", "unknown"), response["code"], time.time() - begin,
+                          rows=count_rows(response.get("data")),
+                          request_bytes=len(request.body or b""),
+                          response_bytes=len(http_response.body))
+        return http_response
     return warpper
 
 
 @warpper_response
-async def process_feature_request(request):
-    data = request.raw_args if request.method == "GET" else request.json
+async def process_feature_request(request, context):
+    data = load_request_data(request)
+    command = data.get("command", "")
+    # 不支持的命令统一记为 unknown，避免任意的 command 产生大量的指标
+    context["command"] = command if g_feature_database.support_command(command) else "unknown"
     ret = await g_feature_database.dispatch_request(data)
     return ret
 
 
+async def process_export_request(request):
+    """
+    流式导出一个 id 区间: 每一行一条 json 记录（NDJSON），最后一行是 {"code": 0, "desc": "sucess", "data": 行数}，
+    出错时最后一行的 code 不为 0；没有最后一行说明连接中断，数据不完整
+    """
+    data = request.raw_args
+    command = data.get("command", "")
+    if not g_feature_database.support_export(command):
+        return sa_json(common_result(code=101, desc="no support command <{}>".format(command)))
+
+    async def streaming_fn(response):
+        begin = time.time()
+        count, size = 0, 0
+        try:
+            async for rows in g_feature_database.export_range(data):
+                count += len(rows)
+                chunk = "".join(wire_format.json_dumps(row) + "\n" for row in rows)
+                size += len(chunk)
+                await response.write(chunk)
+            trailer = common_result(data=count)
+        except Exception as err:
+            logger.error(traceback.format_exc())
+            trailer = common_result(code=100, desc="{}".format(err), data=count)
+        chunk = wire_format.json_dumps(trailer) + "\n"
+        await response.write(chunk)
+        g_metrics.observe(command, trailer["code"], time.time() - begin, rows=count, response_bytes=size + len(chunk))
+
+    return sa_stream(streaming_fn, content_type="application/x-ndjson")
+
+
+async def process_metrics_request(request):
+    """
+    所有 worker 的指标相加，Prometheus 文本格式；本 worker 的指标是最新的，其他 worker 的最多晚 flush_interval 秒
+    """
+    directory = metrics_dir(get_state_dir())
+    g_metrics.dump(directory, g_feature_database.database_stats())
+    snapshots = load_snapshots(directory, max_age=max(60, g_conf_parameter.metrics_flush_interval * 3))
+    return sa_raw(render(snapshots).encode(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+async def flush_metrics():
+    directory = metrics_dir(get_state_dir())
+    while True:
+        await asyncio.sleep(g_conf_parameter.metrics_flush_interval)
+        try:
+            g_metrics.dump(directory, g_feature_database.database_stats())
+        except Exception:
+            logger.error(traceback.format_exc())
+
+
+async def start_database(app, loop):
+    """
+    每个 worker 启动时创建自己的连接池，第一个请求不用等待建立连接；定期写出本 worker 的指标
+    """
+    await g_feature_database.start()
+    if g_conf_parameter.metrics_enable == 1:
+        global g_metrics_task
+        g_metrics_task = loop.create_task(flush_metrics())
+
+
+async def close_database(app, loop):
+    if g_metrics_task is not None:
+        g_metrics_task.cancel()
+    await g_feature_database.close()
+
+
 def main():
     # 解析配置文件
     parser = argparse.ArgumentParser()
@@ -60,8 +185,34 @@ def main():
     logger.set_back_count(g_conf_parameter.log_back_count)
     logger.start()
 
+    global g_compression
+    g_compression = Compression(encodings=g_conf_parameter.compression_encodings,
+                                level=g_conf_parameter.compression_level,
+                                min_size=g_conf_parameter.compression_min_size)
+
+    loop = asyncio.get_event_loop()
+    if g_conf_parameter.mysql_index_check == 1:
+        # 检查区域的查询是否用到了 sql/region_index.sql 中的索引，没有配置区域时用整个城市和按区县两种语句各检查一次
+        regions = g_conf_parameter.index_regions or [("0", "0", "-1"), ("0", "0", "0")]
+        loop.run_until_complete(g_feature_database.check_region_indexes(regions))
+    if g_conf_parameter.index_enable == 1:
+        # 在启动 worker 之前生成共享的索引文件
+        loop.run_until_complete(g_feature_database.build_id_indexes())
+    # 数据库连接池不能带到 worker 的事件循环中，用完后关闭
+    loop.run_until_complete(g_feature_database.close())
+
     app = Sanic("feature_sync_server")
     app.add_route(process_feature_request, "/feature", methods=["GET", "POST"])
+    app.add_route(process_export_request, "/feature/export", methods=["GET"])
+    if g_conf_parameter.metrics_enable == 1:
+        clear_snapshots(metrics_dir(get_state_dir()))
+        app.add_route(process_metrics_request, "/metrics", methods=["GET"])
+    app.register_listener(start_database, "before_server_start")
+    app.register_listener(close_database, "after_server_stop")
+
+    if g_conf_parameter.mysql_max_connections and g_conf_parameter.mysql_max_connections < g_conf_parameter.workers_num:
+        logger.warning("[database] max_connections {} < workers_num {}, each worker still uses 1 connection".format(
+                       g_conf_parameter.mysql_max_connections, g_conf_parameter.workers_num))
 
     logger.info("{0} feature_sync_server start at port {1} wrokers {2} conf {3} {0}".format(
         "*" * 10, g_conf_parameter.server_port, g_conf_parameter.workers_num, args.config_path))
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import re
+import functools
+
+from lib.logger import logger
+
+# 语句中按区域过滤的通配写法，town_code 为 -1 时表示整个城市
+_TOWN_WILDCARD = re.compile(r"\s+and\s+\(%\(town_code\)s\s*=\s*'-1'\s+or\s+town_code\s*=\s*%\(town_code\)s\)")
+
+# sql/region_index.sql 中创建的索引: 整个城市的查询用 (province_code, city_code, id)，按区县的查询用 (province_code, city_code, town_code, id)
+CITY_INDEX = "idx_region_city_id"
+TOWN_INDEX = "idx_region_town_id"
+
+
+@functools.lru_cache(maxsize=None)
+def _specialize(statement, whole_city):
+    if whole_city:
+        return _TOWN_WILDCARD.sub("", statement)
+    return _TOWN_WILDCARD.sub(" and town_code=%(town_code)s", statement)
+
+
+def region_statement(statement, town_code):
+    """
+    把 (%(town_code)s='-1' or town_code=%(town_code)s) 按 town_code 展开成两种语句中的一种:
+        town_code 为 -1（或没有）时去掉 town_code 的条件，否则为 town_code=%(town_code)s，
+    带 or 的条件 MySQL 不能用组合索引，MAX(id) 和按 id 的范围查询会扫描整个城市
+    """
+    return _specialize(statement, town_code in (None, "", "-1"))
+
+
+def expected_index(town_code):
+    return CITY_INDEX if town_code in (None, "", "-1") else TOWN_INDEX
+
+
+async def check_region_index(database_client, name, statement, parameter):
+    """
+    EXPLAIN 展开后的语句，没有用到区域的索引时打印警告（需要执行 sql/region_index.sql），返回是否用到
+    """
+    town_code = parameter.get("town_code")
+    index = expected_index(town_code)
+    try:
+        plans = await database_client.query_all("explain " + region_statement(statement, town_code), parameter=parameter)
+    except Exception as e:
+        logger.warning("[region_index] explain {} failed: {}".format(name, e))
+        return False
+
+    keys = [plan.get("key") for plan in plans or []]
+    if index not in keys:
+        logger.warning("[region_index] {} ({}/{}/{}) does not use index {}, key: {}, run sql/region_index.sql".format(
+                       name, parameter.get("province_code"), parameter.get("city_code"), town_code, index, keys))
+        return False
+
+    logger.info("[region_index] {} ({}/{}/{}) use index {}".format(
+                name, parameter.get("province_code"), parameter.get("city_code"), town_code, index))
+    return True
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import unittest
+
+import aiomysql
+
+from lib.testing import run
+from lib.mysql_client import MysqlClient, classify_error, CONNECTION, TRANSIENT
+
+
+class ClassifyErrorTest(unittest.TestCase):
+    def test_connection(self):
+        for err in (ConnectionResetError(), asyncio.IncompleteReadError(b"", 4), aiomysql.InterfaceError(0, ""),
+                    aiomysql.OperationalError(2013, "Lost connection to MySQL server during query")):
+            self.assertEqual(classify_error(err), CONNECTION, repr(err))
+
+    def test_transient(self):
+        for code in (1213, 1040):
+            self.assertEqual(classify_error(aiomysql.OperationalError(code, "")), TRANSIENT)
+
+    def test_not_retried(self):
+        for err in (aiomysql.IntegrityError(1062, "Duplicate entry"), aiomysql.OperationalError(), ValueError()):
+            self.assertIsNone(classify_error(err), repr(err))
+
+
+class RetryTest(unittest.TestCase):
+    def client(self):
+        client = MysqlClient()
+        client._max_retries = 2
+        client._retry_backoff = 0
+        client._retry_backoff_max = 0
+        return client
+
+    def test_retry_transient(self):
+        client = self.client()
+        errors = [aiomysql.OperationalError(1213, "Deadlock found"), aiomysql.OperationalError(1205, "Lock wait timeout")]
+
+        async def func(value):
+            if errors:
+                raise errors.pop(0)
+            return value
+
+        self.assertEqual(run(lambda: client._retry(func, 7)), 7)
+        self.assertEqual(client.retry_count, 2)
+
+    def test_give_up(self):
+        client = self.client()
+
+        async def func():
+            raise aiomysql.OperationalError(1213, "Deadlock found")
+
+        with self.assertRaises(aiomysql.OperationalError):
+            run(lambda: client._retry(func))
+        self.assertEqual(client.retry_count, 2)
+
+    def test_data_error_not_retried(self):
+        client = self.client()
+
+        async def func():
+            raise aiomysql.IntegrityError(1062, "Duplicate entry")
+
+        with self.assertRaises(aiomysql.IntegrityError):
+            run(lambda: client._retry(func))
+        self.assertEqual(client.retry_count, 0)
+
+
+class FakeCursor(object):
+    """
+    parameter 中的 rows 为影响的行数，error 为抛出的 IntegrityError
+    """
+    def __init__(self, log):
+        self._log = log
+        self.rowcount = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
+
+    async def execute(self, statement, parameter=None):
+        self._log.append(statement)
+        if "error" in parameter:
+            raise aiomysql.IntegrityError(1062, parameter["error"])
+        self.rowcount = parameter["rows"]
+
+
+class FakeConnection(object):
+    def __init__(self):
+        self.log = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
+
+    def cursor(self):
+        return FakeCursor(self.log)
+
+    async def begin(self):
+        self.log.append("begin")
+
+    async def commit(self):
+        self.log.append("commit")
+
+    async def rollback(self):
+        self.log.append("rollback")
+
+
+class TransactionTest(unittest.TestCase):
+    operations = [("insert 1", dict(rows=1)),
+                  ("insert 2", dict(error="Duplicate entry")),
+                  ("delete 3", dict(rows=0), True),
+                  ("update 4", dict(rows=1))]
+
+    def execute(self, operations, fail_fast):
+        client = MysqlClient()
+        conn = FakeConnection()
+        client._connection = lambda: conn
+        return run(lambda: client._execute_transaction(operations, fail_fast)), conn.log
+
+    def test_fail_fast(self):
+        (committed, result), log = self.execute(self.operations, True)
+        self.assertFalse(committed)
+        self.assertEqual(result, [(1, None), (0, "(1062, 'Duplicate entry')"), (0, "not executed"), (0, "not executed")])
+        self.assertEqual(log, ["begin", "insert 1", "insert 2", "rollback"])
+
+    def test_continue(self):
+        (committed, result), log = self.execute(self.operations, False)
+        self.assertTrue(committed)
+        # 没有影响任何行的 delete 3 带 allow_empty，不算失败
+        self.assertEqual(result, [(1, None), (0, "(1062, 'Duplicate entry')"), (0, None), (1, None)])
+        self.assertEqual(log, ["begin", "insert 1", "insert 2", "delete 3", "update 4", "commit"])
+
+    def test_no_row_affected(self):
+        (committed, result), log = self.execute([("update 1", dict(rows=0)), ("update 2", dict(rows=1))], True)
+        self.assertFalse(committed)
+        self.assertEqual(result, [(0, "no row affected"), (0, "not executed")])
+        self.assertEqual(log, ["begin", "update 1", "rollback"])
+
+
+if __name__ == '__main__':
+    unittest.main()
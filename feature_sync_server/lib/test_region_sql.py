@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import filecmp
+import unittest
+
+from lib.region_sql import region_statement, expected_index, CITY_INDEX, TOWN_INDEX
+
+STATEMENT = "select max(id) as id from user where province_code=%(province_code)s and city_code=%(city_code)s " \
+            "and (%(town_code)s='-1' or town_code=%(town_code)s)"
+
+
+class RegionStatementTest(unittest.TestCase):
+    def test_whole_city(self):
+        for town_code in ("-1", None, ""):
+            self.assertEqual(region_statement(STATEMENT, town_code),
+                             "select max(id) as id from user where province_code=%(province_code)s and city_code=%(city_code)s")
+            self.assertEqual(expected_index(town_code), CITY_INDEX)
+
+    def test_town(self):
+        self.assertEqual(region_statement(STATEMENT, "321084"),
+                         "select max(id) as id from user where province_code=%(province_code)s and city_code=%(city_code)s "
+                         "and town_code=%(town_code)s")
+        self.assertEqual(expected_index("321084"), TOWN_INDEX)
+
+    def test_without_wildcard(self):
+        statement = "select id from user where id in %(ids)s"
+        self.assertEqual(region_statement(statement, "-1"), statement)
+        self.assertEqual(region_statement(statement, "321084"), statement)
+
+    def test_client_copy(self):
+        root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        self.assertTrue(filecmp.cmp(os.path.join(root, "feature_sync_server", "lib", "region_sql.py"),
+                                    os.path.join(root, "feature_sync_client", "lib", "region_sql.py"), shallow=False))
+
+
+if __name__ == '__main__':
+    unittest.main()
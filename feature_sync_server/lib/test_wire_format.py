@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import filecmp
+import unittest
+
+from lib import wire_format
+from lib.wire_format import JSON, MSGPACK, decode_bytes_fields
+
+# 不是合法 utf-8 的二进制
+FEATURE = bytes(range(256)) * 4
+PIC_MD5 = b"\x00\xff\x80\x7f" * 4
+
+
+def feature_row():
+    return dict(id=1, user_id=2, timestamp=3, feature_id=0, feature=FEATURE,
+                province_code="320000", city_code="321000", town_code="321084")
+
+
+class BytesFieldsTest(unittest.TestCase):
+    formats = [JSON, MSGPACK] if wire_format.msgpack is not None else [JSON]
+
+    def test_request_round_trip(self):
+        # 客户端把行放在请求体中，服务端按 Content-Type 解析后还原 bytes 列
+        for content_type in self.formats:
+            body = dict(command="batch", commands=[dict(command="add_feature_model_0330", values=feature_row()),
+                                                   dict(command="add_user", values=dict(id=2, uid="u", pic_md5=PIC_MD5))])
+            data = wire_format.loads(wire_format.dumps(body, content_type), content_type)
+            self.assertEqual(decode_bytes_fields(data["commands"][0]["values"]), feature_row(), content_type)
+            self.assertEqual(decode_bytes_fields(data["commands"][1]["values"])["pic_md5"], PIC_MD5, content_type)
+
+    def test_response_round_trip(self):
+        for content_type in self.formats:
+            data = wire_format.loads(wire_format.dumps(dict(code=0, data=[feature_row()]), content_type), content_type)
+            self.assertEqual([decode_bytes_fields(row) for row in data["data"]], [feature_row()], content_type)
+
+    def test_export_line(self):
+        # /feature/export 每一行都是 json
+        line = wire_format.json_dumps(feature_row())
+        self.assertEqual(decode_bytes_fields(wire_format.loads(line)), feature_row())
+
+    def test_none(self):
+        self.assertEqual(decode_bytes_fields(dict(id=1, pic_md5=None)), dict(id=1, pic_md5=None))
+
+    def test_client_copy(self):
+        root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        self.assertTrue(filecmp.cmp(os.path.join(root, "feature_sync_server", "lib", "wire_format.py"),
+                                    os.path.join(root, "feature_sync_client", "lib", "wire_format.py"), shallow=False))
+
+
+if __name__ == '__main__':
+    unittest.main()
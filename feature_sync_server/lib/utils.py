@@ -18,6 +18,13 @@ def get_log_dir():
     return os.path.join(get_script_path(), 'log')
 
 
+def get_state_dir():
+    state_dir = os.path.join(get_script_path(), 'state')
+    if not os.path.isdir(state_dir):
+        os.mkdir(state_dir)
+    return state_dir
+
+
 def single_ton(cls):
     ins = dict()
     def _warpper(*arg,**kwars):